@@ -22,19 +22,27 @@ from typing import List
 
 from openai import AsyncOpenAI
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, PicklePersistence
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
 from bot_partials.errors import TGErrorHandler
 from bot_partials.general import TGBotGeneral
 from bot_partials.leaderboard import TGLeaderboard
 from bot_partials.logger import produce_logger, init_logging
+from bot_partials.long_output import OutputRenderer
+from bot_partials.outbox import MessageScheduler
 from bot_partials.prompting import TGPrompter
 from bot_partials.router import MessageRouter
 from bot_partials.selector import TGSelector
+from bot_partials.sql_persistence import SQLitePersistence
+from bot_partials.update_processor import PerUserUpdateProcessor, DEFAULT_MAX_CONCURRENT_UPDATES
+from bot_partials.webhook import WebhookServer, run_webhook
+from core.jobs import DEFAULT_SHUTDOWN_GRACE_S, EvaluationJobStore, EvaluationWorkerPool
+from core.llm_cache import LLMResponseCache
 from core.llm_manager import LLMManager
 from core.prompt_db import PromptDBManager
-from core.prompter import PromptRunner
-from core.ratelimit import RateLimiter, RateLimitedBatchQueue
+from core.prompter import DEFAULT_SNIPPET_TIMEOUT_S, PromptRunner
+from core.ratelimit import RateLimitedBatchQueue
+from core.rendering import default_renderer
 from core.task_management import TaskManager
 
 
@@ -58,9 +66,74 @@ def parse_args(input_string: List[str] = None) -> argparse.Namespace:
         default='logs',
         help="Path to log file"
     )
+    parser.add_argument(
+        "--max_concurrent_updates",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_UPDATES,
+        help="Max number of updates processed at once, updates of one user are processed in order"
+    )
+    parser.add_argument(
+        "--snippet_timeout_s",
+        type=float,
+        default=DEFAULT_SNIPPET_TIMEOUT_S,
+        help="Time an LLM call of a snippet may take once it leaves the queue, a single /run_snippet gets it in total"
+    )
+    parser.add_argument(
+        "--shutdown_grace_s",
+        type=float,
+        default=DEFAULT_SHUTDOWN_GRACE_S,
+        help="Time to let running evaluations finish on shutdown, the rest resume on the next start"
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=['polling', 'webhook'],
+        default='polling',
+        help="How to get updates from Telegram"
+    )
+    parser.add_argument(
+        "--webhook_host",
+        type=str,
+        default='0.0.0.0',
+        help="Address the webhook server listens on"
+    )
+    parser.add_argument(
+        "--webhook_port",
+        type=int,
+        default=8080,
+        help="Port the webhook server listens on"
+    )
+    parser.add_argument(
+        "--webhook_path",
+        type=str,
+        default='/telegram',
+        help="Path Telegram posts updates to"
+    )
+    parser.add_argument(
+        "--webhook_secret",
+        type=str,
+        default=os.environ.get("TG_WEBHOOK_SECRET"),
+        help="Secret token Telegram sends with every update (TG_WEBHOOK_SECRET by default)"
+    )
+    parser.add_argument(
+        "--webhook_url",
+        type=str,
+        default=None,
+        help="Public URL of the webhook to register in Telegram on start, e.g. https://bot.example.com/telegram"
+    )
     return parser.parse_args(input_string)
 
 
+STATS_LOG_INTERVAL_S = 60.0
+
+
+async def log_llm_stats(logger, llms: LLMManager, outbox: MessageScheduler):
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL_S)
+        logger.info(f'llm stats: {llms.stats()}')
+        logger.info(f'outbox stats: {outbox.stats()}')
+
+
 def main(args) -> None:
     """Start the bot."""
     init_logging()
@@ -72,21 +145,27 @@ def main(args) -> None:
 
     task_manager = TaskManager(args)
     sql_db = PromptDBManager()
-    llms = LLMManager(Path(args.data_root) / 'llm_config.yaml')
+    llm_cache = LLMResponseCache(f"{args.persistence_dir}/llm_cache.db")
+    llms = LLMManager(Path(args.data_root) / 'llm_config.yaml', cache=llm_cache)
 
-    limiter = RateLimiter()
-    queue = RateLimitedBatchQueue(limiter)
-    prompt_runner = PromptRunner(limiter, queue, sql_db, llms)
+    queue = RateLimitedBatchQueue()
+    prompt_runner = PromptRunner(queue, sql_db, llms, snippet_timeout_s=args.snippet_timeout_s)
 
     logger = produce_logger(Path(args.log_pth) / 'bot.log', logger_tag='bot')
     prompt_logger = produce_logger(Path(args.log_pth) / 'prompts.log', logger_tag='prompts', propagate=False)
     error_logger = produce_logger(Path(args.log_pth) / 'error.log', logger_tag='error_bot')
 
-    bot_general = TGBotGeneral(logger, sql_db)
-    bot_leaderboard = TGLeaderboard(logger, sql_db)
-    bot_prompter = TGPrompter(logger, prompt_logger, task_manager, prompt_runner)
-    bot_selector = TGSelector(logger, task_manager)
-    bot_error = TGErrorHandler(error_logger)
+    outbox = MessageScheduler(logger)
+    # Shared with PromptTask.short_description and __repr__: one set of compiled templates and one cache
+    renderer = default_renderer()
+    output = OutputRenderer(outbox, logger)
+    job_store = EvaluationJobStore(f"{args.persistence_dir}/jobs.db")
+    jobs = EvaluationWorkerPool(job_store, prompt_runner, task_manager, logger)
+    bot_general = TGBotGeneral(logger, sql_db, outbox, renderer)
+    bot_leaderboard = TGLeaderboard(logger, sql_db, outbox)
+    bot_prompter = TGPrompter(logger, prompt_logger, task_manager, prompt_runner, outbox, output, jobs)
+    bot_selector = TGSelector(logger, task_manager, outbox, renderer)
+    bot_error = TGErrorHandler(error_logger, outbox)
 
     bot_router = MessageRouter(
         partials=[
@@ -97,11 +176,32 @@ def main(args) -> None:
         default_partial=bot_prompter
     )
 
+    monitoring_tasks = []
+
+    async def start_monitoring(application: Application):
+        monitoring_tasks.append(asyncio.create_task(log_llm_stats(logger, llms, outbox)))
+        monitoring_tasks.append(asyncio.create_task(task_manager.watch(logger)))
+        await bot_prompter.start_jobs(application.bot)
+
+    async def stop_monitoring(application: Application):
+        # No new updates come at this point, the evaluations in flight get the grace period
+        await jobs.stop(args.shutdown_grace_s)
+        for task in monitoring_tasks:
+            task.cancel()
+
     # Create the Application and pass it your bot's token.
-    persistence = PicklePersistence(filepath=f"{args.persistence_dir}/prompetition_bot")
+    # user_data used to be in a pickle rewritten as a whole on every flush, it's imported once
+    persistence = SQLitePersistence(f"{args.persistence_dir}/bot_data.db", logger=logger)
+    persistence.migrate_from_pickle(f"{args.persistence_dir}/prompetition_bot")
     application = (Application.builder()
                    .token(os.environ.get("TG_TOKEN"))
                    .persistence(persistence)
+                   .concurrent_updates(PerUserUpdateProcessor(
+                       max_concurrent_updates=args.max_concurrent_updates,
+                       unordered_commands=['stop']
+                   ))
+                   .post_init(start_monitoring)
+                   .post_stop(stop_monitoring)
                    .build())
 
     filter = ~filters.UpdateType.EDITED_MESSAGE
@@ -120,6 +220,8 @@ def main(args) -> None:
     application.add_handler(CommandHandler("run_snippet", bot_prompter.run_snippet, filter))
     application.add_handler(CommandHandler("run_open", bot_prompter.run_open, filter))
     application.add_handler(CommandHandler("run_to_score", bot_prompter.run_to_score, filter))
+    # /stop isn't queued behind the user's running command, see PerUserUpdateProcessor
+    application.add_handler(CommandHandler("stop", bot_prompter.stop, filter))
 
     application.add_handler(CommandHandler("task_show", bot_selector.show_task, filter))
     application.add_handler(CommandHandler("task_list", bot_selector.task_list, filter))
@@ -137,11 +239,23 @@ def main(args) -> None:
     application.add_error_handler(bot_error.handler)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if args.mode == 'webhook':
+        server = WebhookServer(
+            application,
+            logger,
+            host=args.webhook_host,
+            port=args.webhook_port,
+            path=args.webhook_path,
+            secret_token=args.webhook_secret
+        )
+        asyncio.run(run_webhook(application, server, webhook_url=args.webhook_url))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
     async def to_close():
-        await limiter.close()
+        await llms.close()
         sql_db.close()
+        llm_cache.close()
         await aclient.close()
 
     asyncio.run(to_close())
@@ -5,9 +5,13 @@ from logging import Logger
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from bot_partials.outbox import MessageScheduler
+
+
 class TGErrorHandler:
-    def __init__(self, logger: Logger):
+    def __init__(self, logger: Logger, outbox: MessageScheduler):
         self.logger = logger
+        self.outbox = outbox
 
     async def handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Log the error and send a telegram message to notify the developer."""
@@ -22,4 +26,6 @@ class TGErrorHandler:
         )
         self.logger.error(message)
 
-        await update.effective_user.send_message("Oops, something went wrong.")
+        # Errors of jobs and other background work come without a chat to answer to
+        if isinstance(update, Update) and update.effective_chat is not None:
+            await self.outbox.send(update.effective_chat, "Oops, something went wrong.")
@@ -1,6 +1,7 @@
 from logging import Logger
 from typing import List
 
+from bot_partials.outbox import MessageScheduler
 from bot_partials.partial import Partial
 from bot_partials.state import MessageState
 from telegram import Update
@@ -8,14 +9,17 @@ from telegram.ext import ContextTypes
 
 from bot_partials.userdata_keys import USER_NAME_KEY, STATE_KEY
 from core.prompt_db import PromptDBManager
-from core.utils import from_txt_file, tg_user_id
+from core.rendering import TemplateRenderer
+from core.utils import tg_user_id
 
 
 class TGBotGeneral(Partial):
 
-    def __init__(self, logger: Logger, sql_db: PromptDBManager):
+    def __init__(self, logger: Logger, sql_db: PromptDBManager, outbox: MessageScheduler, renderer: TemplateRenderer):
         self.logger = logger
         self.sql_db = sql_db
+        self.outbox = outbox
+        self.renderer = renderer
 
     @property
     def message_states(self) -> List[MessageState]:
@@ -25,19 +29,19 @@ class TGBotGeneral(Partial):
     # context.
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /start is issued."""
-        await update.effective_chat.send_message(from_txt_file('templates/greetings.txt'), parse_mode='HTML')
+        await self.outbox.send(update.effective_chat, self.renderer.static_text('greetings.txt'), parse_mode='HTML')
         context.user_data[STATE_KEY] = MessageState.EXPECTING_NAME
         user = update.effective_user
         self.logger.info(f'/start / {user.id} / {user.name}')
         if USER_NAME_KEY not in context.user_data:
             self.logger.info(f'/start / {user.id} / {user.name}: asked for the name')
-            await update.effective_chat.send_message('Before running the bot, please set your name:')
+            await self.outbox.send(update.effective_chat, 'Before running the bot, please set your name:')
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /help is issued."""
         user = update.effective_user
         self.logger.info(f'/help / {user.id} / {user.name}.')
-        await update.effective_chat.send_message(from_txt_file('templates/help.txt'), parse_mode='HTML')
+        await self.outbox.send(update.effective_chat, self.renderer.static_text('help.txt'), parse_mode='HTML')
 
     async def whoami(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /help is issued."""
@@ -51,7 +55,7 @@ class TGBotGeneral(Partial):
 
         message = name or "No name has been found."
         self.logger.info(f'/whoami / {user.id} / {user.name}: {message}')
-        await update.effective_chat.send_message(message)
+        await self.outbox.send(update.effective_chat, message)
 
     async def set_name(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /help is issued."""
@@ -63,13 +67,14 @@ class TGBotGeneral(Partial):
             context.user_data[USER_NAME_KEY] = name
             self.sql_db.update_user_name(tg_user_id(update.effective_user.id), name)
             context.user_data[STATE_KEY] = MessageState.IDLE
-            await update.effective_chat.send_message(
+            await self.outbox.send(
+                update.effective_chat,
                 f"Ok, now your name is stored as <b>{name}</b>. You can change it with /set_name.",
                 parse_mode='HTML',
             )
         else:
             context.user_data[STATE_KEY] = MessageState.EXPECTING_NAME
-            await update.effective_chat.send_message("Ok, now type your name in:")
+            await self.outbox.send(update.effective_chat, "Ok, now type your name in:")
 
     async def message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Echo the user message."""
@@ -81,12 +86,14 @@ class TGBotGeneral(Partial):
                 context.user_data[USER_NAME_KEY] = name
                 self.sql_db.update_user_name(tg_user_id(update.effective_user.id), name)
                 context.user_data[STATE_KEY] = MessageState.IDLE
-                await update.effective_chat.send_message(
+                await self.outbox.send(
+                    update.effective_chat,
                     f"Ok, now your name is stored as <b>{name}</b>. You can change it with /set_name.",
                     parse_mode='HTML'
                 )
             else:
                 self.logger.info(f'general.message / {user.id} / {user.name}: failed to set the name `{update.message.text}`.')
-                await update.effective_chat.send_message(
+                await self.outbox.send(
+                    update.effective_chat,
                     f"Can't see the name. Try again."
                 )
\ No newline at end of file
@@ -2,6 +2,7 @@ from logging import Logger
 from typing import List
 
 from bot_partials.focus import FocusManagement
+from bot_partials.outbox import MessageScheduler
 from bot_partials.partial import Partial
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -14,9 +15,10 @@ LEADERBOARD_SIZE = 10
 
 class TGLeaderboard(Partial):
 
-    def __init__(self, logger: Logger, sql_db: PromptDBManager):
+    def __init__(self, logger: Logger, sql_db: PromptDBManager, outbox: MessageScheduler):
         self.logger = logger
         self.sql_db = sql_db
+        self.outbox = outbox
 
     @staticmethod
     def form_board_lines(board: List[LeaderRow], user_id: str):
@@ -47,7 +49,7 @@ class TGLeaderboard(Partial):
         focus = FocusManagement(context)
         if focus.task is None:
             self.logger.info(f'/leaderboard / {user.id} / {user.name}: no task')
-            await update.effective_chat.send_message('No task has been selected.')
+            await self.outbox.send(update.effective_chat, 'No task has been selected.')
             return
 
         board = self.sql_db.form_leader_board(focus.task)
@@ -58,7 +60,7 @@ class TGLeaderboard(Partial):
         if len(board) == 0:
             self.logger.info(f'/leaderboard / {user.id} / {user.name} / {focus.task}: empty leaderboard')
             message = f'<b>Leaderboard {focus.task}</b>\n\nNo entries.'
-            await update.effective_chat.send_message(message, parse_mode='HTML')
+            await self.outbox.send(update.effective_chat, message, parse_mode='HTML')
             return
 
         top_k_lines = TGLeaderboard.form_board_lines(board, user_id)
@@ -67,4 +69,4 @@ class TGLeaderboard(Partial):
         top_k_msg = '\n'.join(top_k_lines)
         message = f'<b>Leaderboard {focus.task}</b>\n\n<code>{html_escape(top_k_msg)}</code>'
 
-        await update.effective_chat.send_message(message, parse_mode='HTML')
\ No newline at end of file
+        await self.outbox.send(update.effective_chat, message, parse_mode='HTML')
\ No newline at end of file
@@ -0,0 +1,67 @@
+import gzip
+from logging import Logger
+from typing import Awaitable, Callable, Optional
+
+from telegram import Chat, InputFile
+
+from bot_partials.outbox import MessageScheduler
+from core.utils import TG_MESSAGE_LENGTH, split_tg_html
+
+# Output taking more messages than this is sent as a single document instead
+DEFAULT_MAX_MESSAGES = 4
+
+DOCUMENT_TEMPLATE = (
+    '<!DOCTYPE html>\n'
+    '<html><head><meta charset="utf-8"><title>{title}</title></head>\n'
+    '<body style="white-space: pre-wrap; font-family: sans-serif">\n{body}\n</body></html>\n'
+)
+
+EditCallable = Callable[..., Awaitable]
+
+
+class OutputRenderer:
+    """
+    Delivers HTML output of any length: split into messages at safe tag boundaries,
+    or, past `max_messages`, attached as one gzipped HTML document.
+    """
+
+    def __init__(self,
+                 outbox: MessageScheduler,
+                 logger: Logger,
+                 max_messages: int = DEFAULT_MAX_MESSAGES,
+                 message_length: int = TG_MESSAGE_LENGTH):
+        self.outbox = outbox
+        self.logger = logger
+        self.max_messages = max_messages
+        self.message_length = message_length
+
+    @staticmethod
+    def html_document(html: str, title: str) -> bytes:
+        # Telegram HTML is a subset of HTML, a browser shows it as it is
+        return gzip.compress(DOCUMENT_TEMPLATE.format(title=title, body=html).encode('utf-8'))
+
+    async def send(self,
+                   chat: Chat,
+                   html: str,
+                   summary: str,
+                   filename: str,
+                   edit: Optional[EditCallable] = None):
+        """
+        `summary` (HTML) goes along the document, `edit` (e.g. message.edit_text) puts the first part
+        into an already sent message instead of sending a new one.
+        """
+        parts = split_tg_html(html, self.message_length)
+        if len(parts) > self.max_messages:
+            self.logger.info(f'output of {len(html)} chars is sent as {filename}.html.gz')
+            document = InputFile(self.html_document(html, filename), filename=f'{filename}.html.gz')
+            if edit is not None:
+                await edit(summary, parse_mode='HTML')
+                await self.outbox.send_document(chat, document)
+            else:
+                await self.outbox.send_document(chat, document, caption=summary, parse_mode='HTML')
+            return
+        if edit is not None:
+            await edit(parts[0], parse_mode='HTML')
+            parts = parts[1:]
+        for part in parts:
+            await self.outbox.send(chat, part, parse_mode='HTML')
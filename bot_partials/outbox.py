@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import dataclasses
+import time
+from logging import Logger
+from typing import Any, Deque, Dict, Hashable, List, Optional
+
+from telegram import Chat, InputFile, Message
+from telegram.constants import ChatType
+from telegram.error import RetryAfter
+
+from bot_partials.streaming import MAX_MESSAGE_LENGTH, retry_after_s
+from core.ratelimit import TokenBucket
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_MESSAGES_PER_S = 30.0
+PRIVATE_CHAT_MESSAGES_PER_S = 1.0
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_MESSAGES_PER_S = 20.0 / 60.0
+GROUP_CHAT_BURST = 1
+
+MERGE_SEPARATOR = '\n\n'
+
+
+@dataclasses.dataclass(eq=False)
+class _Outgoing:
+    chat: Chat
+    text: str
+    parse_mode: Optional[str]
+    kwargs: Dict[str, Any]
+    coalesce: bool
+    futures: List[asyncio.Future]
+    # The text is the caption then
+    document: Optional[InputFile] = None
+
+    def can_merge(self, other: '_Outgoing') -> bool:
+        return (self.coalesce and other.coalesce
+                and self.document is None and other.document is None
+                and not self.kwargs and not other.kwargs
+                and self.parse_mode == other.parse_mode
+                and len(self.text) + len(MERGE_SEPARATOR) + len(other.text) <= MAX_MESSAGE_LENGTH)
+
+    def merge(self, other: '_Outgoing'):
+        self.text += MERGE_SEPARATOR + other.text
+        self.futures.extend(other.futures)
+
+    async def deliver(self) -> Message:
+        if self.document is not None:
+            return await self.chat.send_document(
+                self.document, caption=self.text, parse_mode=self.parse_mode, **self.kwargs
+            )
+        return await self.chat.send_message(self.text, parse_mode=self.parse_mode, **self.kwargs)
+
+
+class MessageScheduler:
+    """
+    Sends messages within Telegram's global and per-chat limits, a queue and a sender task per chat.
+
+    Messages of a chat go out in order. While a chat is throttled its pending messages pile up
+    and consecutive ones are merged into one message, unless sent with coalesce=False
+    (e.g. the message is edited later). RetryAfter pauses the chat for the time asked.
+    """
+
+    def __init__(self,
+                 logger: Logger,
+                 global_rate_per_s: float = GLOBAL_MESSAGES_PER_S,
+                 private_rate_per_s: float = PRIVATE_CHAT_MESSAGES_PER_S,
+                 group_rate_per_s: float = GROUP_CHAT_MESSAGES_PER_S):
+        self.logger = logger
+        self.private_rate_per_s = private_rate_per_s
+        self.group_rate_per_s = group_rate_per_s
+        self.global_bucket = TokenBucket(global_rate_per_s, capacity=global_rate_per_s)
+
+        self.queues: Dict[Hashable, Deque[_Outgoing]] = dict()
+        self.chat_buckets: Dict[Hashable, TokenBucket] = dict()
+        self.paused_until_s: Dict[Hashable, float] = dict()
+        self.senders: Dict[Hashable, asyncio.Task] = dict()
+
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat: Chat) -> TokenBucket:
+        if chat.id not in self.chat_buckets:
+            if getattr(chat, 'type', None) in (ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL):
+                bucket = TokenBucket(self.group_rate_per_s, capacity=GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(self.private_rate_per_s, capacity=PRIVATE_CHAT_BURST)
+            self.chat_buckets[chat.id] = bucket
+        return self.chat_buckets[chat.id]
+
+    async def send(self,
+                   chat: Chat,
+                   text: str,
+                   parse_mode: Optional[str] = None,
+                   coalesce: bool = True,
+                   **kwargs) -> Message:
+        # Resolves once the message (possibly merged with the next ones) is sent
+        future = asyncio.get_running_loop().create_future()
+        return await self._enqueue(_Outgoing(chat, text, parse_mode, kwargs, coalesce, [future]))
+
+    async def send_document(self,
+                            chat: Chat,
+                            document: InputFile,
+                            caption: Optional[str] = None,
+                            parse_mode: Optional[str] = None,
+                            **kwargs) -> Message:
+        future = asyncio.get_running_loop().create_future()
+        return await self._enqueue(_Outgoing(chat, caption, parse_mode, kwargs, False, [future], document))
+
+    async def _enqueue(self, outgoing: _Outgoing) -> Message:
+        chat = outgoing.chat
+        future = outgoing.futures[0]
+        self.queues.setdefault(chat.id, collections.deque()).append(outgoing)
+        if chat.id not in self.senders:
+            self.senders[chat.id] = asyncio.create_task(self._send_queue(chat.id))
+        return await asyncio.shield(future)
+
+    def _delay_s(self, chat: Chat) -> float:
+        pause_s = self.paused_until_s.get(chat.id, 0.0) - time.monotonic()
+        return max(pause_s, self._chat_bucket(chat).delay_s(), self.global_bucket.delay_s())
+
+    async def _send_queue(self, chat_id: Hashable):
+        queue = self.queues[chat_id]
+        outgoing = None
+        try:
+            while queue:
+                delay_s = self._delay_s(queue[0].chat)
+                if delay_s > 0:
+                    await asyncio.sleep(delay_s)
+                    continue
+                outgoing = queue.popleft()
+                while queue and outgoing.can_merge(queue[0]):
+                    outgoing.merge(queue.popleft())
+                    self.merged += 1
+                self._chat_bucket(outgoing.chat).consume()
+                self.global_bucket.consume()
+                try:
+                    message = await outgoing.deliver()
+                except RetryAfter as e:
+                    self.logger.warning(f'outbox: chat {chat_id} is flood limited for {e.retry_after}s')
+                    self.paused_until_s[chat_id] = time.monotonic() + retry_after_s(e)
+                    self.retries += 1
+                    queue.appendleft(outgoing)
+                    continue
+                except Exception as e:
+                    for future in outgoing.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.sent += 1
+                for future in outgoing.futures:
+                    if not future.done():
+                        future.set_result(message)
+        finally:
+            # The sender is cancelled on shutdown, the ones waiting for it are cancelled too
+            for unsent in [outgoing, *queue]:
+                for future in ([] if unsent is None else unsent.futures):
+                    future.cancel()
+            self.senders.pop(chat_id, None)
+            self.queues.pop(chat_id, None)
+            self.paused_until_s.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chats_waiting': len(self.senders),
+            'pending': sum(len(queue) for queue in self.queues.values()),
+            'sent': self.sent,
+            'merged': self.merged,
+            'retries': self.retries,
+        }
@@ -1,32 +1,62 @@
+import contextlib
+from datetime import datetime, timezone
 from logging import Logger
-from typing import List
+from typing import Callable, Dict, List, Optional
 
-from telegram import Update
+from telegram import Bot, Chat, Message, Update
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes
 
 from bot_partials.focus import FocusManagement
+from bot_partials.long_output import OutputRenderer
+from bot_partials.outbox import MessageScheduler
 from bot_partials.partial import Partial
 from bot_partials.state import MessageState
+from bot_partials.streaming import StreamingMessage
 from bot_partials.userdata_keys import PROMPT_KEY, AUTOCLEAN_KEY, DEBUG_KEY, STOP_KEY
+from core.jobs import JOB_CANCELLED, EvaluationJob, EvaluationWorkerPool
 from core.llm_manager import LLMManager
-from core.prompter import PromptRunner
+from core.prompter import EvaluationStatus, PromptRunner, SnippetBatchEvaluation
+from core.ratelimit import BatchProgress, QueueOverflowError
 from core.task_management import TaskManager
 from core.utils import html_escape, tg_user_id
 
 DEFAULT_DEBUG_STATE = True
 DEFAULT_AUTOCLEAN_STATE = False
 
+QUEUE_OVERFLOW_MESSAGE = "The evaluation queue is full right now. Please try again in a few minutes."
+
+
+def progress_text(progress: BatchProgress) -> str:
+    lines = [f'Computing... {progress.done}/{progress.total} snippets done.']
+    status = progress.queue_status
+    if status is not None:
+        queue_line = f'Queue: {status.jobs_ahead} requests ahead of yours'
+        if status.eta_s is not None:
+            queue_line += f', ETA ~{status.eta_s:.0f}s'
+        lines.append(queue_line + '.')
+    return '\n'.join(lines)
+
 class TGPrompter(Partial):
 
     def __init__(self,
                  logger: Logger,
                  prompt_logger: Logger,
                  task_manager: TaskManager,
-                 runner: PromptRunner):
+                 runner: PromptRunner,
+                 outbox: MessageScheduler,
+                 output: OutputRenderer,
+                 jobs: EvaluationWorkerPool):
         self.logger = logger
         self.prompt_logger = prompt_logger
         self.task_manager = task_manager
         self.runner = runner
+        self.outbox = outbox
+        self.output = output
+        self.jobs = jobs
+        # Batch runs are delivered by the job pool, after a restart too: there's no update to reply to
+        self.bot: Optional[Bot] = None
+        self.job_notifiers: Dict[int, Callable] = dict()
 
     @property
     def message_states(self) -> List[MessageState]:
@@ -40,7 +70,7 @@ class TGPrompter(Partial):
         context.user_data[DEBUG_KEY] = debug
         message = "Debug mode is on." if debug else "Debug mode is off."
         self.logger.info(f'/switch_debug_mode / {user.id} / {user.name}: {message}')
-        await update.effective_chat.send_message(message)
+        await self.outbox.send(update.effective_chat, message)
 
     async def switch_autoclean(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /start is issued."""
@@ -50,7 +80,7 @@ class TGPrompter(Partial):
         context.user_data[AUTOCLEAN_KEY] = autoclean
         message = "Autoclean mode is on." if autoclean else "Autoclean mode is off."
         self.logger.info(f'/switch_autoclean / {user.id} / {user.name}: {message}')
-        await update.effective_chat.send_message(message)
+        await self.outbox.send(update.effective_chat, message)
 
     async def message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Echo the user message."""
@@ -73,16 +103,108 @@ class TGPrompter(Partial):
             "Use /snippet_focus and /run_snippet, to run on a single snippet.",
         ]
         hint_msg = '\n'.join(hints)
-        await update.effective_chat.send_message(
+        await self.outbox.send(
+            update.effective_chat,
             f"New prompt:\n<code>{prompt}</code>\n\n{hint_msg}", parse_mode='HTML'
         )
 
+    def _progress_notifier(self, message: Message):
+        last_text = message.text
+
+        async def notify(progress: BatchProgress):
+            nonlocal last_text
+            text = progress_text(progress)
+            if text == last_text:
+                return
+            try:
+                await message.edit_text(text)
+                last_text = text
+            except TelegramError as e:
+                self.logger.warning(f'progress update failed: {e}')
+
+        return notify
+
+    async def start_jobs(self, bot: Bot):
+        self.bot = bot
+        await self.jobs.start(self._deliver_job, self._job_progress)
+
+    async def _submit_job(self, update: Update, task_id: str, tag: str, prompt: str) -> EvaluationJob:
+        chat = update.effective_chat
+        # Edited with the progress, so it isn't merged with other messages
+        message = await self.outbox.send(chat, 'Computing...', coalesce=False)
+        return self.jobs.submit(
+            user_id=tg_user_id(update.effective_user.id),
+            chat_id=chat.id,
+            chat_type=chat.type,
+            message_id=message.message_id,
+            task_id=task_id,
+            tag=tag,
+            prompt=prompt
+        )
+
+    def _job_message(self, job: EvaluationJob) -> Message:
+        chat = Chat(id=job.chat_id, type=job.chat_type)
+        chat.set_bot(self.bot)
+        message = Message(message_id=job.message_id, date=datetime.now(timezone.utc), chat=chat)
+        message.set_bot(self.bot)
+        return message
+
+    async def _job_progress(self, job: EvaluationJob, progress: BatchProgress):
+        if job.job_id not in self.job_notifiers:
+            self.job_notifiers[job.job_id] = self._progress_notifier(self._job_message(job))
+        await self.job_notifiers[job.job_id](progress)
+
+    async def _deliver_job(self, job: EvaluationJob, result_batch: Optional[SnippetBatchEvaluation]):
+        self.job_notifiers.pop(job.job_id, None)
+        message = self._job_message(job)
+
+        async def edit(text: str, **kwargs):
+            # The job is already finished in the store: if the status message is gone or too old to edit,
+            # the result goes in a new message rather than nowhere
+            try:
+                return await message.edit_text(text, **kwargs)
+            except TelegramError as e:
+                self.logger.warning(f'job {job.job_id} / {job.user_id}: status message not edited: {e}')
+                return await self.outbox.send(message.chat, text, coalesce=False, **kwargs)
+
+        if result_batch is None:
+            self.logger.info(f'job {job.job_id} / {job.user_id}: {job.status}')
+            if job.status == JOB_CANCELLED:
+                text = "Stopped."
+            elif job.error is not None:
+                text = f"The run failed: {job.error}."
+            else:
+                text = "The run failed. Please try again."
+            await edit(text)
+            return
+
+        command = '/run_to_score' if job.tag == 'hidden' else '/run_open'
+        self.logger.info(f'{command} / {job.user_id} / job {job.job_id} / {result_batch.score * 100:.2f}')
+        self.prompt_logger.info(f'{command} / {job.user_id}\nprompt={job.prompt}\n\nresult_batch={result_batch.tg_html_form()}')
+        # Hidden snippets aren't shown, only their scores
+        html = result_batch.tg_html_form_semihidden() if job.tag == 'hidden' else result_batch.tg_html_form()
+        await self.output.send(
+            message.chat,
+            html,
+            summary=result_batch.tg_html_shortform(),
+            filename=f'{result_batch.task_id}_{result_batch.tag}',
+            edit=edit
+        )
+
+    async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        context.user_data[STOP_KEY] = True
+        cancelled = self.runner.cancel_user(tg_user_id(user.id)) + self.jobs.cancel_user(tg_user_id(user.id))
+        self.logger.info(f'/stop / {user.id} / {user.name}: {cancelled} requests cancelled')
+        message = "Stopped." if cancelled > 0 else "Nothing to stop."
+        await self.outbox.send(update.effective_chat, message)
+
     async def prompt_fetch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.effective_user
         prompt = context.user_data.get(PROMPT_KEY, None)
         self.logger.info(f'/prompt_fetch / {user.id} / {user.name}: {len(prompt) if prompt else "nothing"}')
         message = f"No prompt is set" if prompt is None else prompt
-        await update.effective_chat.send_message(message)
+        await self.outbox.send(update.effective_chat, message)
 
 
     async def run_to_score(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -92,23 +214,18 @@ class TGPrompter(Partial):
         focus = FocusManagement(context)
         if focus.task is None:
             self.logger.info(f'/run_to_score / {user.id} / {user.name}: no task selected')
-            await update.effective_chat.send_message("No task selected. Use /task_select to choose one.")
+            await self.outbox.send(update.effective_chat, "No task selected. Use /task_select to choose one.")
             return
         task = self.task_manager.get_current_task(focus.task)
         prompt = context.user_data.get(PROMPT_KEY, "")
 
         if prompt == "":
             self.logger.info(f'/run_to_score / {user.id} / {user.name}: no prompt set')
-            await update.effective_chat.send_message("Please enter your prompt first.")
+            await self.outbox.send(update.effective_chat, "Please enter your prompt first.")
             return
 
-        self.logger.info(f'/run_to_score / {user.id} / {user.name}')
-        message = await update.effective_chat.send_message('Computing...')
-        user_id = tg_user_id(update.effective_user.id)
-        result_batch = await self.runner.compute_hidden_batch(task, user_id, prompt)
-        self.logger.info(f'/run_to_score / {user.id} / {user.name} / {result_batch.score * 100:.2f}')
-        self.prompt_logger.info(f'/run_to_score / {user.id} / {user.name}\nprompt={prompt}\n\nresult_batch={result_batch.tg_html_form()}')
-        await message.edit_text(result_batch.tg_html_form_semihidden(), parse_mode='HTML')
+        job = await self._submit_job(update, task.id, 'hidden', prompt)
+        self.logger.info(f'/run_to_score / {user.id} / {user.name}: job {job.job_id}')
 
         if context.user_data.get(AUTOCLEAN_KEY, DEFAULT_AUTOCLEAN_STATE):
             context.user_data[PROMPT_KEY] = ""
@@ -120,43 +237,50 @@ class TGPrompter(Partial):
         focus = FocusManagement(context)
         if focus.task is None:
             self.logger.info(f'/run_open / {user.id} / {user.name}: no task selected')
-            await update.effective_chat.send_message("No task selected. Use /task_select to choose one.")
+            await self.outbox.send(update.effective_chat, "No task selected. Use /task_select to choose one.")
             return
         task = self.task_manager.get_current_task(focus.task)
         prompt = context.user_data.get(PROMPT_KEY, "")
 
         if prompt == "":
             self.logger.info(f'/run_open / {user.id} / {user.name}: no prompt set')
-            await update.effective_chat.send_message("Please enter your prompt first.")
+            await self.outbox.send(update.effective_chat, "Please enter your prompt first.")
             return
         context.user_data[STOP_KEY] = False
         debug = context.user_data.get(DEBUG_KEY, DEFAULT_DEBUG_STATE)
         self.logger.info(f'/run_open / {user.id} / {user.name} / {debug = }')
         if not debug:
-            message = await update.effective_chat.send_message('Computing...')
-            user_id = tg_user_id(update.effective_user.id)
-            result_batch = await self.runner.compute_open_batch(task, user_id, prompt)
-            await message.edit_text(result_batch.tg_html_form(), parse_mode='HTML')
+            job = await self._submit_job(update, task.id, 'open', prompt)
+            self.logger.info(f'/run_open / {user.id} / {user.name}: job {job.job_id}')
         else:
             matcher = task.get_matcher()
+            user_id = tg_user_id(update.effective_user.id)
             total = len(task.open_snippets)
-            await update.effective_chat.send_message(f"Computing on {total} snippets...")
-            for idd, snippet_id in enumerate(task.open_snippets):
-                # TODO: potentialy, we can run it in parallel
-                if context.user_data.get(STOP_KEY, False):
-                    context.user_data[STOP_KEY] = False
-                    break
-                evall = await self.runner.process_snippet(
-                    task=task,
-                    snippet_id=snippet_id,
-                    prompt=prompt,
-                    matcher=matcher,
-                )
-                prefix = f'{idd + 1}/{total}. '
-                self.prompt_logger.info(f'/run_open / {user.id} / {user.name} / {prefix + evall.tg_html_form()}')
-                await update.effective_chat.send_message(prefix + evall.tg_html_form(), parse_mode='HTML')
+            await self.outbox.send(update.effective_chat, f"Computing on {total} snippets...")
+            # Snippets run in parallel and each result is sent as soon as it's ready, tagged with its index.
+            # Streaming replies of all of them at once would hit the edit limits of the chat, so they aren't.
+            evaluations = self.runner.evaluate_as_completed(task, task.open_snippets, prompt, matcher, user_id)
+            try:
+                async with contextlib.aclosing(evaluations):
+                    async for idd, evall in evaluations:
+                        if context.user_data.get(STOP_KEY, False) or evall.status == EvaluationStatus.CANCELLED:
+                            context.user_data[STOP_KEY] = False
+                            break
+                        prefix = f'{idd + 1}/{total}. '
+                        self.prompt_logger.info(f'/run_open / {user.id} / {user.name} / {prefix + evall.tg_html_form()}')
+                        await self.output.send(
+                            update.effective_chat,
+                            prefix + evall.tg_html_form(),
+                            summary=prefix + evall.tg_html_shortform(),
+                            filename=f'{evall.task_id}_{evall.snippet_id}'
+                        )
+            except QueueOverflowError as e:
+                self.logger.warning(f'/run_open / {user.id} / {user.name}: {e}')
+                await self.outbox.send(update.effective_chat, QUEUE_OVERFLOW_MESSAGE)
+                return
             self.logger.info(f'/run_open / {user.id} / {user.name} / {matcher.score() * 100:.2f}')
-            await update.effective_chat.send_message(
+            await self.outbox.send(
+                update.effective_chat,
                 f'Total open avg score: {matcher.score() * 100:.2f}',
                 parse_mode='HTML'
             )
@@ -168,11 +292,11 @@ class TGPrompter(Partial):
         focus = FocusManagement(context)
         if focus.task is None:
             self.logger.info(f'/run_snippet / {user.id} / {user.name}: no prompt set')
-            await update.effective_chat.send_message("No task selected. Use /task_select to choose one.")
+            await self.outbox.send(update.effective_chat, "No task selected. Use /task_select to choose one.")
             return
         if focus.snippet is None:
             self.logger.info(f'/run_snippet / {user.id} / {user.name} / {focus.task}: no snippet set')
-            await update.effective_chat.send_message("No snippet selected. Use /snippet_focus to choose one.")
+            await self.outbox.send(update.effective_chat, "No snippet selected. Use /snippet_focus to choose one.")
             return
 
         task = self.task_manager.get_current_task(focus.task)
@@ -180,25 +304,44 @@ class TGPrompter(Partial):
 
         if prompt == "":
             self.logger.info(f'/run_snippet / {user.id} / {user.name} / {focus.task} - {focus.snippet}: no prompt set')
-            await update.effective_chat.send_message("Please enter your prompt first.")
+            await self.outbox.send(update.effective_chat, "Please enter your prompt first.")
             return
 
         snippet_dct = task.open_snippets.get(focus.snippet, None)
         if snippet_dct is None:
             self.logger.info(f'/run_snippet / {user.id} / {user.name} / {focus.task} - {focus.snippet}: no snippet found')
-            await update.effective_chat.send_message("Snippet name seems to be broken. Try another one.")
+            await self.outbox.send(update.effective_chat, "Snippet name seems to be broken. Try another one.")
             return
 
         self.logger.info(f'/run_snippet / {user.id} / {user.name} / {focus.task} - {focus.snippet}: run')
-        await update.effective_chat.send_message(f'Processing Task {focus.task} / Snippet: {focus.snippet}')
+        message = await self.outbox.send(
+            update.effective_chat,
+            f'Processing Task {focus.task} / Snippet: {focus.snippet}',
+            coalesce=False
+        )
+        # The reply is shown as it is generated and replaced with the evaluation at the end
+        stream = StreamingMessage(message, self.logger, self.outbox.send)
 
         matcher = task.get_matcher()
-        evall = await self.runner.process_snippet(
-            task=task,
-            snippet_id=focus.snippet,
-            prompt=prompt,
-            matcher=matcher,
-        )
+        try:
+            evall = await self.runner.process_snippet(
+                task=task,
+                snippet_id=focus.snippet,
+                prompt=prompt,
+                matcher=matcher,
+                user_id=tg_user_id(update.effective_user.id),
+                on_chunk=stream.update,
+            )
+        except QueueOverflowError as e:
+            self.logger.warning(f'/run_snippet / {user.id} / {user.name}: {e}')
+            await stream.finish(QUEUE_OVERFLOW_MESSAGE, parse_mode=None)
+            return
         self.logger.info(f'/run_snippet / {user.id} / {user.name} / {evall.score * 100:.2f}')
         self.prompt_logger.info(f'/run_snippet / {user.id} / {user.name} / {evall.tg_html_form()}')
-        await update.effective_chat.send_message(evall.tg_html_form(), parse_mode='HTML')
\ No newline at end of file
+        await self.output.send(
+            update.effective_chat,
+            evall.tg_html_form(),
+            summary=evall.tg_html_shortform(),
+            filename=f'{evall.task_id}_{evall.snippet_id}',
+            edit=stream.finish
+        )
\ No newline at end of file
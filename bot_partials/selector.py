@@ -6,9 +6,11 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from bot_partials.focus import FocusManagement
+from bot_partials.outbox import MessageScheduler
 from bot_partials.partial import Partial
 from bot_partials.state import MessageState
 from bot_partials.userdata_keys import STATE_KEY
+from core.rendering import TemplateRenderer
 from core.task_management import TaskManager
 from core.task import PromptTask
 from core.utils import html_escape
@@ -16,9 +18,11 @@ from core.utils import html_escape
 
 class TGSelector(Partial):
 
-    def __init__(self, logger: Logger, task_manager: TaskManager):
+    def __init__(self, logger: Logger, task_manager: TaskManager, outbox: MessageScheduler, renderer: TemplateRenderer):
         self.logger = logger
         self.task_manager = task_manager
+        self.outbox = outbox
+        self.renderer = renderer
 
     @property
     def message_states(self) -> List[MessageState]:
@@ -42,7 +46,7 @@ class TGSelector(Partial):
         first_id = task_conf_list[0]["id"]
         result_lst.append(f'Use command /task_select, to choose a particular task. E.g. "/task_select {first_id}"')
 
-        await update.message.reply_text('\n'.join(result_lst).strip(), parse_mode='HTML')
+        await self.outbox.send(update.effective_chat, '\n'.join(result_lst).strip(), parse_mode='HTML')
 
     async def _select_task(self, search_token: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -52,20 +56,21 @@ class TGSelector(Partial):
 
         if choice_num == 0:
             self.logger.info(f'/task_select / {user.id} / {user.name} / {search_token}: no tasks found.')
-            await update.effective_chat.send_message(f'No task found with id {search_token}.')
+            await self.outbox.send(update.effective_chat, f'No task found with id {search_token}.')
             context.user_data[STATE_KEY] = MessageState.TASK_SELECTION
         elif choice_num == 1:
             focus.update_task(choices[0])
             self.logger.info(f'/task_select / {user.id} / {user.name} / {search_token}: single task {choices[0]}.')
             context.user_data[STATE_KEY] = MessageState.IDLE
-            await update.effective_chat.send_message(f'Task `{choices[0]}` has been selected.')
+            await self.outbox.send(update.effective_chat, f'Task `{choices[0]}` has been selected.')
             current_task = self.task_manager.get_current_task(focus.task)
-            await update.effective_chat.send_message(current_task.short_description(), parse_mode='HTML')
+            await self.outbox.send(update.effective_chat, self.renderer.short_description(current_task), parse_mode='HTML')
         else:
             self.logger.info(f'/task_select / {user.id} / {user.name} / {search_token}: multiple tasks {len(choices)}.')
             multi_choice = "\n- ".join(choices)
             suffix = "\nNo task selected." if focus.task is None else f"\nCurrent task stays: {focus.task}"
-            await update.effective_chat.send_message(
+            await self.outbox.send(
+                update.effective_chat,
                 ' '.join([
                     f'Multiple tasks found:\n- {multi_choice}.',
                     suffix
@@ -77,7 +82,7 @@ class TGSelector(Partial):
         search_token = update.message.text.strip()
         search_token = ' '.join(search_token.split(' ')[1:])
         if search_token == "":
-            await update.message.reply_text('Select the task by typing id')
+            await self.outbox.send(update.effective_chat, 'Select the task by typing id')
             context.user_data[STATE_KEY] = MessageState.TASK_SELECTION
         else:
             await self._select_task(search_token, update, context)
@@ -85,7 +90,7 @@ class TGSelector(Partial):
     async def _get_task_or_complain(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *, if_not: str) -> Optional[PromptTask]:
         focus = FocusManagement(context)
         if focus.task is None:
-            await update.effective_chat.send_message(if_not)
+            await self.outbox.send(update.effective_chat, if_not)
             await self.task_list(update, context)
             return None
         return self.task_manager.get_current_task(focus.task)
@@ -105,7 +110,7 @@ class TGSelector(Partial):
         title = f'<b>{html_escape(current_task.title_with_id)}</b>'
         snippet_lines = [f'- <b>{name}</b>: {html_escape(obj["Task"])}' for name, obj in snippets.items()]
         all_lins = [title, ''] + snippet_lines
-        await update.effective_chat.send_message('\n'.join(all_lins), parse_mode='HTML')
+        await self.outbox.send(update.effective_chat, '\n'.join(all_lins), parse_mode='HTML')
 
     async def _select_snippet(self, search_token: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -124,7 +129,7 @@ class TGSelector(Partial):
 
         if choice_num == 0:
             self.logger.info(f'/snippet_focus / {user.id} / {user.name} / {focus.task} - {search_token}: no snippet found')
-            await update.effective_chat.send_message(f'No snippet found with id {search_token}.')
+            await self.outbox.send(update.effective_chat, f'No snippet found with id {search_token}.')
             context.user_data[STATE_KEY] = MessageState.SNIPPET_SELECTION
         elif choice_num == 1:
             focus.update_snippet(choices[0])
@@ -132,14 +137,15 @@ class TGSelector(Partial):
                 f'/snippet_focus / {user.id} / {user.name} / {focus.task} - {search_token}: snippet selected {choices[0]}'
             )
             context.user_data[STATE_KEY] = MessageState.IDLE
-            await update.effective_chat.send_message(f'Task `{choices[0]}` has been selected.')
+            await self.outbox.send(update.effective_chat, f'Task `{choices[0]}` has been selected.')
         else:
             self.logger.info(
                 f'/snippet_focus/ {user.id} / {user.name} / {focus.task} - {search_token}: multiple snippets {len(choices)}'
             )
             multi_choice = "\n- ".join(choices)
             suffix = "No snippet selected." if focus.snippet is None else f"Current snippet is {focus.snippet}"
-            await update.effective_chat.send_message(
+            await self.outbox.send(
+                update.effective_chat,
                 ' '.join([
                     f'Multiple snippets found:\n- {multi_choice}.',
                     suffix
@@ -151,7 +157,7 @@ class TGSelector(Partial):
         search_token = update.message.text.strip()
         search_token = ' '.join(search_token.split(' ')[1:])
         if search_token == "":
-            await update.message.reply_text('Select the snippet by typing snippet id.')
+            await self.outbox.send(update.effective_chat, 'Select the snippet by typing snippet id.')
             context.user_data[STATE_KEY] = MessageState.SNIPPET_SELECTION
         else:
             await self._select_snippet(search_token, update, context)
@@ -163,12 +169,12 @@ class TGSelector(Partial):
             f'/snippet_unfocus / {user.id} / {user.name} / {focus.task} - {focus.snippet}'
         )
         if focus.snippet is None:
-            await update.effective_chat.send_message(f'No snippet to unselect.')
+            await self.outbox.send(update.effective_chat, f'No snippet to unselect.')
             return
 
         old_snippet = focus.snippet
         focus.update_snippet(None)
-        await update.effective_chat.send_message(f'Snippet `{old_snippet}` has been unselected.')
+        await self.outbox.send(update.effective_chat, f'Snippet `{old_snippet}` has been unselected.')
 
     async def show_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.effective_user
@@ -187,7 +193,7 @@ class TGSelector(Partial):
         self.logger.info(
             f'/task_show / {user.id} / {user.name} / {focus.task} - {focus.snippet}'
         )
-        await update.effective_chat.send_message(current_task.short_description(snippet=focus.snippet), parse_mode='HTML')
+        await self.outbox.send(update.effective_chat, self.renderer.short_description(current_task, snippet=focus.snippet), parse_mode='HTML')
 
     async def message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
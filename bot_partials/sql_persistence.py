@@ -0,0 +1,203 @@
+import asyncio
+import json
+import pickle
+import sqlite3
+from logging import Logger
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+USER_DATA = 'user_data'
+CHAT_DATA = 'chat_data'
+BOT_DATA = 'bot_data'
+CALLBACK_DATA = 'callback_data'
+CONVERSATION_PREFIX = 'conversation:'
+
+# The pickle file keeps a copy of the data after the migration, under this suffix
+MIGRATED_SUFFIX = '.migrated'
+
+
+class _PersistenceUnpickler(pickle.Unpickler):
+    # PicklePersistence saves references to the bot as persistent ids, the bot isn't there yet
+    def persistent_load(self, pid: Any) -> None:
+        return None
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Keeps user_data, chat_data, bot_data and conversations in SQLite, one row per user / chat,
+    so that a flush writes only the rows that changed instead of the whole data of every user.
+
+    The rows written while the application updates the persistence go in one transaction.
+    """
+
+    def __init__(self,
+                 db_name: str = 'persistence/bot_data.db',
+                 logger: Optional[Logger] = None,
+                 store_data: Optional[PersistenceInput] = None,
+                 update_interval: float = 60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.logger = logger
+        self.conn = sqlite3.connect(db_name)
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+        # Pickled rows as they are on disk: unchanged data isn't written again
+        self.rows: Dict[str, Dict[str, bytes]] = dict()
+        self.cursor.execute('SELECT kind, key, data FROM persistence_data')
+        for kind, key, data in self.cursor.fetchall():
+            self.rows.setdefault(kind, dict())[key] = data
+
+        self.commit_handle: Optional[asyncio.Handle] = None
+        self.rows_written = 0
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS persistence_data (
+                kind TEXT,
+                key TEXT,
+                data BLOB,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        self._commit()
+        self.conn.close()
+
+    # Storage
+
+    @staticmethod
+    def _id_key(idd: int) -> str:
+        return str(idd)
+
+    def _load(self, kind: str) -> Dict[str, Any]:
+        return {key: pickle.loads(data) for key, data in self.rows.get(kind, dict()).items()}
+
+    def _store(self, kind: str, key: str, data: bytes):
+        self.rows.setdefault(kind, dict())[key] = data
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO persistence_data (kind, key, data) VALUES (?, ?, ?)',
+            (kind, key, data)
+        )
+        self.rows_written += 1
+
+    def _write(self, kind: str, key: str, value: Any):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.rows.get(kind, dict()).get(key) == data:
+            return
+        self._store(kind, key, data)
+        self._schedule_commit()
+
+    def _delete(self, kind: str, key: str):
+        if self.rows.get(kind, dict()).pop(key, None) is None:
+            return
+        self.cursor.execute('DELETE FROM persistence_data WHERE kind = ? AND key = ?', (kind, key))
+        self._schedule_commit()
+
+    def _schedule_commit(self):
+        # The application updates all the dirty rows at once (asyncio.gather of update_* calls),
+        # the commit runs right after them
+        if self.commit_handle is None:
+            self.commit_handle = asyncio.get_running_loop().call_soon(self._commit)
+
+    def _commit(self):
+        self.commit_handle = None
+        self.conn.commit()
+
+    # BasePersistence
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {int(key): value for key, value in self._load(USER_DATA).items()}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {int(key): value for key, value in self._load(CHAT_DATA).items()}
+
+    async def get_bot_data(self) -> Any:
+        return self._load(BOT_DATA).get('', dict())
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return self._load(CALLBACK_DATA).get('')
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        return {
+            tuple(json.loads(key)): state
+            for key, state in self._load(CONVERSATION_PREFIX + name).items()
+        }
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        self._write(USER_DATA, self._id_key(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        self._write(CHAT_DATA, self._id_key(chat_id), data)
+
+    async def update_bot_data(self, data: Any) -> None:
+        self._write(BOT_DATA, '', data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._write(CALLBACK_DATA, '', data)
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        if new_state is None:
+            self._delete(CONVERSATION_PREFIX + name, json.dumps(list(key)))
+        else:
+            self._write(CONVERSATION_PREFIX + name, json.dumps(list(key)), new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._delete(USER_DATA, self._id_key(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._delete(CHAT_DATA, self._id_key(chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+        self._commit()
+
+    # Migration
+
+    def is_empty(self) -> bool:
+        return not any(self.rows.values())
+
+    def migrate_from_pickle(self, filepath: str) -> bool:
+        """
+        One-time import of a single file PicklePersistence. The pickle is renamed afterwards
+        and kept as a backup. Does nothing if there's no such file or the database isn't empty.
+        """
+        path = Path(filepath)
+        if not path.exists() or not self.is_empty():
+            return False
+        with open(path, 'rb') as f:
+            data = _PersistenceUnpickler(f).load()
+
+        # There's no running loop yet, everything goes in one transaction committed below
+        def write_now(kind: str, key: str, value: Any):
+            self._store(kind, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+        for kind in [USER_DATA, CHAT_DATA]:
+            for idd, value in (data.get(kind) or dict()).items():
+                write_now(kind, self._id_key(idd), value)
+        if data.get(BOT_DATA):
+            write_now(BOT_DATA, '', data[BOT_DATA])
+        if data.get(CALLBACK_DATA) is not None:
+            write_now(CALLBACK_DATA, '', data[CALLBACK_DATA])
+        for name, conversation in (data.get('conversations') or dict()).items():
+            for key, state in conversation.items():
+                write_now(CONVERSATION_PREFIX + name, json.dumps(list(key)), state)
+        self.conn.commit()
+
+        path.rename(path.with_name(path.name + MIGRATED_SUFFIX))
+        if self.logger is not None:
+            self.logger.info(f'persistence: migrated {self.rows_written} rows from {path}')
+        return True
@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+import time
+from logging import Logger
+from typing import Awaitable, Callable, Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+# Telegram starts answering with RetryAfter on frequent edits of one message,
+# about one edit per second per chat keeps it quiet.
+EDIT_INTERVAL_S = 1.0
+MAX_MESSAGE_LENGTH = 4096
+TRUNCATION_MARK = '...\n'
+
+SendCallable = Callable[..., Awaitable[Message]]
+
+
+def retry_after_s(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class StreamingMessage:
+    """
+    Shows the text of a streamed LLM reply by editing one message.
+
+    update() only remembers the latest text and is cheap to call on every token,
+    edits are sent in background no more often than once per interval_s.
+    finish() replaces the preview with the final (HTML) text, or sends it with `send`
+    (e.g. MessageScheduler.send, to stay within the chat limits) if the message can't be edited.
+    """
+
+    def __init__(self,
+                 message: Message,
+                 logger: Logger,
+                 send: SendCallable,
+                 prefix: str = '',
+                 interval_s: float = EDIT_INTERVAL_S):
+        self.message = message
+        self.logger = logger
+        self.send = send
+        self.prefix = prefix
+        self.interval_s = interval_s
+
+        self.text = ''
+        self.shown_text = message.text
+        self.next_edit_s = 0.0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def update(self, text: str):
+        self.text = text
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush())
+
+    def _preview(self) -> str:
+        # The preview is plain text: the reply may cut an HTML entity in half
+        text = self.prefix + self.text
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            return text
+        return TRUNCATION_MARK + text[len(text) - MAX_MESSAGE_LENGTH + len(TRUNCATION_MARK):]
+
+    async def _flush(self):
+        delay_s = self.next_edit_s - time.monotonic()
+        if delay_s > 0:
+            await asyncio.sleep(delay_s)
+        text = self._preview()
+        if text == self.shown_text or not text.strip():
+            return
+        self.next_edit_s = time.monotonic() + self.interval_s
+        try:
+            await self.message.edit_text(text)
+            self.shown_text = text
+        except RetryAfter as e:
+            self.next_edit_s = time.monotonic() + retry_after_s(e)
+        except TelegramError as e:
+            self.logger.warning(f'streaming edit failed: {e}')
+
+    async def finish(self, text: str, parse_mode: Optional[str] = 'HTML'):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        while True:
+            try:
+                await self.message.edit_text(text, parse_mode=parse_mode)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_s(e))
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    return
+                # The message may have been deleted meanwhile, the result is sent anew then
+                self.logger.warning(f'final streaming edit failed: {e}')
+                await self.send(self.message.chat, text, parse_mode=parse_mode, coalesce=False)
+                return
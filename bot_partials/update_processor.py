@@ -0,0 +1,84 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Iterable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+DEFAULT_MAX_CONCURRENT_UPDATES = 64
+# Updates waiting for the previous ones of the same user don't take a processing slot,
+# but they are accepted only up to this many in total.
+DEFAULT_MAX_PENDING_UPDATES = 1024
+
+
+class _UserLock:
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, at most `max_concurrent_updates` at once,
+    while the updates of one user are processed strictly one after another, so that
+    the state kept in user_data changes in order.
+
+    `unordered_commands` (e.g. /stop) skip both the user's queue and the cap.
+    """
+
+    def __init__(self,
+                 max_concurrent_updates: int = DEFAULT_MAX_CONCURRENT_UPDATES,
+                 max_pending_updates: int = DEFAULT_MAX_PENDING_UPDATES,
+                 unordered_commands: Iterable[str] = ()):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency_cap = max_concurrent_updates
+        self.unordered_commands = {command.lstrip('/') for command in unordered_commands}
+        self.user_locks: Dict[Hashable, _UserLock] = dict()
+        self.slots: Optional[asyncio.Semaphore] = None
+
+    async def initialize(self) -> None:
+        self.slots = asyncio.Semaphore(self.concurrency_cap)
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[Hashable]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    def _is_unordered(self, update: object) -> bool:
+        if not isinstance(update, Update) or update.effective_message is None:
+            return False
+        text = update.effective_message.text or ''
+        if not text.startswith('/'):
+            return False
+        # /command@bot_name arguments
+        parts = text[1:].split(maxsplit=1)
+        return bool(parts) and parts[0].split('@', 1)[0] in self.unordered_commands
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._is_unordered(update):
+            await coroutine
+            return
+        key = self._user_key(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+
+        user_lock = self.user_locks.setdefault(key, _UserLock())
+        user_lock.waiters += 1
+        try:
+            async with user_lock.lock:
+                async with self.slots:
+                    await coroutine
+        finally:
+            user_lock.waiters -= 1
+            if user_lock.waiters == 0:
+                self.user_locks.pop(key, None)
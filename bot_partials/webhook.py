@@ -0,0 +1,211 @@
+import asyncio
+import hmac
+import json
+import signal
+from logging import Logger
+from typing import Dict, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+HEALTH_PATH = '/healthz'
+READINESS_PATH = '/readyz'
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+# Telegram and proxies keep connections alive, idle ones are closed after a while
+KEEP_ALIVE_TIMEOUT_S = 75.0
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+
+class BadHTTPRequest(Exception):
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class WebhookServer:
+    """
+    A minimal HTTP/1.1 server on asyncio streams, enough for the Telegram webhook behind a reverse proxy.
+
+    POST `path` puts the update to the application's update queue, the same handlers process it as in polling.
+    GET /healthz answers while the process is alive, GET /readyz only while updates are accepted.
+    """
+
+    def __init__(self,
+                 application: Application,
+                 logger: Logger,
+                 host: str,
+                 port: int,
+                 path: str,
+                 secret_token: Optional[str] = None):
+        self.application = application
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.path = '/' + path.strip('/')
+        self.secret_token = secret_token
+
+        self.ready = False
+        self.server: Optional[asyncio.Server] = None
+        self.connections: Set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+        self.logger.info(f'webhook server is listening on {self.host}:{self.port}{self.path}')
+
+    async def stop(self):
+        self.ready = False
+        if self.server is not None:
+            self.server.close()
+            # Idle keep-alive connections would hold wait_closed() otherwise
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT_S)
+                except (TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except BadHTTPRequest as e:
+                    await self._respond(writer, e.status, str(e), keep_alive=False)
+                    return
+                if request is None:
+                    return
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, text = await self._handle(method, path, headers, body)
+                await self._respond(writer, status, text, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read_line(reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except ValueError:
+            # A line over the stream's limit (64 KiB): readline raises instead of returning it
+            raise BadHTTPRequest('Line too long')
+
+    @classmethod
+    async def _read_request(cls, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await cls._read_line(reader)
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise BadHTTPRequest('Malformed request line')
+        method, target, _ = parts
+
+        headers = dict()
+        while True:
+            line = await cls._read_line(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise BadHTTPRequest('Too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadHTTPRequest('Malformed Content-Length')
+        if length < 0:
+            raise BadHTTPRequest('Malformed Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise BadHTTPRequest('Payload too large', status=413)
+        body = await reader.readexactly(length) if length > 0 else b''
+        return method.upper(), target.split('?', 1)[0], headers, body
+
+    async def _handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str]:
+        if path == HEALTH_PATH:
+            return 200, 'ok'
+        if path == READINESS_PATH:
+            return (200, 'ready') if self.ready else (503, 'not ready')
+        if path != self.path:
+            return 404, 'not found'
+        if method != 'POST':
+            return 405, 'method not allowed'
+        if self.secret_token is not None:
+            received = headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received.encode('utf-8'), self.secret_token.encode('utf-8')):
+                return 403, 'forbidden'
+        if not self.ready:
+            # Telegram redelivers updates that weren't accepted
+            return 503, 'not ready'
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.logger.warning(f'webhook got a malformed update: {e}')
+            return 400, 'malformed update'
+        await self.application.update_queue.put(update)
+        return 200, 'ok'
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, text: str, keep_alive: bool):
+        body = text.encode('utf-8')
+        head = '\r\n'.join([
+            f'HTTP/1.1 {status} {REASONS.get(status, "")}',
+            'Content-Type: text/plain; charset=utf-8',
+            f'Content-Length: {len(body)}',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+            '',
+            '',
+        ])
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def run_webhook(application: Application,
+                      server: WebhookServer,
+                      webhook_url: Optional[str] = None):
+    # The counterpart of application.run_polling: runs until SIGINT / SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await server.start()
+    try:
+        async with application:
+            if application.post_init is not None:
+                await application.post_init(application)
+            await application.start()
+            if webhook_url is not None:
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=server.secret_token,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            server.ready = True
+            await stop_event.wait()
+            server.ready = False
+            await application.stop()
+            if application.post_stop is not None:
+                await application.post_stop(application)
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+    finally:
+        await server.stop()
@@ -1,16 +1,150 @@
-from typing import List, Optional
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, List, Optional
 
-from openai import AsyncOpenAI, NOT_GIVEN, NotGiven
+from openai import (
+    AsyncOpenAI, NOT_GIVEN, NotGiven, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+)
 
 # Get the value of an environment variable
 DEFAULT_MODEL = 'deepseek-chat'
 
+DEFAULT_MAX_RETRIES = 3
+RETRY_BASE_DELAY_S = 1.0
+RETRY_MAX_DELAY_S = 30.0
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT_S = 30.0
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def is_overload_error(error: BaseException) -> bool:
+    # The provider is throttling us or can't keep up: 429, 5xx or a timeout
+    if isinstance(error, (RateLimitError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+def is_retryable_error(error: BaseException) -> bool:
+    # Other 4xx (bad request, auth, unknown model) won't get better with another attempt
+    return is_overload_error(error) or isinstance(error, APIConnectionError)
+
+def retry_delay_s(error: BaseException, attempt: int) -> float:
+    # Capped exponential backoff with full jitter, but not sooner than the provider's Retry-After
+    delay_s = random.uniform(0.0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
+    if isinstance(error, APIStatusError):
+        try:
+            retry_after_s = float(error.response.headers.get('retry-after', 0.0))
+        except ValueError:
+            retry_after_s = 0.0
+        delay_s = max(delay_s, min(retry_after_s, RETRY_MAX_DELAY_S))
+    return delay_s
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive transient failures of an endpoint and fails calls fast
+    for `reset_timeout_s`. Then a single probe call is let through: success closes the breaker,
+    failure opens it again.
+    """
+
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout_s: float = BREAKER_RESET_TIMEOUT_S):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+
+        self.failures = 0
+        self.opened_at_s: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at_s is None:
+            return 'closed'
+        if self.is_open():
+            return 'open'
+        return 'half_open'
+
+    def is_open(self) -> bool:
+        if self.opened_at_s is None:
+            return False
+        return self.probing or time.monotonic() - self.opened_at_s < self.reset_timeout_s
+
+    def before_call(self):
+        if self.opened_at_s is None:
+            return
+        if self.is_open():
+            raise CircuitOpenError(f'{self.name} is failing, calls are paused for a while')
+        self.probing = True
+
+    def on_success(self):
+        self.failures = 0
+        self.opened_at_s = None
+        self.probing = False
+
+    def on_failure(self):
+        self.failures += 1
+        if self.opened_at_s is not None or self.failures >= self.failure_threshold:
+            self.opened_at_s = time.monotonic()
+        self.probing = False
+
+    def on_cancel(self):
+        self.probing = False
+
+
+async def call_with_retries(routine_factory: Callable[[], Awaitable[Any]],
+                            *,
+                            breaker: Optional[CircuitBreaker] = None,
+                            max_retries: int = DEFAULT_MAX_RETRIES,
+                            deadline_s: Optional[float] = None) -> Any:
+    # routine_factory is expected to call breaker.before_call() right before the request goes out.
+    # No retry is attempted past deadline_s (time.monotonic()), TimeoutError is raised instead.
+    attempt = 0
+    while True:
+        if breaker is not None and breaker.is_open():
+            raise CircuitOpenError(f'{breaker.name} is failing, calls are paused for a while')
+        try:
+            result = await routine_factory()
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.on_cancel()
+            raise
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            retryable = is_retryable_error(e)
+            if breaker is not None:
+                if retryable:
+                    breaker.on_failure()
+                else:
+                    # The endpoint has answered, the request itself is bad
+                    breaker.on_cancel()
+            if not retryable or attempt >= max_retries:
+                raise
+            delay_s = retry_delay_s(e, attempt)
+            if deadline_s is not None and time.monotonic() + delay_s >= deadline_s:
+                raise TimeoutError('The deadline has passed') from e
+            await asyncio.sleep(delay_s)
+            attempt += 1
+            continue
+        if breaker is not None:
+            breaker.on_success()
+        return result
+
 async def get_ai_response(*,
         client: AsyncOpenAI,
         system_prompt: str,
         prompt: str,
         model_name: str = DEFAULT_MODEL,
-        temperature: Optional[float] | NotGiven =NOT_GIVEN):
+        temperature: Optional[float] | NotGiven =NOT_GIVEN,
+        usage_collector: Optional[List] = None,
+        timeout: Optional[float] | NotGiven = NOT_GIVEN):
     history_list = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": prompt},
@@ -19,8 +153,11 @@ async def get_ai_response(*,
         model=model_name,
         messages=history_list,
         temperature=temperature,
-        stream=False
+        stream=False,
+        timeout=timeout
     )
+    if usage_collector is not None:
+        usage_collector.append(response.usage)
     return response.choices[0].message.content
 
 async def stream_ai_response(*,
@@ -29,7 +166,9 @@ async def stream_ai_response(*,
         prompt: str,
         model_name: str = DEFAULT_MODEL,
         temperature: Optional[float] | NotGiven = NOT_GIVEN,
-        collector: Optional[List[str]] = None):
+        collector: Optional[List[str]] = None,
+        usage_collector: Optional[List] = None,
+        timeout: Optional[float] | NotGiven = NOT_GIVEN):
     history_list = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": prompt},
@@ -38,11 +177,21 @@ async def stream_ai_response(*,
         model=model_name,
         messages=history_list,
         temperature=temperature,
-        stream=True
+        stream=True,
+        # Without it the stream carries no usage, and the TPM budget can't be corrected
+        stream_options={'include_usage': True} if usage_collector is not None else NOT_GIVEN,
+        timeout=timeout
     )
     async for chunk in response:
+        # Providers may report usage in the last chunk, it comes without choices
+        usage = getattr(chunk, 'usage', None)
+        if usage is not None and usage_collector is not None:
+            usage_collector.append(usage)
+        if not chunk.choices:
+            continue
         content = chunk.choices[0].delta.content
+        if content is None:
+            continue
         if collector is not None:
             collector.append(content)
         yield content
-
@@ -0,0 +1,117 @@
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Mapping, Tuple
+
+from core.utils import PathLike, from_json_file
+
+# A task compiled into one file: the header points to the index (JSON) at the end of the file,
+# the index holds task info and the (offset, length) of every text in the file.
+BUNDLE_NAME = 'task.bundle'
+BUNDLE_MAGIC = b'PTBNDL01'
+BUNDLE_HEADER = struct.Struct('<8sQQ')
+
+SNIPPET_TYPES = ['open_snippets', 'hidden_snippets']
+
+
+def compile_task_bundle(task_dir: PathLike, bundle_pth: PathLike = None) -> Path:
+    """Packs the task directory (info.json, sample prompt, snippets) into a single bundle file."""
+    task_dir = Path(task_dir)
+    bundle_pth = Path(bundle_pth) if bundle_pth is not None else task_dir / BUNDLE_NAME
+    task_info = from_json_file(task_dir / 'info.json')
+
+    body = bytearray()
+
+    def put(data: bytes) -> Tuple[int, int]:
+        offset = BUNDLE_HEADER.size + len(body)
+        body.extend(data)
+        return offset, len(data)
+
+    sample_prompt = (task_dir / task_info['sample_prompt_pth']).read_bytes()
+    index = {
+        'info': task_info,
+        'sample_prompt': put(sample_prompt),
+    }
+    for snippet_type in SNIPPET_TYPES:
+        snippets = dict()
+        for snippet in task_info[snippet_type]:
+            snippet = Path(snippet)
+            snippets[snippet.name] = [
+                *put((task_dir / snippet / 'task.txt').read_bytes()),
+                *put((task_dir / snippet / 'answer.json').read_bytes()),
+            ]
+        index[snippet_type] = snippets
+
+    index_data = json.dumps(index, ensure_ascii=False).encode('utf-8')
+    index_offset = BUNDLE_HEADER.size + len(body)
+    # Written aside and renamed, so that a running bot never maps a half-written bundle
+    tmp_pth = bundle_pth.with_name(bundle_pth.name + '.tmp')
+    with open(tmp_pth, 'wb') as f:
+        f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, index_offset, len(index_data)))
+        f.write(body)
+        f.write(index_data)
+    tmp_pth.replace(bundle_pth)
+    return bundle_pth
+
+
+class TaskBundle:
+    # A compiled task, memory-mapped. Texts are decoded only when asked for.
+
+    def __init__(self, bundle_pth: PathLike):
+        self.bundle_pth = Path(bundle_pth)
+        with open(self.bundle_pth, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = BUNDLE_HEADER.unpack_from(self.data, 0)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f'{self.bundle_pth} is not a task bundle')
+        self.index = json.loads(self.data[index_offset:index_offset + index_length].decode('utf-8'))
+
+    @property
+    def task_info(self) -> Dict:
+        return self.index['info']
+
+    def _text(self, offset: int, length: int) -> str:
+        return self.data[offset:offset + length].decode('utf-8')
+
+    def sample_prompt(self) -> str:
+        return self._text(*self.index['sample_prompt'])
+
+    def snippet_names(self, snippet_type: str) -> List[str]:
+        return list(self.index[snippet_type])
+
+    def snippet(self, snippet_type: str, name: str) -> Dict[str, Any]:
+        task_offset, task_length, answer_offset, answer_length = self.index[snippet_type][name]
+        return {
+            'Task': self._text(task_offset, task_length),
+            'Answer': json.loads(self._text(answer_offset, answer_length))
+        }
+
+    def snippets(self, snippet_type: str) -> 'BundleSnippets':
+        return BundleSnippets(self, snippet_type)
+
+
+class BundleSnippets(Mapping):
+    # Snippets of a bundle by name, each decoded on first access
+
+    def __init__(self, bundle: TaskBundle, snippet_type: str):
+        self.bundle = bundle
+        self.snippet_type = snippet_type
+        self.names = bundle.snippet_names(snippet_type)
+        self.decoded: Dict[str, Dict] = dict()
+
+    def __getitem__(self, name: str) -> Dict[str, Any]:
+        if name not in self.decoded:
+            if name not in self.bundle.index[self.snippet_type]:
+                raise KeyError(name)
+            self.decoded[name] = self.bundle.snippet(self.snippet_type, name)
+        return self.decoded[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.bundle.index[self.snippet_type]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
@@ -0,0 +1,332 @@
+import asyncio
+import dataclasses
+import functools
+import sqlite3
+import time
+from logging import Logger
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from core.llm_manager import LLMResponse
+from core.prompter import PromptRunner, SnippetBatchEvaluation, SnippetEvaluation
+from core.ratelimit import BatchProgress, QueueOverflowError
+from core.task import PromptTask
+from core.task_management import TaskManager
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_CANCELLED = 'cancelled'
+JOB_FAILED = 'failed'
+
+DEFAULT_SHUTDOWN_GRACE_S = 30.0
+# A job the provider's queue can't take yet is tried again after this delay, a few times
+OVERFLOW_RETRY_DELAY_S = 10.0
+OVERFLOW_MAX_RETRIES = 30
+
+
+@dataclasses.dataclass
+class EvaluationJob:
+    job_id: int
+    user_id: str
+    chat_id: int
+    chat_type: str
+    message_id: Optional[int]
+    task_id: str
+    tag: str
+    prompt: str
+    status: str = JOB_PENDING
+    created_at: float = 0.0
+    # Not stored: the retries of this process and the reason of a failure shown to the user
+    overflow_retries: int = 0
+    error: Optional[str] = None
+
+
+class EvaluationJobStore:
+    # Batch evaluations and the snippets already answered, so that a restart doesn't lose them
+
+    def __init__(self, db_name: str = 'persistence/jobs.db'):
+        self.conn = sqlite3.connect(db_name)
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS evaluation_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                chat_id INTEGER,
+                chat_type TEXT,
+                message_id INTEGER,
+                task_id TEXT,
+                tag TEXT,
+                prompt TEXT,
+                status TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS evaluation_job_snippets (
+                job_id INTEGER,
+                snippet_id TEXT,
+                result_msg TEXT,
+                cached INTEGER,
+                fallback_llm TEXT,
+                PRIMARY KEY (job_id, snippet_id)
+            )
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def create_job(self,
+                   user_id: str,
+                   chat_id: int,
+                   chat_type: str,
+                   message_id: Optional[int],
+                   task_id: str,
+                   tag: str,
+                   prompt: str) -> EvaluationJob:
+        now = time.time()
+        self.cursor.execute('''
+            INSERT INTO evaluation_jobs
+                (user_id, chat_id, chat_type, message_id, task_id, tag, prompt, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, chat_type, message_id, task_id, tag, prompt, JOB_PENDING, now, now))
+        self.conn.commit()
+        return EvaluationJob(
+            job_id=self.cursor.lastrowid,
+            user_id=user_id,
+            chat_id=chat_id,
+            chat_type=chat_type,
+            message_id=message_id,
+            task_id=task_id,
+            tag=tag,
+            prompt=prompt,
+            created_at=now
+        )
+
+    def set_status(self, job_id: int, status: str):
+        self.cursor.execute(
+            'UPDATE evaluation_jobs SET status = ?, updated_at = ? WHERE job_id = ?',
+            (status, time.time(), job_id)
+        )
+        self.conn.commit()
+
+    def finish_job(self, job_id: int, status: str):
+        # The answers are needed only until the result is computed
+        self.cursor.execute('DELETE FROM evaluation_job_snippets WHERE job_id = ?', (job_id,))
+        self.set_status(job_id, status)
+
+    def unfinished_jobs(self) -> List[EvaluationJob]:
+        self.cursor.execute('''
+            SELECT job_id, user_id, chat_id, chat_type, message_id, task_id, tag, prompt, status, created_at
+            FROM evaluation_jobs
+            WHERE status IN (?, ?)
+            ORDER BY job_id
+        ''', (JOB_PENDING, JOB_RUNNING))
+        return [EvaluationJob(*row) for row in self.cursor.fetchall()]
+
+    def record_snippet(self, job_id: int, evall: SnippetEvaluation):
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO evaluation_job_snippets (job_id, snippet_id, result_msg, cached, fallback_llm)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (job_id, evall.snippet_id, evall.result_msg, int(evall.cached), evall.fallback_llm))
+        self.conn.commit()
+
+    def answered_snippets(self, job_id: int) -> Dict[str, LLMResponse]:
+        self.cursor.execute(
+            'SELECT snippet_id, result_msg, cached, fallback_llm FROM evaluation_job_snippets WHERE job_id = ?',
+            (job_id,)
+        )
+        return {
+            snippet_id: LLMResponse(result_msg, cached=bool(cached), llm_name=fallback_llm)
+            for snippet_id, result_msg, cached, fallback_llm in self.cursor.fetchall()
+        }
+
+
+DeliverCallable = Callable[[EvaluationJob, Optional[SnippetBatchEvaluation]], Awaitable[None]]
+ProgressCallable = Callable[[EvaluationJob, BatchProgress], Awaitable[None]]
+
+
+class EvaluationWorkerPool:
+    """
+    Runs each batch evaluation recorded in the job store as its own task.
+
+    The store is for durability only: the snippets of all jobs go to the rate limiter right away,
+    which schedules them fairly between users and reports the queue position to `notify_progress`.
+    Jobs left unfinished by the previous process are picked up on start, skipping the snippets
+    already answered. The result (or None if the job failed or was cancelled before it started)
+    is passed to `deliver`, `job.status` tells which.
+    """
+
+    def __init__(self,
+                 store: EvaluationJobStore,
+                 runner: PromptRunner,
+                 task_manager: TaskManager,
+                 logger: Logger):
+        self.store = store
+        self.runner = runner
+        self.task_manager = task_manager
+        self.logger = logger
+
+        self.tasks: Dict[int, asyncio.Task] = dict()
+        self.pending: Dict[int, EvaluationJob] = dict()
+        self.cancelled: set = set()
+        self.retries: Dict[int, asyncio.TimerHandle] = dict()
+        self.deliver: Optional[DeliverCallable] = None
+        self.notify_progress: Optional[ProgressCallable] = None
+
+    async def start(self, deliver: DeliverCallable, notify_progress: Optional[ProgressCallable] = None):
+        self.deliver = deliver
+        self.notify_progress = notify_progress
+        resumed = self.store.unfinished_jobs()
+        for job in resumed:
+            job.status = JOB_PENDING
+            self._enqueue(job)
+        if resumed:
+            self.logger.info(f'jobs: {len(resumed)} unfinished jobs resumed')
+
+    async def stop(self, grace_s: float = DEFAULT_SHUTDOWN_GRACE_S):
+        # Jobs not done within the grace period stay in the store and are resumed on the next start
+        if self.tasks:
+            await asyncio.wait(list(self.tasks.values()), timeout=grace_s)
+        if self.pending:
+            self.logger.warning(f'jobs: {len(self.pending)} jobs left for the next start')
+        # Jobs waiting for a retry are pending in the store as well
+        for handle in self.retries.values():
+            handle.cancel()
+        self.retries.clear()
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    def submit(self,
+               user_id: str,
+               chat_id: int,
+               chat_type: str,
+               message_id: Optional[int],
+               task_id: str,
+               tag: str,
+               prompt: str) -> EvaluationJob:
+        job = self.store.create_job(user_id, chat_id, chat_type, message_id, task_id, tag, prompt)
+        self._enqueue(job)
+        return job
+
+    def _enqueue(self, job: EvaluationJob):
+        self.pending[job.job_id] = job
+        self._start(job)
+
+    def _start(self, job: EvaluationJob):
+        task = asyncio.create_task(self._run_logged(job))
+        self.tasks[job.job_id] = task
+        task.add_done_callback(functools.partial(self._forget_task, job.job_id))
+
+    def _forget_task(self, job_id: int, task: asyncio.Task):
+        # A job retried after an overflow has a new task by then
+        if self.tasks.get(job_id, None) is task:
+            self.tasks.pop(job_id)
+
+    def cancel_user(self, user_id: str) -> int:
+        # Jobs already running are stopped by cancelling their requests, see PromptRunner.cancel_user
+        jobs = [
+            job for job in self.pending.values()
+            if job.user_id == user_id and job.status == JOB_PENDING and job.job_id not in self.cancelled
+        ]
+        self.cancelled.update(job.job_id for job in jobs)
+        for job in jobs:
+            # A job waiting for a retry is finished right away
+            handle = self.retries.get(job.job_id, None)
+            if handle is not None:
+                handle.cancel()
+                self._retry(job)
+        return len(jobs)
+
+    def stats(self) -> Dict[str, int]:
+        running = sum(job.status == JOB_RUNNING for job in self.pending.values())
+        return {
+            'pending': len(self.pending) - running,
+            'running': running,
+        }
+
+    async def _run_logged(self, job: EvaluationJob):
+        try:
+            await self._run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f'jobs: job {job.job_id} failed: {type(e).__name__}: {e}')
+
+    async def _run(self, job: EvaluationJob):
+        if job.job_id in self.cancelled:
+            self.cancelled.discard(job.job_id)
+            await self._finish(job, JOB_CANCELLED, None)
+            return
+
+        job.status = JOB_RUNNING
+        self.store.set_status(job.job_id, JOB_RUNNING)
+        notify_progress = None
+        if self.notify_progress is not None:
+            async def notify_progress(progress: BatchProgress):
+                await self.notify_progress(job, progress)
+
+        try:
+            task = self.task_manager.get_current_task(job.task_id)
+            answered = self.store.answered_snippets(job.job_id)
+            if self._exceeds_queue(task, job, answered):
+                # No retry helps: the provider's queue never takes that many at once
+                self.logger.warning(f'jobs: job {job.job_id} failed: batch larger than the LLM queue')
+                job.error = 'the task has more texts than the LLM queue takes'
+                result_batch = None
+            else:
+                compute = self.runner.compute_hidden_batch if job.tag == 'hidden' else self.runner.compute_open_batch
+                result_batch = await compute(
+                    task, job.user_id, job.prompt,
+                    notify_progress=notify_progress,
+                    answered=answered,
+                    on_answer=lambda evall: self.store.record_snippet(job.job_id, evall)
+                )
+        except QueueOverflowError:
+            if job.overflow_retries >= OVERFLOW_MAX_RETRIES:
+                self.logger.warning(f'jobs: job {job.job_id} failed: LLM queue full after {job.overflow_retries} retries')
+                job.error = 'the LLM queue is full, too many runs are waiting'
+                await self._finish(job, JOB_FAILED, None)
+                return
+            # Still durable: the job is started again later
+            job.overflow_retries += 1
+            job.status = JOB_PENDING
+            self.store.set_status(job.job_id, JOB_PENDING)
+            self.retries[job.job_id] = asyncio.get_running_loop().call_later(OVERFLOW_RETRY_DELAY_S, self._retry, job)
+            return
+        except asyncio.CancelledError:
+            # Shutdown: the job stays running in the store and is resumed
+            raise
+        except Exception as e:
+            self.logger.error(f'jobs: job {job.job_id} failed: {type(e).__name__}: {e}')
+            await self._finish(job, JOB_FAILED, None)
+            return
+        if result_batch is None:
+            await self._finish(job, JOB_FAILED, None)
+            return
+        await self._finish(job, JOB_DONE, result_batch)
+
+    def _exceeds_queue(self, task: PromptTask, job: EvaluationJob, answered: Dict[str, LLMResponse]) -> bool:
+        rate_limiter = self.runner.llms.get_rate_limiter(task.llm)
+        if rate_limiter is None:
+            return False
+        snippets = task.hidden_snippets if job.tag == 'hidden' else task.open_snippets
+        return len(snippets) - len(answered) > rate_limiter.queue_max_size
+
+    def _retry(self, job: EvaluationJob):
+        self.retries.pop(job.job_id, None)
+        self._start(job)
+
+    async def _finish(self, job: EvaluationJob, status: str, result_batch: Optional[SnippetBatchEvaluation]):
+        # Marked finished before the delivery: a crash while sending mustn't score the run twice
+        job.status = status
+        self.store.finish_job(job.job_id, status)
+        self.pending.pop(job.job_id, None)
+        await self.deliver(job, result_batch)
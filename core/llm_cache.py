@@ -0,0 +1,162 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+DEFAULT_MEMORY_SIZE = 1_000
+DEFAULT_DISK_SIZE   = 100_000
+DEFAULT_TTL_S       = 7 * 24 * 60 * 60.0
+
+# Share of the disk tier dropped at once when it overflows,
+# so that eviction doesn't run on every single insert.
+DISK_EVICTION_SHARE = 0.1
+
+
+def response_cache_key(llm_name: str,
+                       model_name: Optional[str],
+                       system_prompt: str,
+                       prompt: str,
+                       temperature: Optional[float]) -> str:
+    payload = json.dumps(
+        [llm_name, model_name, system_prompt, prompt, temperature],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    # Two tiers: in-memory LRU in front of an on-disk SQLite table.
+
+    def __init__(self,
+                 db_name: str = 'persistence/llm_cache.db',
+                 memory_size: int = DEFAULT_MEMORY_SIZE,
+                 disk_size: int = DEFAULT_DISK_SIZE,
+                 ttl_s: float = DEFAULT_TTL_S):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl_s = ttl_s
+
+        self.memory = OrderedDict()
+
+        self.conn = sqlite3.connect(db_name)
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+        self.evict_expired()
+
+        self.cursor.execute('SELECT COUNT(*) FROM llm_responses')
+        self.disk_count = self.cursor.fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT,
+                created_at REAL,
+                accessed_at REAL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS llm_responses_accessed_at
+            ON llm_responses (accessed_at)
+        ''')
+        self.conn.commit()
+
+    def is_expired(self, created_at: float, now: float) -> bool:
+        return now - created_at > self.ttl_s
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        if key in self.memory:
+            created_at, response = self.memory[key]
+            if not self.is_expired(created_at, now):
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return response
+            self.memory.pop(key)
+
+        self.cursor.execute('''
+            SELECT response, created_at
+            FROM llm_responses
+            WHERE cache_key = ?
+        ''', (key,))
+        row = self.cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        response, created_at = row
+        if self.is_expired(created_at, now):
+            self.cursor.execute('DELETE FROM llm_responses WHERE cache_key = ?', (key,))
+            self.conn.commit()
+            self.disk_count -= 1
+            self.misses += 1
+            return None
+
+        self.cursor.execute('''
+            UPDATE llm_responses
+            SET accessed_at = ?
+            WHERE cache_key = ?
+        ''', (now, key))
+        self.conn.commit()
+        self._remember(key, created_at, response)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        self._remember(key, now, response)
+
+        self.cursor.execute('SELECT 1 FROM llm_responses WHERE cache_key = ?', (key,))
+        is_new = self.cursor.fetchone() is None
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO llm_responses (cache_key, response, created_at, accessed_at)
+            VALUES (?, ?, ?, ?)
+        ''', (key, response, now, now))
+        self.conn.commit()
+        if is_new:
+            self.disk_count += 1
+        if self.disk_count > self.disk_size:
+            self.evict_oldest()
+
+    def _remember(self, key: str, created_at: float, response: str):
+        self.memory[key] = (created_at, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def evict_expired(self):
+        self.cursor.execute('''
+            DELETE FROM llm_responses
+            WHERE created_at < ?
+        ''', (time.time() - self.ttl_s,))
+        self.conn.commit()
+
+    def evict_oldest(self):
+        to_drop = self.disk_count - self.disk_size + int(self.disk_size * DISK_EVICTION_SHARE)
+        self.cursor.execute('''
+            DELETE FROM llm_responses
+            WHERE cache_key IN (
+                SELECT cache_key
+                FROM llm_responses
+                ORDER BY accessed_at ASC
+                LIMIT ?
+            )
+        ''', (to_drop,))
+        self.conn.commit()
+        self.disk_count -= self.cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_entries': len(self.memory),
+            'disk_entries': self.disk_count,
+        }
+
+    def close(self):
+        self.conn.close()
@@ -1,25 +1,128 @@
 import asyncio
+import collections
+import dataclasses
 import os
-from typing import Optional
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
 
 import yaml
 
-from openai import AsyncOpenAI, NotGiven
+from openai import AsyncOpenAI, NOT_GIVEN, NotGiven
+from openai.types import CompletionUsage
 
-from core.ai import get_ai_response
+from core.ai import (
+    CircuitBreaker, call_with_retries, get_ai_response, stream_ai_response, is_overload_error, BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT_S, DEFAULT_MAX_RETRIES
+)
+from core.llm_cache import LLMResponseCache, response_cache_key
+from core.ratelimit import (
+    AdaptiveConcurrency, RateLimiter, Priority, DEFAULT_RATE_LIMIT, DEFAULT_TIMERANGE_S, DEFAULT_MAX_CONCURRENCY, DEFAULT_QUEUE_SIZE,
+    DEFAULT_AGING_S
+)
+from core.single_flight import SingleFlight
 from core.utils import PathLike
 
+
+CHARS_PER_TOKEN = 4.0
+MESSAGE_OVERHEAD_TOKENS = 16
+DEFAULT_COMPLETION_TOKENS = 256
+ESTIMATE_EWMA_ALPHA = 0.1
+
+# Requests that may start at once under an `rpm` limit
+DEFAULT_RPM_BURST = 3
+
+LATENCY_WINDOW = 200
+DEFAULT_HEDGE_PERCENTILE = 95.0
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+
+
+def rpm_bucket(rpm: int, burst: int) -> Tuple[int, int]:
+    # Refill rate (per minute) and burst of the request bucket. A bucket starting full lets `burst + rate`
+    # requests out within a minute, so the refill takes the burst out of `rpm`: no minute goes over it
+    # (but for rpm: 1, which can't be split).
+    burst = min(burst, rpm // 2)
+    if burst < 1:
+        return rpm, 1
+    return rpm - burst, burst
+
+
+class TokenEstimator:
+    # Guesses the token cost of a request before it is sent
+    # and calibrates itself on the usage reported by the provider.
+
+    def __init__(self, completion_tokens: int = DEFAULT_COMPLETION_TOKENS):
+        self.chars_per_token = CHARS_PER_TOKEN
+        self.completion_tokens = float(completion_tokens)
+
+    def estimate(self, system_prompt: str, prompt: str) -> int:
+        prompt_tokens = (len(system_prompt) + len(prompt)) / self.chars_per_token
+        return int(prompt_tokens + MESSAGE_OVERHEAD_TOKENS + self.completion_tokens)
+
+    def observe(self, system_prompt: str, prompt: str, usage):
+        chars = len(system_prompt) + len(prompt)
+        prompt_tokens = (usage.prompt_tokens or 0) - MESSAGE_OVERHEAD_TOKENS
+        if chars > 0 and prompt_tokens > 0:
+            self.chars_per_token += ESTIMATE_EWMA_ALPHA * (chars / prompt_tokens - self.chars_per_token)
+        if usage.completion_tokens is not None:
+            self.completion_tokens += ESTIMATE_EWMA_ALPHA * (usage.completion_tokens - self.completion_tokens)
+
+    def usage_from_text(self, system_prompt: str, prompt: str, completion: str) -> CompletionUsage:
+        # For providers that don't report usage, e.g. ignore stream_options
+        prompt_tokens = int((len(system_prompt) + len(prompt)) / self.chars_per_token) + MESSAGE_OVERHEAD_TOKENS
+        completion_tokens = int(len(completion) / self.chars_per_token)
+        return CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+
+class RequestCancelledError(RuntimeError):
+    pass
+
+
+class LatencyTracker:
+    # Service latencies (from leaving the queue to the reply) of the recent requests to one LLM
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.latencies = collections.deque(maxlen=window)
+
+    def observe(self, latency_s: float):
+        self.latencies.append(latency_s)
+
+    def percentile(self, percentile: float, min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES) -> Optional[float]:
+        if len(self.latencies) < max(min_samples, 1):
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(percentile / 100.0 * (len(latencies) - 1))]
+
+
+@dataclasses.dataclass
+class LLMResponse:
+    content: str
+    cached: bool = False
+    llm_name: Optional[str] = None
+
+
 class LLMManager:
 
-    def __init__(self, config_pth: PathLike):
+    def __init__(self, config_pth: PathLike, cache: Optional[LLMResponseCache] = None):
         with open(config_pth, 'r') as file:
             config = yaml.safe_load(file)
 
         self.default_llm = config['default_llm']
         self.config = config['llms']
+        self.cache = cache
+        self.single_flight = SingleFlight()
 
         self.aclients = dict()
         self.model_names = dict()
+        self.rate_limiters = dict()
+        self.token_estimators = dict()
+        self.circuit_breakers = dict()
+        self.latency_trackers = dict()
+        self.hedge_stats = dict()
+        self.user_requests: Dict[str, Set[asyncio.Task]] = dict()
 
     def get_clinet_model(self, llm_name):
         if llm_name not in self.config:
@@ -29,31 +132,361 @@ class LLMManager:
             base_url = config['baseurl']
             api_key = config.get('api_key', None)
             api_key = api_key or os.getenv(config.get('api_key_env', ""))
+            # Retries are done by call_with_retries, each attempt goes through the rate limiter
             self.aclients[llm_name] = AsyncOpenAI(
                 base_url=base_url,
-                api_key=api_key
+                api_key=api_key,
+                max_retries=0
             )
             self.model_names[llm_name] = config.get('model_name', None)
         return self.aclients[llm_name], self.model_names[llm_name]
 
+    def get_rate_limiter(self, llm_name: Optional[str]) -> RateLimiter:
+        llm_name = llm_name or self.default_llm
+        if llm_name not in self.config:
+            raise ValueError(f"LLM config {llm_name} hasn't been found")
+        if llm_name not in self.rate_limiters:
+            config = self.config[llm_name].get('rate_limit', None) or dict()
+            if 'rpm' in config:
+                rate_limit, burst = rpm_bucket(config['rpm'], config.get('burst', DEFAULT_RPM_BURST))
+                time_range_s = 60.0
+            else:
+                rate_limit, time_range_s, burst = DEFAULT_RATE_LIMIT, DEFAULT_TIMERANGE_S, None
+            max_concurrency = config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+            adaptive_concurrency = None
+            if 'adaptive_concurrency' in config:
+                # max_concurrency becomes the starting point of the adaptive limit
+                adaptive_config = config['adaptive_concurrency'] or dict()
+                adaptive_concurrency = AdaptiveConcurrency(
+                    initial=max_concurrency,
+                    min_limit=adaptive_config.get('min', 1),
+                    max_limit=adaptive_config.get('max', max_concurrency * 4),
+                )
+            self.rate_limiters[llm_name] = RateLimiter(
+                rate_limit=rate_limit,
+                time_range_s=time_range_s,
+                burst=burst,
+                max_concurrency=max_concurrency,
+                queue_max_size=config.get('queue_size', DEFAULT_QUEUE_SIZE),
+                tokens_per_minute=config.get('tpm', None),
+                aging_s=config.get('aging_s', DEFAULT_AGING_S),
+                adaptive_concurrency=adaptive_concurrency,
+                is_overload=is_overload_error,
+            )
+            self.token_estimators[llm_name] = TokenEstimator(
+                completion_tokens=config.get('completion_tokens', DEFAULT_COMPLETION_TOKENS)
+            )
+            self.latency_trackers[llm_name] = LatencyTracker()
+        return self.rate_limiters[llm_name]
+
+    def get_circuit_breaker(self, llm_name: str) -> CircuitBreaker:
+        # LLM configs pointing to the same endpoint share a breaker, the first one configures it
+        config = self.config[llm_name]
+        base_url = config['baseurl']
+        if base_url not in self.circuit_breakers:
+            retry_config = config.get('retry', None) or dict()
+            self.circuit_breakers[base_url] = CircuitBreaker(
+                name=base_url,
+                failure_threshold=retry_config.get('breaker_threshold', BREAKER_FAILURE_THRESHOLD),
+                reset_timeout_s=retry_config.get('breaker_reset_s', BREAKER_RESET_TIMEOUT_S),
+            )
+        return self.circuit_breakers[base_url]
+
+    def get_cache_key(self,
+                      llm_name: str,
+                      system_prompt: str,
+                      prompt: str,
+                      temperature: Optional[float] | NotGiven = NOT_GIVEN) -> str:
+        _, model = self.get_clinet_model(llm_name)
+        if isinstance(temperature, NotGiven):
+            temperature = None
+        return response_cache_key(llm_name, model, system_prompt, prompt, temperature)
+
+    def get_cached_response(self,
+                            llm_name: Optional[str],
+                            system_prompt: str,
+                            prompt: str,
+                            temperature: Optional[float] | NotGiven = NOT_GIVEN) -> Optional[LLMResponse]:
+        if self.cache is None:
+            return None
+        llm_name = llm_name or self.default_llm
+        key = self.get_cache_key(llm_name, system_prompt, prompt, temperature)
+        content = self.cache.get(key)
+        if content is None:
+            return None
+        return LLMResponse(content=content, cached=True, llm_name=llm_name)
 
     async def get_ai_response(self,
                               llm_name: Optional[str],
                               system_prompt: str,
                               prompt: str,
-                              **kwargs):
+                              use_cache: bool = True,
+                              temperature: Optional[float] | NotGiven = NOT_GIVEN,
+                              user_id: Optional[str] = None,
+                              priority: Priority = Priority.INTERACTIVE,
+                              allow_fallback: bool = True,
+                              on_chunk: Optional[Callable[[str], None]] = None,
+                              deadline_s: Optional[float] = None,
+                              **kwargs) -> LLMResponse:
+        # Requests of a user are tracked, so that cancel_user can stop them.
+        # Cancelled requests raise RequestCancelledError.
+        # deadline_s (time.monotonic()) goes down to the rate limiter and the HTTP call,
+        # past it the request is cancelled and TimeoutError is raised.
+        # timeout_s bounds each attempt from the moment it leaves the rate limiter, time in the queue doesn't count.
+        routine = self._get_ai_response(
+            llm_name, system_prompt, prompt, use_cache, temperature,
+            user_id=user_id, priority=priority, allow_fallback=allow_fallback, on_chunk=on_chunk,
+            deadline_s=deadline_s, **kwargs
+        )
+        if user_id is None and deadline_s is None:
+            return await routine
+        request = asyncio.create_task(routine)
+        if user_id is not None:
+            self.user_requests.setdefault(user_id, set()).add(request)
+        try:
+            if deadline_s is None:
+                return await request
+            # Also covers waiting for a request coalesced with one of a later deadline
+            return await asyncio.wait_for(request, max(0.0, deadline_s - time.monotonic()))
+        except asyncio.CancelledError:
+            if request.cancelled() and asyncio.current_task().cancelling() == 0:
+                raise RequestCancelledError(f'Request of {user_id} has been cancelled')
+            raise
+        finally:
+            requests = self.user_requests.get(user_id, set())
+            requests.discard(request)
+            if not requests:
+                self.user_requests.pop(user_id, None)
+
+    def cancel_user(self, user_id: str) -> int:
+        # Cancelling the caller side keeps requests coalesced with other users' ones alive (see SingleFlight),
+        # the rate limiter slots of the rest are freed right away.
+        requests = self.user_requests.get(user_id, set())
+        for request in requests:
+            request.cancel()
+        return len(requests)
+
+    async def _get_ai_response(self,
+                               llm_name: Optional[str],
+                               system_prompt: str,
+                               prompt: str,
+                               use_cache: bool = True,
+                               temperature: Optional[float] | NotGiven = NOT_GIVEN,
+                               user_id: Optional[str] = None,
+                               priority: Priority = Priority.INTERACTIVE,
+                               allow_fallback: bool = True,
+                               on_chunk: Optional[Callable[[str], None]] = None,
+                               deadline_s: Optional[float] = None,
+                               **kwargs) -> LLMResponse:
+        # use_cache=False disables both caching and coalescing of identical requests,
+        # as both assume the reply is deterministic.
+        # allow_fallback=False keeps hedged requests on llm_name, e.g. for scored runs.
+        # on_chunk streams the reply: it is called with the text received so far.
+        # Only requests of the same priority are coalesced. The shared request runs with
+        # the deadline and user_id of the first caller, the others retry if it times out.
         llm_name = llm_name or self.default_llm
+        if use_cache:
+            cached = self.get_cached_response(llm_name, system_prompt, prompt, temperature)
+            if cached is not None:
+                return cached
+
+        if on_chunk is not None:
+            # Streamed requests are neither coalesced nor hedged, the caller shows the tokens as they come
+            content = await self._request(
+                llm_name, system_prompt, prompt, use_cache, temperature=temperature, user_id=user_id,
+                priority=priority, on_chunk=on_chunk, deadline_s=deadline_s, **kwargs
+            )
+            return LLMResponse(content=content, llm_name=llm_name)
+
+        led = []
+
+        def routine_factory():
+            led.append(True)
+            return self._hedged_request(
+                llm_name, system_prompt, prompt, use_cache, allow_fallback,
+                temperature=temperature, user_id=user_id, priority=priority, deadline_s=deadline_s, **kwargs
+            )
+
+        if not use_cache:
+            return await routine_factory()
+        key = (self.get_cache_key(llm_name, system_prompt, prompt, temperature), allow_fallback, priority)
+        while True:
+            try:
+                return await self.single_flight.do(key, routine_factory)
+            except TimeoutError:
+                if led:
+                    raise
+                # The deadline of the first caller has passed, ours is checked by get_ai_response
+
+    async def _hedged_request(self,
+                              llm_name: str,
+                              system_prompt: str,
+                              prompt: str,
+                              use_cache: bool,
+                              allow_fallback: bool,
+                              **kwargs) -> LLMResponse:
+        # If the reply takes longer than the configured percentile of the observed latency,
+        # a duplicate request goes to the same LLM or its fallback. The first answer wins.
+        hedge_config = self.config[llm_name].get('hedge', None)
+        if hedge_config is None:
+            content = await self._request(llm_name, system_prompt, prompt, use_cache, **kwargs)
+            return LLMResponse(content=content, llm_name=llm_name)
+
+        hedge_llm = hedge_config.get('fallback', None) if allow_fallback else None
+        hedge_llm = hedge_llm or llm_name
+        started = asyncio.Event()
+        primary = asyncio.create_task(
+            self._request(llm_name, system_prompt, prompt, use_cache, started=started, **kwargs)
+        )
+        timer = asyncio.create_task(self._wait_hedge_point(
+            llm_name,
+            started,
+            hedge_config.get('percentile', DEFAULT_HEDGE_PERCENTILE),
+            hedge_config.get('min_samples', DEFAULT_HEDGE_MIN_SAMPLES)
+        ))
+        requests = {primary: llm_name}
+        try:
+            await asyncio.wait([primary, timer], return_when=asyncio.FIRST_COMPLETED)
+            if not primary.done() and timer.result():
+                hedge = asyncio.create_task(
+                    self._request(hedge_llm, system_prompt, prompt, use_cache, **kwargs)
+                )
+                requests[hedge] = hedge_llm
+                stats = self.hedge_stats.setdefault(llm_name, {'hedged': 0, 'hedge_won': 0})
+                stats['hedged'] += 1
+
+            pending = set(requests)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None:
+                        if request is not primary:
+                            self.hedge_stats[llm_name]['hedge_won'] += 1
+                        return LLMResponse(content=request.result(), llm_name=requests[request])
+            # Both have failed, report the primary's error
+            return LLMResponse(content=primary.result(), llm_name=llm_name)
+        finally:
+            for request in [timer, *requests]:
+                if not request.done():
+                    request.cancel()
+                elif not request.cancelled():
+                    # Marks the error of the losing request as retrieved
+                    request.exception()
+
+    async def _wait_hedge_point(self,
+                                llm_name: str,
+                                started: asyncio.Event,
+                                percentile: float,
+                                min_samples: int) -> bool:
+        # The clock starts once the request has left the queue, so queueing itself doesn't trigger hedges
+        await started.wait()
+        delay_s = self.latency_trackers[llm_name].percentile(percentile, min_samples)
+        if delay_s is None:
+            return False
+        await asyncio.sleep(delay_s)
+        return True
+
+    async def _request(self,
+                       llm_name: str,
+                       system_prompt: str,
+                       prompt: str,
+                       use_cache: bool,
+                       temperature: Optional[float] | NotGiven = NOT_GIVEN,
+                       user_id: Optional[str] = None,
+                       priority: Priority = Priority.INTERACTIVE,
+                       started: Optional[asyncio.Event] = None,
+                       on_chunk: Optional[Callable[[str], None]] = None,
+                       deadline_s: Optional[float] = None,
+                       timeout_s: Optional[float] = None,
+                       **kwargs) -> str:
         client, model = self.get_clinet_model(llm_name)
-        return await get_ai_response(
-            client=client,
-            system_prompt=system_prompt,
-            prompt=prompt,
-            model_name=model,
-            **kwargs
+        limiter = self.get_rate_limiter(llm_name)
+        estimator = self.token_estimators[llm_name]
+        token_cost = estimator.estimate(system_prompt, prompt)
+        breaker = self.get_circuit_breaker(llm_name)
+        retry_config = self.config[llm_name].get('retry', None) or dict()
+        latency_tracker = self.latency_trackers[llm_name]
+
+        async def call():
+            # The breaker may have opened while the call was waiting in the queue
+            breaker.before_call()
+            if started is not None:
+                started.set()
+            start_s = time.monotonic()
+            timeout = NOT_GIVEN if timeout_s is None else timeout_s
+            if deadline_s is not None:
+                timeout = deadline_s - start_s
+                if timeout <= 0:
+                    raise TimeoutError('The deadline has passed in the queue')
+                if timeout_s is not None:
+                    timeout = min(timeout, timeout_s)
+            usage_collector = []
+            # Bounds a hung connection, e.g. a stream that stops sending without closing
+            async with asyncio.timeout(timeout_s):
+                if on_chunk is None:
+                    content = await get_ai_response(
+                        client=client,
+                        system_prompt=system_prompt,
+                        prompt=prompt,
+                        model_name=model,
+                        temperature=temperature,
+                        usage_collector=usage_collector,
+                        timeout=timeout,
+                        **kwargs
+                    )
+                else:
+                    # A retried stream starts over, so on_chunk always gets the whole text so far
+                    chunks = []
+                    async for chunk in stream_ai_response(
+                        client=client,
+                        system_prompt=system_prompt,
+                        prompt=prompt,
+                        model_name=model,
+                        temperature=temperature,
+                        collector=chunks,
+                        usage_collector=usage_collector,
+                        timeout=timeout,
+                        **kwargs
+                    ):
+                        on_chunk(''.join(chunks))
+                    content = ''.join(chunks)
+            usage = usage_collector[0] if usage_collector else None
+            if usage is None and on_chunk is not None:
+                # Debits what was actually streamed, the reply may be far longer than the estimate
+                usage = estimator.usage_from_text(system_prompt, prompt, content)
+            if usage is not None and usage.total_tokens is not None:
+                limiter.adjust_tokens(usage.total_tokens - token_cost)
+                estimator.observe(system_prompt, prompt, usage)
+            latency_tracker.observe(time.monotonic() - start_s)
+            return content
+
+        content = await call_with_retries(
+            lambda: limiter.submit(
+                call(), token_cost=token_cost, user_id=user_id, priority=priority, deadline_s=deadline_s
+            ),
+            breaker=breaker,
+            max_retries=retry_config.get('max_retries', DEFAULT_MAX_RETRIES),
+            deadline_s=deadline_s
         )
+        if use_cache and self.cache is not None and content is not None:
+            key = self.get_cache_key(llm_name, system_prompt, prompt, temperature)
+            self.cache.put(key, content)
+        return content
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = dict()
+        for llm_name, limiter in self.rate_limiters.items():
+            stats[llm_name] = limiter.stats()
+            stats[llm_name]['breaker'] = self.get_circuit_breaker(llm_name).state
+            stats[llm_name].update(self.hedge_stats.get(llm_name, dict()))
+        return stats
 
     async def close(self):
-        await asyncio.gather(
+        await asyncio.gather(*[
+            limiter.close()
+            for limiter in self.rate_limiters.values()
+        ])
+        await asyncio.gather(*[
             client.close()
             for client in self.aclients.values()
-        )
+        ])
@@ -1,3 +1,4 @@
+import hashlib
 import sqlite3
 import json
 from datetime import datetime
@@ -29,42 +30,107 @@ class LeaderRow:
             user_name = user_name + " (YOU)"
         return f'{self.hidden_value * 100:3.2f} - {user_name} - {len(prompt) = }'
 
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+# Ordered schema changes, migration i brings the database to version i + 1.
+# Applied once each and recorded in `schema_migrations`; never edit a released one, append a new one.
+MIGRATIONS: List[List[str]] = [
+    # 1: the tables as they were before the versioning (a database of that time is already here)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS prompt_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            task_id TEXT,
+            prompt_id INT,
+            creation_date DATE,
+            open_score REAL,
+            open_runs INTEGER,
+            hidden_score REAL,
+            hidden_runs INTEGER,
+            parameters_json TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            user_name TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS prompts (
+            prompt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            task_id TEXT,
+            prompt TEXT
+        )
+        ''',
+    ],
+    # 2: prompts are looked up by the hash of the text instead of comparing the whole text with every row
+    [
+        'ALTER TABLE prompts ADD COLUMN prompt_hash TEXT',
+        'UPDATE prompts SET prompt_hash = prompt_hash(prompt)',
+        'CREATE INDEX prompts_lookup ON prompts (user_id, task_id, prompt_hash)',
+    ],
+    # 3: the run lookup of insert_prompt_run is answered from the index alone (run_id is the rowid),
+    # the leaderboard and top-k queries filter by task and user
+    [
+        'CREATE INDEX prompt_runs_lookup ON prompt_runs (user_id, task_id, prompt_id, parameters_json)',
+        'CREATE INDEX prompt_runs_task ON prompt_runs (task_id, user_id)',
+    ],
+]
+
+PRAGMAS = [
+    # Readers don't block the writer, and a commit is an append to the log
+    'PRAGMA journal_mode = WAL',
+    # Safe with WAL: a power loss may drop the last commits, but never corrupts the database
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    # In KiB when negative
+    'PRAGMA cache_size = -65536',
+    'PRAGMA mmap_size = 268435456',
+]
+
+
 class PromptDBManager:
-    def __init__(self, db_name: str = 'persistence/sql.db'):
+    def __init__(self, db_name: str = 'persistence/sql.db', schema_version: int = None):
         self.conn = sqlite3.connect(db_name)
+        self.conn.create_function('prompt_hash', 1, prompt_hash, deterministic=True)
         self.cursor = self.conn.cursor()
-        self.create_tables()
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        # schema_version stops the migrations early, only to measure an older schema (helpers/prompt_db_benchmark.py)
+        self.migrate(len(MIGRATIONS) if schema_version is None else schema_version)
 
-    def create_tables(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS prompt_runs (
-                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                task_id TEXT,
-                prompt_id INT,
-                creation_date DATE,
-                open_score REAL,
-                open_runs INTEGER,
-                hidden_score REAL,
-                hidden_runs INTEGER,
-                parameters_json TEXT
-            )
-        ''')
+    def get_schema_version(self) -> int:
         self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                user_name TEXT
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at DATE
             )
         ''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS prompts (
-                prompt_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                task_id TEXT,
-                prompt TEXT
-            )
-        ''')
-        self.conn.commit()
+        self.cursor.execute('SELECT MAX(version) FROM schema_migrations')
+        return self.cursor.fetchone()[0] or 0
+
+    def migrate(self, target_version: int):
+        version = self.get_schema_version()
+        for version in range(version + 1, target_version + 1):
+            # Each migration is applied as a whole or not at all
+            self.cursor.execute('BEGIN')
+            try:
+                for statement in MIGRATIONS[version - 1]:
+                    self.cursor.execute(statement)
+                self.cursor.execute(
+                    'INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)',
+                    (version, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
     def insert_prompt_run(self,
                       user_id: str,
@@ -83,24 +149,18 @@ class PromptDBManager:
         parameters_dumped = json.dumps(parameters_json)
 
         self.cursor.execute('''
-            SELECT run_id, open_score, open_runs, hidden_score, hidden_runs 
+            SELECT run_id
             FROM prompt_runs 
             WHERE user_id = ? AND task_id = ? AND prompt_id = ? AND parameters_json = ?
         ''', (user_id, task_id, prompt_id, parameters_dumped))
         existing_run = self.cursor.fetchone()
         if existing_run:
-            run_id, prev_open_score, prev_open_runs, prev_hidden_score, prev_hidden_runs = existing_run
             self.cursor.execute('''
                 UPDATE prompt_runs
-                SET open_score = ?, open_runs = ?, hidden_score = ?, hidden_runs = ?
+                SET open_score = open_score + ?, open_runs = open_runs + ?,
+                    hidden_score = hidden_score + ?, hidden_runs = hidden_runs + ?
                 WHERE run_id = ?
-            ''', (
-                prev_open_score + open_score,
-                prev_open_runs + open_runs,
-                prev_hidden_score + hidden_score,
-                prev_hidden_runs + hidden_runs,
-                run_id
-            ))
+            ''', (open_score, open_runs, hidden_score, hidden_runs, existing_run[0]))
         else:
             creation_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.cursor.execute('''
@@ -110,20 +170,21 @@ class PromptDBManager:
         self.conn.commit()
 
     def insert_prompt(self, user_id: str, task_id: str, prompt: str) -> int:
+        hashed = prompt_hash(prompt)
         self.cursor.execute('''
             SELECT prompt_id 
             FROM prompts
-            WHERE user_id = ? AND task_id = ? AND prompt = ?
-        ''', (user_id, task_id, prompt))
+            WHERE user_id = ? AND task_id = ? AND prompt_hash = ? AND prompt = ?
+        ''', (user_id, task_id, hashed, prompt))
         existing_prompt = self.cursor.fetchone()
 
         if existing_prompt:
             prompt_id = existing_prompt[0]
         else:
             self.cursor.execute('''
-                INSERT INTO prompts (user_id, task_id, prompt)
-                VALUES (?, ?, ?)
-            ''', (user_id, task_id, prompt))
+                INSERT INTO prompts (user_id, task_id, prompt, prompt_hash)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, task_id, prompt, hashed))
             prompt_id = self.cursor.lastrowid
             self.conn.commit()
         return prompt_id
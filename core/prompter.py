@@ -1,15 +1,20 @@
+import asyncio
 import dataclasses
+import enum
 import json
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-from core.ai import get_ai_response
-from core.llm_manager import LLMManager
+from core.llm_manager import LLMManager, LLMResponse, RequestCancelledError
 from core.matcher import Matcher
 from core.prompt_db import PromptDBManager
-from core.ratelimit import RateLimiter, RateLimitedBatchQueue
+from core.ratelimit import Priority, QueueOverflowError, RateLimitedBatchQueue
 from core.task import PromptTask
 from core.utils import html_escape
 
+# A hung provider connection must not keep a run "Computing..." forever
+DEFAULT_SNIPPET_TIMEOUT_S = 120.0
+
 
 def data_to_str(data):
     if isinstance(data, str):
@@ -19,6 +24,13 @@ def data_to_str(data):
     return str(data)
 
 
+class EvaluationStatus(enum.Enum):
+    OK = 'ok'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+    CANCELLED = 'cancelled'
+
+
 @dataclasses.dataclass
 class SnippetEvaluation:
     task_id: str
@@ -28,10 +40,30 @@ class SnippetEvaluation:
     result_data: Any
     answer_data: Any
     result_msg: str
+    cached: bool = False
+    status: EvaluationStatus = EvaluationStatus.OK
+    error: Optional[str] = None
+    fallback_llm: Optional[str] = None
+
+    def tg_html_shortform(self) -> str:
+        if self.status != EvaluationStatus.OK:
+            return f'Status: <b>{self.status.value}</b>'
+        cached_mark = ' (cached)' if self.cached else ''
+        if self.fallback_llm is not None:
+            cached_mark += f' (by {html_escape(self.fallback_llm)})'
+        return f'Score: <b>{self.score * 100.0:.2f}%</b>{cached_mark}'
 
     def tg_html_form(self) -> str:
+        if self.status != EvaluationStatus.OK:
+            lines = [
+                self.tg_html_shortform(),
+                f'Text:\n<code>{html_escape(self.snippet_txt)}</code>',
+            ]
+            if self.error is not None:
+                lines.append(f'Error:\n<code>{html_escape(self.error)}</code>')
+            return "\n".join(lines)
         return "\n".join([
-            f'Score: <b>{self.score * 100.0:.2f}%</b>',
+            self.tg_html_shortform(),
             f'Text:\n<code>{html_escape(self.snippet_txt)}</code>',
             f'Result:\n<code>{html_escape(data_to_str(self.result_data))}</code>',
             f'Answer:\n<code>{html_escape(data_to_str(self.answer_data))}</code>',
@@ -46,10 +78,32 @@ class SnippetBatchEvaluation:
     score: float
     eval_list: List[SnippetEvaluation]
 
-    def tg_html_form(self) -> str:
+    @property
+    def status(self) -> EvaluationStatus:
+        statuses = {evall.status for evall in self.eval_list}
+        for status in [EvaluationStatus.CANCELLED, EvaluationStatus.TIMEOUT, EvaluationStatus.ERROR]:
+            if status in statuses:
+                return status
+        return EvaluationStatus.OK
+
+    @property
+    def partial(self) -> bool:
+        # Some snippets are evaluated, but not all of them
+        evaluated = sum(evall.status == EvaluationStatus.OK for evall in self.eval_list)
+        return 0 < evaluated < len(self.eval_list)
+
+    def _title_line(self) -> str:
         title = self.task_id if self.tag is None else f'{self.task_id}/{self.tag}'
+        if self.status != EvaluationStatus.OK:
+            failed = sum(evall.status != EvaluationStatus.OK for evall in self.eval_list)
+            partial_score = f', partial score: {self.score * 100:.2f}%' if self.partial else ''
+            return (f'<b>{title} - {self.status.value}: {failed}/{len(self.eval_list)} snippets not evaluated'
+                    f'{partial_score}, the run is not recorded</b>')
+        return f'<b>{title} - score: {self.score * 100:.2f}%</b>'
+
+    def tg_html_form(self) -> str:
         lines = [
-            f'<b>{title} - score: {self.score * 100:.2f}%</b>',
+            self._title_line(),
             '',
         ]
         for idd, evall in enumerate(self.eval_list):
@@ -59,85 +113,229 @@ class SnippetBatchEvaluation:
         return '\n'.join(lines).strip()
 
     def tg_html_form_semihidden(self) -> str:
-        title = self.task_id if self.tag is None else f'{self.task_id}/{self.tag}'
         lines = [
-            f'<b>{title} - score: {self.score * 100:.2f}%</b>',
+            self._title_line(),
             '<code>',
         ]
         for idd, evall in enumerate(self.eval_list):
+            if evall.status != EvaluationStatus.OK:
+                lines.append(f'{idd + 1}. {evall.snippet_id}: {evall.status.value}')
+                continue
+            cached_mark = ' (cached)' if evall.cached else ''
             lines.extend([
-                f'{idd + 1}. {evall.snippet_id}: {evall.score * 100:.2f}%',
+                f'{idd + 1}. {evall.snippet_id}: {evall.score * 100:.2f}%{cached_mark}',
             ])
         lines.append('</code>')
         return '\n'.join(lines)
 
     def tg_html_shortform(self) -> str:
-        title = self.task_id if self.tag is None else f'{self.task_id}/{self.tag}'
-        return f'<b>{title} - score: {self.score * 100:.2f}%</b>'
+        return self._title_line()
 
 
 class PromptRunner:
 
     def __init__(self,
-                 rate_limiter: RateLimiter,
                  queue: RateLimitedBatchQueue,
                  sql_db: PromptDBManager,
-                 llms: LLMManager):
-        self.rate_limiter = rate_limiter
+                 llms: LLMManager,
+                 snippet_timeout_s: float = DEFAULT_SNIPPET_TIMEOUT_S):
+        # An interactive snippet gets snippet_timeout_s in total. Batch snippets may wait in the queue
+        # for as long as it takes, only each LLM call is bounded by snippet_timeout_s.
         self.queue = queue
         self.sql_db = sql_db
         self.llms = llms
+        self.snippet_timeout_s = snippet_timeout_s
 
     async def process_snippet(self,
                                         task: PromptTask,
                                         snippet_id: str,
                                         prompt: str,
                                         matcher: Matcher,
-                                        custom_snippet_dct: Dict = None) -> SnippetEvaluation:
-        return await self.rate_limiter.submit(
-            self._process_snippet_unlim(
-                task, snippet_id, prompt, matcher, custom_snippet_dct
-            )
+                                        custom_snippet_dct: Dict = None,
+                                        user_id: Optional[str] = None,
+                                        on_chunk: Optional[Callable[[str], None]] = None) -> SnippetEvaluation:
+        # The LLM call itself is rate limited by LLMManager with the limiter of task.llm,
+        # single snippet runs are interactive and go ahead of batch scoring.
+        # They aren't recorded, so a fallback LLM may answer.
+        return await self._process_snippet_unlim(
+            task, snippet_id, prompt, matcher, custom_snippet_dct, user_id, Priority.INTERACTIVE,
+            allow_fallback=True, on_chunk=on_chunk, deadline_s=time.monotonic() + self.snippet_timeout_s
         )
 
-    async def _process_snippet_unlim(self,
-                              task: PromptTask,
-                              snippet_id: str,
-                              prompt: str,
-                              matcher: Matcher,
-                              custom_snippet_dct: Dict = None) -> SnippetEvaluation:
+    @staticmethod
+    def _get_snippet(task: PromptTask, snippet_id: str, custom_snippet_dct: Dict = None) -> Dict:
         task_snippet_dcts = custom_snippet_dct or task.open_snippets
-        snippet_dct = task_snippet_dcts[snippet_id]
-        snippet_txt = snippet_dct['Task']
-        snippet_answer = snippet_dct['Answer']
-        result_msg = await self.llms.get_ai_response(
-            llm_name=task.llm,
-            system_prompt=prompt,
-            prompt=snippet_txt
-        )
-        result_data = task.reply_pipe(result_msg)
-        answer_data = task.answer_pipe(snippet_answer)
+        return task_snippet_dcts[snippet_id]
+
+    def _evaluate_snippet(self,
+                          task: PromptTask,
+                          snippet_id: str,
+                          matcher: Matcher,
+                          response: LLMResponse,
+                          custom_snippet_dct: Dict = None) -> SnippetEvaluation:
+        snippet_dct = self._get_snippet(task, snippet_id, custom_snippet_dct)
+        result_data = task.reply_pipe(response.content)
+        answer_data = task.answer_pipe(snippet_dct['Answer'])
         score = matcher.accumulate(result_data, answer_data)
+        llm_name = task.llm or self.llms.default_llm
         return SnippetEvaluation(
             task_id=task.id,
             snippet_id=snippet_id,
             score=score,
             result_data=result_data,
             answer_data=answer_data,
-            snippet_txt=snippet_txt,
-            result_msg=result_msg
+            snippet_txt=snippet_dct['Task'],
+            result_msg=response.content,
+            cached=response.cached,
+            fallback_llm=response.llm_name if response.llm_name != llm_name else None
         )
 
+    async def _process_snippet_unlim(self,
+                              task: PromptTask,
+                              snippet_id: str,
+                              prompt: str,
+                              matcher: Matcher,
+                              custom_snippet_dct: Dict = None,
+                              user_id: Optional[str] = None,
+                              priority: Priority = Priority.BATCH,
+                              allow_fallback: bool = False,
+                              on_chunk: Optional[Callable[[str], None]] = None,
+                              deadline_s: Optional[float] = None,
+                              timeout_s: Optional[float] = None) -> SnippetEvaluation:
+        snippet_dct = self._get_snippet(task, snippet_id, custom_snippet_dct)
+        try:
+            response = await self.llms.get_ai_response(
+                llm_name=task.llm,
+                system_prompt=prompt,
+                prompt=snippet_dct['Task'],
+                use_cache=task.cache_responses,
+                user_id=user_id,
+                priority=priority,
+                allow_fallback=allow_fallback,
+                on_chunk=on_chunk,
+                deadline_s=deadline_s,
+                timeout_s=timeout_s
+            )
+        except QueueOverflowError:
+            raise
+        except RequestCancelledError:
+            return self._failed_snippet(task, snippet_id, snippet_dct, EvaluationStatus.CANCELLED)
+        except TimeoutError:
+            return self._failed_snippet(task, snippet_id, snippet_dct, EvaluationStatus.TIMEOUT)
+        except Exception as e:
+            # Retries are exhausted or the breaker is open, the snippet isn't scored
+            return self._failed_snippet(
+                task, snippet_id, snippet_dct, EvaluationStatus.ERROR, f'{type(e).__name__}: {e}'
+            )
+        return self._evaluate_snippet(task, snippet_id, matcher, response, custom_snippet_dct)
+
+    @staticmethod
+    def _failed_snippet(task: PromptTask,
+                        snippet_id: str,
+                        snippet_dct: Dict,
+                        status: EvaluationStatus,
+                        error: Optional[str] = None) -> SnippetEvaluation:
+        return SnippetEvaluation(
+            task_id=task.id,
+            snippet_id=snippet_id,
+            score=0.0,
+            result_data=None,
+            answer_data=None,
+            snippet_txt=snippet_dct['Task'],
+            result_msg='',
+            status=status,
+            error=error
+        )
+
+    def cancel_user(self, user_id: str) -> int:
+        return self.llms.cancel_user(user_id)
+
+    async def evaluate_as_completed(self,
+                                    task: PromptTask,
+                                    snippet_dct: Dict,
+                                    prompt: str,
+                                    matcher: Matcher,
+                                    user_id: Optional[str] = None) -> AsyncIterator[Tuple[int, SnippetEvaluation]]:
+        # All snippets go to the rate limiter at once and their evaluations come out as soon as they are ready,
+        # tagged with the index of the snippet. The runs aren't recorded, so a fallback LLM may answer.
+        # Interactive: the user watches the results come in (debug /run_open).
+        self.llms.get_rate_limiter(task.llm).check_capacity(len(snippet_dct))
+
+        async def evaluate(idd: int, snippet_id: str):
+            evall = await self._process_snippet_unlim(
+                task, snippet_id, prompt, matcher, snippet_dct, user_id, Priority.INTERACTIVE,
+                allow_fallback=True, timeout_s=self.snippet_timeout_s
+            )
+            return idd, evall
+
+        evaluations = [
+            asyncio.create_task(evaluate(idd, snippet_id))
+            for idd, snippet_id in enumerate(snippet_dct)
+        ]
+        try:
+            for evaluation in asyncio.as_completed(evaluations):
+                yield await evaluation
+        finally:
+            for evaluation in evaluations:
+                evaluation.cancel()
+
+    async def _answered_snippet(self,
+                                task: PromptTask,
+                                snippet_id: str,
+                                prompt: str,
+                                matcher: Matcher,
+                                snippet_dct: Dict,
+                                user_id: Optional[str],
+                                on_answer: Callable[[SnippetEvaluation], None]) -> SnippetEvaluation:
+        evall = await self._process_snippet_unlim(
+            task, snippet_id, prompt, matcher, snippet_dct, user_id, Priority.BATCH,
+            allow_fallback=task.allow_fallback, timeout_s=self.snippet_timeout_s
+        )
+        if evall.status == EvaluationStatus.OK:
+            on_answer(evall)
+        return evall
+
     async def compute_task_batch(self,
                                  task: PromptTask,
                                  snippet_dct: Dict,
                                  prompt: str,
-                                 tag: str = None):
+                                 tag: str = None,
+                                 user_id: Optional[str] = None,
+                                 notify_progress = None,
+                                 answered: Optional[Dict[str, LLMResponse]] = None,
+                                 on_answer: Optional[Callable[[SnippetEvaluation], None]] = None):
+        """
+        `answered` are the replies got for this batch before (e.g. by the process before a restart),
+        those snippets are scored without asking the LLM again. `on_answer` gets each snippet answered now.
+        """
+        answered = answered or dict()
         matcher = task.get_matcher()
+        evaluations = {
+            snippet_id: self._evaluate_snippet(task, snippet_id, matcher, answered[snippet_id], snippet_dct)
+            for snippet_id in snippet_dct if snippet_id in answered
+        }
+        snippet_ids = [snippet_id for snippet_id in snippet_dct if snippet_id not in answered]
         task_batch = []
-        for snippet_id in snippet_dct:
-            task_batch.append(self._process_snippet_unlim(task, snippet_id, prompt, matcher, snippet_dct))
-        eval_list = await self.queue.add_batch_task(task_batch)
+        for snippet_id in snippet_ids:
+            if on_answer is None:
+                task_batch.append(self._process_snippet_unlim(
+                    task, snippet_id, prompt, matcher, snippet_dct, user_id, Priority.BATCH,
+                    allow_fallback=task.allow_fallback, timeout_s=self.snippet_timeout_s
+                ))
+            else:
+                task_batch.append(self._answered_snippet(
+                    task, snippet_id, prompt, matcher, snippet_dct, user_id, on_answer
+                ))
+        if task_batch:
+            # Raises QueueOverflowError if the provider's queue can't take the whole batch
+            eval_list = await self.queue.add_batch_task(
+                task_batch,
+                rate_limiter=self.llms.get_rate_limiter(task.llm),
+                user_id=user_id,
+                notify_progress=notify_progress
+            )
+            evaluations.update(zip(snippet_ids, eval_list))
+        eval_list = [evaluations[snippet_id] for snippet_id in snippet_dct]
         return SnippetBatchEvaluation(
             score=matcher.score(),
             task_id=task.id,
@@ -145,13 +343,25 @@ class PromptRunner:
             tag=tag
         )
 
-    async def compute_open_batch(self, task: PromptTask, user_id: str, prompt: str):
+    async def compute_open_batch(self,
+                                 task: PromptTask,
+                                 user_id: str,
+                                 prompt: str,
+                                 notify_progress = None,
+                                 answered: Optional[Dict[str, LLMResponse]] = None,
+                                 on_answer: Optional[Callable[[SnippetEvaluation], None]] = None):
         evall = await self.compute_task_batch(
             task=task,
             snippet_dct=task.open_snippets,
             prompt=prompt,
-            tag="open"
+            tag="open",
+            user_id=user_id,
+            notify_progress=notify_progress,
+            answered=answered,
+            on_answer=on_answer
         )
+        if evall.status != EvaluationStatus.OK:
+            return evall
         self.sql_db.insert_prompt_run(
             user_id=user_id,
             task_id=task.id,
@@ -161,13 +371,25 @@ class PromptRunner:
         )
         return evall
 
-    async def compute_hidden_batch(self, task: PromptTask, user_id: str, prompt: str):
+    async def compute_hidden_batch(self,
+                                   task: PromptTask,
+                                   user_id: str,
+                                   prompt: str,
+                                   notify_progress = None,
+                                   answered: Optional[Dict[str, LLMResponse]] = None,
+                                   on_answer: Optional[Callable[[SnippetEvaluation], None]] = None):
         evall = await self.compute_task_batch(
             task=task,
             snippet_dct=task.hidden_snippets,
             prompt=prompt,
-            tag="hidden"
+            tag="hidden",
+            user_id=user_id,
+            notify_progress=notify_progress,
+            answered=answered,
+            on_answer=on_answer
         )
+        if evall.status != EvaluationStatus.OK:
+            return evall
         self.sql_db.insert_prompt_run(
             user_id=user_id,
             task_id=task.id,
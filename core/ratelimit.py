@@ -1,110 +1,692 @@
 import asyncio
+import collections
+import dataclasses
+import enum
+import functools
 import time
-import sys
-import traceback
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set
 
-DEFAULT_RATE_LIMIT  = 5
-DEFAULT_TIMERANGE_S = 1.0
-DEFAULT_QUEUE_SIZE  = 10_000
+DEFAULT_RATE_LIMIT      = 5
+DEFAULT_TIMERANGE_S     = 1.0
+DEFAULT_MAX_CONCURRENCY = 5
+DEFAULT_QUEUE_SIZE      = 10_000
+# Waiting this long lifts a routine by one priority class
+DEFAULT_AGING_S         = 10.0
+# Window to measure the service rate over
+SERVICE_RATE_WINDOW_S   = 60.0
+LATENCY_EWMA_ALPHA      = 0.1
+BATCH_PROGRESS_INTERVAL_S = 5.0
+# tokens_per_minute holds for any window of this length
+TOKEN_WINDOW_S          = 60.0
+# Adaptive concurrency: latency above baseline * tolerance counts as congestion
+AIMD_LATENCY_TOLERANCE  = 2.0
+AIMD_BACKOFF            = 0.5
+AIMD_SHORT_ALPHA        = 0.3
+AIMD_BASELINE_ALPHA     = 0.01
 
 
-async def worker(name, queue, time_range_s):
-    # use name for debugging
-    # time_range_s is the time range in seconds
-    while True:
-        routine = await queue.get()
+class QueueOverflowError(RuntimeError):
+    pass
 
-        start_time_s = time.time()
-        try:
-            await routine
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            traceback.print_exception(exc_type, exc_value, exc_traceback)
 
-        queue.task_done()
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BATCH       = 1
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_s: float, capacity: float):
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_s = time.monotonic()
+
+    def _refill(self):
+        now_s = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now_s - self.updated_s) * self.rate_per_s)
+        self.updated_s = now_s
+
+    def delay_s(self, amount: float = 1.0) -> float:
+        # Time to wait until `amount` tokens are available, 0 if they are already there.
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate_per_s
+
+    def consume(self, amount: float = 1.0):
+        # Negative amount gives tokens back, e.g. when the cost was overestimated.
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+@dataclasses.dataclass(eq=False)
+class _Debit:
+    time_s: float
+    amount: float
+
+
+class SlidingWindowBudget:
+    """
+    Lets at most `budget` be debited within any `window_s`. A debit counts for `window_s` from the moment
+    it's made, and a correction (e.g. the real token usage) changes the debit it belongs to.
+    """
+
+    def __init__(self, budget: float, window_s: float):
+        self.budget = budget
+        self.window_s = window_s
+        self.debits: Deque[_Debit] = collections.deque()
+        self.total = 0.0
+
+    def _expire(self, now_s: float):
+        while self.debits and now_s - self.debits[0].time_s >= self.window_s:
+            self.total -= self.debits.popleft().amount
+
+    @property
+    def available(self) -> float:
+        self._expire(time.monotonic())
+        return self.budget - self.total
+
+    def delay_s(self, amount: float) -> float:
+        # Time to wait until the oldest debits leave the window and free `amount`, 0 if it's free already.
+        now_s = time.monotonic()
+        self._expire(now_s)
+        excess = self.total + min(amount, self.budget) - self.budget
+        for debit in self.debits:
+            if excess <= 0:
+                break
+            excess -= debit.amount
+            if excess <= 0:
+                return debit.time_s + self.window_s - now_s
+        return 0.0
+
+    def debit(self, amount: float) -> _Debit:
+        now_s = time.monotonic()
+        self._expire(now_s)
+        debit = _Debit(now_s, amount)
+        self.debits.append(debit)
+        self.total += amount
+        return debit
+
+    def correct(self, debit: Optional[_Debit], delta: float):
+        now_s = time.monotonic()
+        self._expire(now_s)
+        if debit is None or now_s - debit.time_s >= self.window_s:
+            # The debit has left the window: nothing to give back, an extra cost counts from now
+            if delta > 0:
+                self.debit(delta)
+            return
+        delta = max(delta, -debit.amount)
+        debit.amount += delta
+        self.total += delta
+
+
+@dataclasses.dataclass(eq=False)
+class _Job:
+    routine: Awaitable
+    future: asyncio.Future
+    token_cost: int = 0
+    user_id: Optional[Hashable] = None
+    priority: Priority = Priority.INTERACTIVE
+    enqueued_s: float = dataclasses.field(default_factory=time.monotonic)
+    # time.monotonic() past which the routine is not worth starting
+    deadline_s: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    started_s: Optional[float] = None
+    token_debit: Optional[_Debit] = None
+
+
+class FairQueue:
+    """
+    Deficit round robin over users: every user with pending jobs gets `quantum` jobs per round,
+    so one user's big batch can't starve the others.
+    """
+
+    def __init__(self, quantum: float = 1.0):
+        self.quantum = quantum
+        self.queues: Dict[Hashable, Deque[_Job]] = collections.OrderedDict()
+        self.deficits: Dict[Hashable, float] = dict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, job: _Job):
+        if job.user_id not in self.queues:
+            self.queues[job.user_id] = collections.deque()
+            self.deficits[job.user_id] = 0.0
+        self.queues[job.user_id].append(job)
+        self.size += 1
+
+    def _current_user(self) -> Hashable:
+        # Rotates the round until the user at the front may send a job
+        while True:
+            user_id = next(iter(self.queues))
+            if self.deficits[user_id] >= 1.0:
+                return user_id
+            self.deficits[user_id] += self.quantum
+            if self.deficits[user_id] < 1.0:
+                self.queues.move_to_end(user_id)
+
+    def peek(self) -> Optional[_Job]:
+        if self.size == 0:
+            return None
+        return self.queues[self._current_user()][0]
+
+    def pop(self) -> Optional[_Job]:
+        if self.size == 0:
+            return None
+        user_id = self._current_user()
+        job = self.queues[user_id].popleft()
+        self.deficits[user_id] -= 1.0
+        self.size -= 1
+        if not self.queues[user_id]:
+            self._forget(user_id)
+        elif self.deficits[user_id] < 1.0:
+            self.queues.move_to_end(user_id)
+        return job
+
+    def remove(self, job: _Job) -> bool:
+        queue = self.queues.get(job.user_id, None)
+        if queue is None or job not in queue:
+            return False
+        queue.remove(job)
+        self.size -= 1
+        if not queue:
+            self._forget(job.user_id)
+        return True
+
+    def _forget(self, user_id: Hashable):
+        self.queues.pop(user_id)
+        self.deficits.pop(user_id)
+
+    def user_size(self, user_id: Hashable) -> int:
+        queue = self.queues.get(user_id, None)
+        return 0 if queue is None else len(queue)
+
+    def user_jobs(self, user_id: Hashable) -> List[_Job]:
+        return list(self.queues.get(user_id, []))
+
+    def oldest_enqueued_s(self) -> float:
+        return min(queue[0].enqueued_s for queue in self.queues.values())
+
+    def jobs_ahead(self, user_id: Hashable) -> int:
+        # Each round serves one job per user, so until the user's last job goes out,
+        # every other user sends at most as many jobs as the user has pending.
+        own = max(1, self.user_size(user_id))
+        return sum(
+            min(len(queue), own)
+            for other_id, queue in self.queues.items()
+            if other_id != user_id
+        )
+
+
+class PriorityFairQueue:
+    """
+    A FairQueue per priority class. The most urgent class goes first,
+    but waiting ages a class up by one level every `aging_s`, so batch jobs can't starve.
+    Aging lifts a class up to the top level at most: classes on the same level take turns,
+    so an old backlog shares the dispatches with new interactive jobs instead of going ahead of them.
+    """
+
+    def __init__(self, aging_s: float = DEFAULT_AGING_S):
+        self.aging_s = aging_s
+        self.classes: Dict[Priority, FairQueue] = {
+            priority: FairQueue()
+            for priority in sorted(Priority)
+        }
+        # Pop count at the last dispatch of each class, to take turns
+        self.pops = 0
+        self.served: Dict[Priority, int] = {priority: -1 for priority in self.classes}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.classes.values())
+
+    def push(self, job: _Job):
+        self.classes[job.priority].push(job)
+
+    def _current_class(self, now_s: float) -> Optional[Priority]:
+        best_priority, best_key = None, None
+        for priority, queue in self.classes.items():
+            if not queue:
+                continue
+            oldest_enqueued_s = queue.oldest_enqueued_s()
+            level = max(0.0, priority - (now_s - oldest_enqueued_s) / self.aging_s)
+            # Same level: the class served longer ago, then the one waiting longer
+            key = (level, self.served[priority], oldest_enqueued_s)
+            if best_key is None or key < best_key:
+                best_priority, best_key = priority, key
+        return best_priority
+
+    def peek(self, now_s: float) -> Optional[_Job]:
+        priority = self._current_class(now_s)
+        return None if priority is None else self.classes[priority].peek()
+
+    def pop(self, now_s: float) -> Optional[_Job]:
+        priority = self._current_class(now_s)
+        if priority is None:
+            return None
+        self.served[priority] = self.pops
+        self.pops += 1
+        return self.classes[priority].pop()
+
+    def remove(self, job: _Job) -> bool:
+        return self.classes[job.priority].remove(job)
+
+    def user_size(self, user_id: Hashable) -> int:
+        return sum(queue.user_size(user_id) for queue in self.classes.values())
 
-        end_time_s = time.time()
-        delta_s = end_time_s - start_time_s
+    def user_jobs(self, user_id: Hashable) -> List[_Job]:
+        return [job for queue in self.classes.values() for job in queue.user_jobs(user_id)]
+
+    def jobs_ahead(self, user_id: Hashable, priority: Priority) -> int:
+        # Aging of the lower classes is not taken into account
+        ahead = 0
+        for other_priority, queue in self.classes.items():
+            if other_priority < priority:
+                ahead += len(queue)
+            elif other_priority == priority:
+                ahead += queue.jobs_ahead(user_id)
+        return ahead
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: grows by one per `limit` successful routines while the limit is used
+    and latency stays flat, and is cut by `backoff` on overload errors (429/5xx) or latency growth.
+    Latency is compared as a short-term average against a slow-moving baseline,
+    so a single long request doesn't look like congestion.
+    """
+
+    def __init__(self,
+                 initial: int,
+                 min_limit: int = 1,
+                 max_limit: int = DEFAULT_MAX_CONCURRENCY * 4,
+                 backoff: float = AIMD_BACKOFF,
+                 latency_tolerance: float = AIMD_LATENCY_TOLERANCE):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.latency_s: Optional[float] = None
+        self.baseline_latency_s: Optional[float] = None
+        self.last_decrease_s = float('-inf')
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def on_success(self, latency_s: float, in_flight: int):
+        if self.latency_s is None:
+            self.latency_s = self.baseline_latency_s = latency_s
+        else:
+            self.latency_s += AIMD_SHORT_ALPHA * (latency_s - self.latency_s)
+            self.baseline_latency_s += AIMD_BASELINE_ALPHA * (latency_s - self.baseline_latency_s)
+
+        if self.latency_s > self.baseline_latency_s * self.latency_tolerance:
+            self._decrease()
+        elif in_flight >= self.current_limit - 1 and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.increases += 1
+
+    def on_overload(self):
+        self._decrease()
+
+    def _decrease(self):
+        # Routines started before the last decrease report the same congestion, don't count them twice
+        now_s = time.monotonic()
+        if now_s - self.last_decrease_s < (self.latency_s or 1.0):
+            return
+        self.limit = max(float(self.min_limit), self.limit * self.backoff)
+        self.last_decrease_s = now_s
+        self.decreases += 1
+        if self.latency_s is not None:
+            # Partly accept the current latency as normal, otherwise a provider that got slower for good
+            # would be pushed down to min_limit
+            self.baseline_latency_s = (self.baseline_latency_s + self.latency_s) / 2.0
+
+
+@dataclasses.dataclass
+class QueueStatus:
+    jobs_ahead: int
+    own_pending: int
+    eta_s: Optional[float]
 
-        if delta_s < time_range_s:
-            sleep_for = time_range_s - delta_s
-            await asyncio.sleep(sleep_for)
 
 class RateLimiter:
+    """
+    Starts at most `rate_limit` routines per `time_range_s` (token bucket, bursts up to `burst`, `rate_limit` by default)
+    and keeps at most `max_concurrency` of them running at once, or as many as `adaptive_concurrency` allows.
+    With `tokens_per_minute` set, routines also pay their `token_cost` from an LLM token budget
+    that holds for any window of TOKEN_WINDOW_S (see SlidingWindowBudget).
+    Pending routines are dispatched by priority class and fairly between users (see PriorityFairQueue).
+    """
 
     def __init__(self,
                  rate_limit: int        = DEFAULT_RATE_LIMIT,
                  time_range_s: float    = DEFAULT_TIMERANGE_S,
-                 queue_max_size: int    = DEFAULT_QUEUE_SIZE):
+                 burst: Optional[int]   = None,
+                 queue_max_size: int    = DEFAULT_QUEUE_SIZE,
+                 max_concurrency: int   = DEFAULT_MAX_CONCURRENCY,
+                 tokens_per_minute: Optional[int] = None,
+                 aging_s: float         = DEFAULT_AGING_S,
+                 adaptive_concurrency: Optional[AdaptiveConcurrency] = None,
+                 is_overload: Optional[Callable[[BaseException], bool]] = None):
         self.rate_limit = rate_limit
         self.time_range_s = time_range_s
         self.queue_max_size = queue_max_size
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.adaptive_concurrency = adaptive_concurrency
+        self.is_overload = is_overload
+
+        self.bucket = TokenBucket(rate_limit / time_range_s, burst or rate_limit)
+        self.token_budget = None
+        if tokens_per_minute is not None:
+            self.token_budget = SlidingWindowBudget(tokens_per_minute, TOKEN_WINDOW_S)
+        self.pending = PriorityFairQueue(aging_s)
+        self.running: Set[_Job] = set()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.dispatcher = None
 
-        self.queue = asyncio.Queue(self.queue_max_size)
-        self.tasks = None
+        self.started = 0
+        self.completed = 0
+        self.completion_times_s: Deque[float] = collections.deque()
+        self.latency_s: Optional[float] = None
 
     async def start_if_not(self):
-        if self.tasks is None:
-            self.tasks = [
-                asyncio.create_task(worker(f'worker-{i}', self.queue, self.time_range_s))
-                for i in range(self.rate_limit)
-            ]
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+    def _has_work(self) -> bool:
+        return len(self.pending) > 0 or len(self.running) > 0
+
+    @property
+    def concurrency_limit(self) -> int:
+        if self.adaptive_concurrency is not None:
+            return self.adaptive_concurrency.current_limit
+        return self.max_concurrency
+
+    async def _dispatch(self):
+        while True:
+            self.wakeup.clear()
+            if not self._has_work():
+                self.idle.set()
+            if not self.pending or len(self.running) >= self.concurrency_limit:
+                await self.wakeup.wait()
+                continue
+            now_s = time.monotonic()
+            job = self.pending.peek(now_s)
+            if job.deadline_s is not None and now_s >= job.deadline_s:
+                # Its submitter is timing out right now, the routine would run for nobody
+                self.pending.remove(job)
+                job.routine.close()
+                if not job.future.done():
+                    job.future.set_exception(TimeoutError())
+                continue
+            delay_s = self.bucket.delay_s()
+            if self.token_budget is not None:
+                delay_s = max(delay_s, self.token_budget.delay_s(job.token_cost))
+            if delay_s > 0:
+                await asyncio.sleep(delay_s)
+                continue
+            self.bucket.consume()
+            if self.token_budget is not None:
+                job.token_debit = self.token_budget.debit(job.token_cost)
+            self.pending.pop(now_s)
+            self.running.add(job)
+            self.started += 1
+            job.task = asyncio.create_task(self._run(job))
+            job.task.add_done_callback(functools.partial(self._job_done, job))
 
-    def send_task(self, routine):
+    async def _run(self, job: _Job):
+        job.started_s = time.monotonic()
         try:
-            self.queue.put_nowait(routine)
-            return True
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            traceback.print_exception(exc_type, exc_value, exc_traceback)
-            return False
+            result = await job.routine
+            if self.adaptive_concurrency is not None:
+                self.adaptive_concurrency.on_success(time.monotonic() - job.started_s, len(self.running))
+            if not job.future.done():
+                job.future.set_result(result)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            if self.adaptive_concurrency is not None and self.is_overload is not None and self.is_overload(e):
+                self.adaptive_concurrency.on_overload()
 
-    async def submit(self, routine):
-        await self.start_if_not()
-        result = []
-        event = asyncio.Event()
-        async def task_wrapper():
-            try:
-                response = await routine
-                result.append(response)
-            except:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exception(exc_type, exc_value, exc_traceback)
-            event.set()
-        self.send_task(task_wrapper())
-
-        await event.wait()
-        if len(result) == 1:
-            return result[0]
+    def _job_done(self, job: _Job, task: asyncio.Task):
+        # A done callback rather than a `finally` in _run: a task cancelled before its first step
+        # never runs _run at all, and its slot must be freed all the same
+        if job.started_s is None:
+            job.routine.close()
+            if not job.future.done():
+                job.future.cancel()
+        else:
+            self._record_completion(job.started_s)
+        self.running.discard(job)
+        self.completed += 1
+        self.wakeup.set()
+        if not self._has_work():
+            self.idle.set()
+
+    def _record_completion(self, start_s: float):
+        now_s = time.monotonic()
+        self.completion_times_s.append(now_s)
+        latency_s = now_s - start_s
+        if self.latency_s is None:
+            self.latency_s = latency_s
         else:
+            self.latency_s += LATENCY_EWMA_ALPHA * (latency_s - self.latency_s)
+
+    def service_rate(self) -> Optional[float]:
+        # Completed routines per second over the last SERVICE_RATE_WINDOW_S
+        now_s = time.monotonic()
+        while self.completion_times_s and now_s - self.completion_times_s[0] > SERVICE_RATE_WINDOW_S:
+            self.completion_times_s.popleft()
+        if len(self.completion_times_s) < 2:
+            return None
+        window_s = now_s - self.completion_times_s[0]
+        if window_s <= 0:
             return None
+        return len(self.completion_times_s) / window_s
+
+    def queue_status(self, user_id: Optional[Hashable] = None, priority: Priority = Priority.BATCH) -> QueueStatus:
+        jobs_ahead = self.pending.jobs_ahead(user_id, priority)
+        own_pending = self.pending.user_size(user_id)
+        rate = self.service_rate()
+        eta_s = None
+        if rate is not None:
+            eta_s = (jobs_ahead + own_pending) / rate + (self.latency_s or 0.0)
+        return QueueStatus(jobs_ahead=jobs_ahead, own_pending=own_pending, eta_s=eta_s)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            'concurrency_limit': self.concurrency_limit,
+            'running': len(self.running),
+            'pending': len(self.pending),
+            'started': self.started,
+            'completed': self.completed,
+            'service_rate': self.service_rate(),
+            'latency_s': self.latency_s,
+        }
+        if self.adaptive_concurrency is not None:
+            stats['concurrency_increases'] = self.adaptive_concurrency.increases
+            stats['concurrency_decreases'] = self.adaptive_concurrency.decreases
+        if self.token_budget is not None:
+            stats['tokens_available'] = self.token_budget.available
+        return stats
+
+    def check_capacity(self, size: int = 1):
+        if len(self.pending) + size > self.queue_max_size:
+            raise QueueOverflowError(
+                f'Rate limiter queue is over capacity: {len(self.pending)} pending, '
+                f'{size} more requested, {self.queue_max_size} allowed'
+            )
+
+    def adjust_tokens(self, delta: int):
+        # Corrects the token budget once the real cost of a routine is known.
+        # Called from the routine itself, the correction goes to the routine's own debit.
+        if self.token_budget is None:
+            return
+        current_task = asyncio.current_task()
+        job = next((job for job in self.running if job.task is current_task), None)
+        self.token_budget.correct(None if job is None else job.token_debit, delta)
 
-    async def submit_batch(self, routine_batch):
+    def send_task(self,
+                  routine: Awaitable,
+                  token_cost: int = 0,
+                  user_id: Optional[Hashable] = None,
+                  priority: Priority = Priority.INTERACTIVE,
+                  deadline_s: Optional[float] = None) -> _Job:
+        try:
+            self.check_capacity()
+        except QueueOverflowError:
+            routine.close()
+            raise
+        job = _Job(
+            routine=routine,
+            future=asyncio.get_running_loop().create_future(),
+            token_cost=token_cost,
+            user_id=user_id,
+            priority=priority,
+            deadline_s=deadline_s
+        )
+        self.pending.push(job)
+        self.idle.clear()
+        self.wakeup.set()
+        return job
+
+    def _cancel_job(self, job: _Job):
+        job.future.cancel()
+        if job.task is not None:
+            job.task.cancel()
+        elif self.pending.remove(job):
+            job.routine.close()
+            self.wakeup.set()
+
+    def cancel_user(self, user_id: Hashable) -> int:
+        # Drops the user's pending routines and cancels the running ones, their submitters get CancelledError
+        jobs = self.pending.user_jobs(user_id) + [job for job in self.running if job.user_id == user_id]
+        for job in jobs:
+            self._cancel_job(job)
+        return len(jobs)
+
+    async def submit(self,
+                     routine: Awaitable,
+                     token_cost: int = 0,
+                     user_id: Optional[Hashable] = None,
+                     priority: Priority = Priority.INTERACTIVE,
+                     deadline_s: Optional[float] = None) -> Any:
+        # Past deadline_s (time.monotonic()) the routine is dropped or cancelled and TimeoutError is raised
         await self.start_if_not()
-        batch = [self.submit(routine) for routine in routine_batch]
+        job = self.send_task(routine, token_cost, user_id, priority, deadline_s)
+        try:
+            if deadline_s is None:
+                return await job.future
+            return await asyncio.wait_for(job.future, max(0.0, deadline_s - time.monotonic()))
+        except (asyncio.CancelledError, TimeoutError):
+            self._cancel_job(job)
+            raise
+
+    async def submit_batch(self,
+                           routine_batch,
+                           user_id: Optional[Hashable] = None,
+                           priority: Priority = Priority.BATCH):
+        await self.start_if_not()
+        try:
+            self.check_capacity(len(routine_batch))
+        except QueueOverflowError:
+            for routine in routine_batch:
+                routine.close()
+            raise
+        batch = [self.submit(routine, user_id=user_id, priority=priority) for routine in routine_batch]
         return await asyncio.gather(*batch)
 
     async def close(self):
-        await self.queue.join()
-        if self.tasks is not None:
-            for task in self.tasks:
-                task.cancel()
-            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.idle.wait()
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+            self.dispatcher = None
+
+
+@dataclasses.dataclass
+class BatchProgress:
+    batches_ahead: int
+    done: int
+    total: int
+    queue_status: Optional[QueueStatus] = None
 
 
 class RateLimitedBatchQueue:
+    # Batch bookkeeping only: each routine of a batch is rate limited
+    # by the limiter of the LLM it calls (see LLMManager.get_rate_limiter).
 
-    def __init__(self, rate_limiter: RateLimiter):
-        self.rate_limiter = rate_limiter
+    def __init__(self, progress_interval_s: float = BATCH_PROGRESS_INTERVAL_S):
+        self.progress_interval_s = progress_interval_s
         self.batches = 0
         self.resolved_batches = 0
 
-    async def add_batch_task(self, routine_batch, notify_batches_ahead = None):
-        batch_id = self.batches
+    async def add_batch_task(self,
+                             routine_batch,
+                             rate_limiter: Optional[RateLimiter] = None,
+                             user_id: Optional[Hashable] = None,
+                             notify_progress = None):
+        """
+        Runs the batch, calling `notify_progress(BatchProgress)` right away
+        and then every `progress_interval_s` until the batch is resolved.
+        `rate_limiter` is the limiter the routines go through, it is used to report the queue position.
+        """
+        if rate_limiter is not None:
+            try:
+                rate_limiter.check_capacity(len(routine_batch))
+            except QueueOverflowError:
+                for routine in routine_batch:
+                    routine.close()
+                raise
+
         batches_ahead = self.batches - self.resolved_batches
         self.batches += 1
-        if notify_batches_ahead is not None:
-            await notify_batches_ahead(batches_ahead)
-        result = await self.rate_limiter.submit_batch(routine_batch)
-        self.resolved_batches += 1
-        return result
\ No newline at end of file
+        done = 0
+
+        async def track(routine):
+            nonlocal done
+            try:
+                return await routine
+            finally:
+                done += 1
+
+        def progress() -> BatchProgress:
+            queue_status = None
+            if rate_limiter is not None:
+                queue_status = rate_limiter.queue_status(user_id, Priority.BATCH)
+            return BatchProgress(
+                batches_ahead=batches_ahead,
+                done=done,
+                total=len(routine_batch),
+                queue_status=queue_status
+            )
+
+        gathered = asyncio.ensure_future(asyncio.gather(*[track(routine) for routine in routine_batch]))
+        try:
+            if notify_progress is not None:
+                await notify_progress(progress())
+                while not gathered.done():
+                    await asyncio.wait([gathered], timeout=self.progress_interval_s)
+                    if not gathered.done():
+                        await notify_progress(progress())
+            return await gathered
+        finally:
+            if not gathered.done():
+                gathered.cancel()
+                # Nobody awaits it anymore, its CancelledError mustn't be reported as never retrieved
+                gathered.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self.resolved_batches += 1
@@ -0,0 +1,58 @@
+import functools
+import weakref
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional
+
+from core.utils import PathLike, from_txt_file
+from jinja2 import Environment, FileSystemLoader
+
+if TYPE_CHECKING:
+    from core.task import PromptTask
+
+TEMPLATES_DIR = 'templates'
+TEMPLATES = ['short_task.txt', 'full_task.txt']
+STATIC_TEXTS = ['greetings.txt', 'help.txt']
+
+
+class TemplateRenderer:
+    """
+    Templates compiled once and texts kept in memory, so that the commands don't touch the disk.
+
+    Task descriptions are cached per task object and focused snippet. A catalog reload creates
+    new task objects, so the descriptions of the old ones go away together with them.
+    """
+
+    def __init__(self, templates_dir: PathLike = TEMPLATES_DIR):
+        self.templates_dir = Path(templates_dir)
+        # No auto reload: a compiled template is never checked against its file again
+        self.env = Environment(loader=FileSystemLoader(self.templates_dir), auto_reload=False, cache_size=-1)
+        for name in TEMPLATES:
+            self.env.get_template(name)
+        self.texts: Dict[str, str] = {
+            name: from_txt_file(self.templates_dir / name)
+            for name in STATIC_TEXTS
+        }
+        self.descriptions: 'weakref.WeakKeyDictionary[PromptTask, Dict[Optional[str], str]]' = \
+            weakref.WeakKeyDictionary()
+
+    def static_text(self, name: str) -> str:
+        if name not in self.texts:
+            self.texts[name] = from_txt_file(self.templates_dir / name)
+        return self.texts[name]
+
+    def render(self, name: str, **context) -> str:
+        return self.env.get_template(name).render(**context)
+
+    def short_description(self, task: 'PromptTask', snippet: str = None) -> str:
+        descriptions = self.descriptions.setdefault(task, dict())
+        if snippet not in descriptions:
+            descriptions[snippet] = self.render('short_task.txt', **task.short_description_context(snippet))
+        return descriptions[snippet]
+
+    def full_description(self, task: 'PromptTask') -> str:
+        return self.render('full_task.txt', **task.full_description_context())
+
+
+@functools.cache
+def default_renderer() -> TemplateRenderer:
+    return TemplateRenderer()
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class _Flight:
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one underlying task.
+
+    The task is shared by reference counting: a waiter leaving (e.g. cancelled)
+    doesn't affect the others, and the task is cancelled only once nobody waits for it.
+    """
+
+    def __init__(self):
+        self.flights: Dict[Hashable, _Flight] = dict()
+
+    def __len__(self):
+        return len(self.flights)
+
+    def waiters(self, key: Hashable) -> int:
+        flight = self.flights.get(key, None)
+        return 0 if flight is None else flight.waiters
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self.flights.get(key, None) is flight:
+            self.flights.pop(key)
+
+    async def do(self, key: Hashable, routine_factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self.flights.get(key, None)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(routine_factory()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
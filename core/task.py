@@ -1,19 +1,29 @@
+import functools
+import types
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Mapping, Optional
 
+from core.bundle import BUNDLE_NAME, TaskBundle
 from core.matcher import AvgIoUMatcher, matcher_from_name
+from core.rendering import default_renderer
 from core.transform_pipe import TransformPipe
 from core.utils import from_json_file, from_txt_file, PathLike, html_escape, html_escape_obj
-from jinja2 import Environment, FileSystemLoader
 
 
 class PromptTask:
 
-    def __init__(self, task_dir: PathLike):
+    def __init__(self, task_dir: PathLike, use_bundle: bool = True):
         self.task_dir = Path(task_dir)
 
         self.task_info_pth = self.task_dir / 'info.json'
-        self.task_info = from_json_file(self.task_info_pth)
+        # The compiled bundle (see helpers/compile_tasks.py) is read instead of the directory when there is one
+        bundle_pth = self.task_dir / BUNDLE_NAME
+        self.bundle: Optional[TaskBundle] = None
+        if use_bundle and bundle_pth.exists():
+            self.bundle = TaskBundle(bundle_pth)
+            self.task_info = self.bundle.task_info
+        else:
+            self.task_info = from_json_file(self.task_info_pth)
 
         reply_pipe_config = self.task_info['reply_pipe']
         self.reply_pipe = TransformPipe(reply_pipe_config, answer_type=self.answer_type)
@@ -24,8 +34,15 @@ class PromptTask:
     def get_matcher(self):
         return matcher_from_name(self.task_info['matcher'])
 
-    @property
+    def preload(self):
+        # Reads all the files of the task, so that nothing is read later.
+        # A bundle is mapped already, its snippets are decoded when asked for.
+        _ = self.sample_prompt, self.open_snippets, self.hidden_snippets
+
+    @functools.cached_property
     def sample_prompt(self) -> str:
+        if self.bundle is not None:
+            return self.bundle.sample_prompt()
         prompt_pth = self.task_dir / self.task_info["sample_prompt_pth"]
         return from_txt_file(prompt_pth)
 
@@ -53,21 +70,33 @@ class PromptTask:
     def description(self):
         return self.task_info['description']
 
-    @property
-    def open_snippets(self) -> Dict:
-        return self.get_snippets('open_snippets')
+    @functools.cached_property
+    def open_snippets(self) -> Mapping:
+        if self.bundle is not None:
+            return self.bundle.snippets('open_snippets')
+        return types.MappingProxyType(self.get_snippets('open_snippets'))
 
-    @property
-    def hidden_snippets(self) -> Dict:
-        return self.get_snippets('hidden_snippets')
+    @functools.cached_property
+    def hidden_snippets(self) -> Mapping:
+        if self.bundle is not None:
+            return self.bundle.snippets('hidden_snippets')
+        return types.MappingProxyType(self.get_snippets('hidden_snippets'))
 
     @property
     def llm(self) -> str:
         return self.task_info.get('llm', None)
 
-    def short_description(self, snippet: str = None) -> str:
-        env = Environment(loader=FileSystemLoader('templates'))
-        template = env.get_template('short_task.txt')
+    @property
+    def cache_responses(self) -> bool:
+        # Tasks relying on non-deterministic sampling may opt out with "cache_responses": false.
+        return self.task_info.get('cache_responses', True)
+
+    @property
+    def allow_fallback(self) -> bool:
+        # Whether scored runs may take a hedged answer from the fallback LLM of the task's LLM.
+        return self.task_info.get('allow_fallback', False)
+
+    def short_description_context(self, snippet: str = None) -> Dict:
         open_snippets = {
             k: html_escape_obj(obj)
             for k, obj in self.open_snippets.items()
@@ -77,7 +106,7 @@ class PromptTask:
             new_open_snippets ={f'[FOCUS] {snippet}': obj}
             new_open_snippets.update(open_snippets)
             open_snippets = new_open_snippets
-        return template.render(
+        return dict(
             id=self.id,
             title=html_escape(self.title),
             description=html_escape(self.description),
@@ -86,10 +115,8 @@ class PromptTask:
             llm=self.llm
         )
 
-    def __repr__(self) -> str:
-        env = Environment(loader=FileSystemLoader('templates'))
-        template = env.get_template('full_task.txt')
-        return template.render(
+    def full_description_context(self) -> Dict:
+        return dict(
             id=self.id,
             title=html_escape(self.title),
             description=html_escape(self.description),
@@ -105,6 +132,12 @@ class PromptTask:
             llm=self.llm
         )
 
+    def short_description(self, snippet: str = None) -> str:
+        return default_renderer().short_description(self, snippet)
+
+    def __repr__(self) -> str:
+        return default_renderer().full_description(self)
+
     def get_snippets(self, snippet_type):
         result = dict()
         for snippet in self.task_info[snippet_type]:
@@ -1,46 +1,107 @@
 import argparse
+import asyncio
+import dataclasses
+import types
+from collections import defaultdict
+from logging import Logger
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Mapping, Set, Tuple
 
+from core.bundle import BUNDLE_NAME
 from core.task import PromptTask
-from core.utils import from_json_file
+
+DEFAULT_WATCH_INTERVAL_S = 5.0
+
+
+@dataclasses.dataclass(frozen=True)
+class TaskCatalog:
+    # Exposed tasks, loaded with all their snippets. Replaced as a whole when the files change.
+    tasks: Mapping[str, PromptTask]
+    task_pths: Mapping[str, Path]
+    # Files of data_root with their modification times, to tell when to reload
+    signature: Tuple
 
 
 class TaskManager:
 
     def __init__(self, args: argparse.Namespace):
         self.data_root = Path(args.data_root)
+        self.catalog = self.load_catalog()
+
+    def data_signature(self) -> Tuple:
+        signature = []
+        for pth in self.data_root.rglob('*'):
+            if pth.is_file():
+                stat = pth.stat()
+                signature.append((str(pth), stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(signature))
+
+    @staticmethod
+    def fresh_bundles(signature: Tuple) -> Set[Path]:
+        # Task dirs whose bundle is newer than every other file of the task.
+        # An edited task is read from the directory until the bundle is compiled again.
+        bundle_mtimes = dict()
+        source_mtimes = defaultdict(int)
+        for pth, mtime_ns, _ in signature:
+            pth = Path(pth)
+            if pth.name == BUNDLE_NAME:
+                bundle_mtimes[pth.parent] = mtime_ns
+            else:
+                for parent in pth.parents:
+                    source_mtimes[parent] = max(source_mtimes[parent], mtime_ns)
+        return {
+            task_dir for task_dir, mtime_ns in bundle_mtimes.items()
+            if mtime_ns >= source_mtimes[task_dir]
+        }
+
+    def load_catalog(self) -> TaskCatalog:
+        signature = self.data_signature()
+        fresh_bundles = self.fresh_bundles(signature)
+        tasks = dict()
+        task_pths = dict()
+        for task_dir in sorted(self.data_root.glob('*')):
+            task_pth = task_dir / 'info.json'
+            if not task_pth.exists():
+                continue
+            task = PromptTask(task_dir, use_bundle=task_dir in fresh_bundles)
+            if not task.task_info.get('exposed', True):
+                continue
+            task.preload()
+            tasks[task.id] = task
+            task_pths[task.id] = task_pth
+        return TaskCatalog(
+            tasks=types.MappingProxyType(tasks),
+            task_pths=types.MappingProxyType(task_pths),
+            signature=signature
+        )
+
+    async def watch(self, logger: Logger, interval_s: float = DEFAULT_WATCH_INTERVAL_S):
+        # Polls the modification times and swaps in a new catalog when something changed.
+        # Commands keep using the catalog they got, no file is read on their path.
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                signature = await asyncio.to_thread(self.data_signature)
+                if signature == self.catalog.signature:
+                    continue
+                self.catalog = await asyncio.to_thread(self.load_catalog)
+                logger.info(f'task catalog reloaded: {len(self.catalog.tasks)} tasks')
+            except Exception as e:
+                # A task may be caught in the middle of an update, the next poll tries again
+                logger.warning(f'task catalog reload failed: {type(e).__name__}: {e}')
+
+    def get_task_id_map(self) -> Mapping[str, Path]:
+        return self.catalog.task_pths
 
-    def get_task_id_map(self):
-        task_conf_list = [
-            task_dir / 'info.json'
-            for task_dir in self.data_root.glob('*')
-            if (task_dir / 'info.json').exists()
-        ]
-        task_map = dict()
-        for task_pth in task_conf_list:
-            task_obj = from_json_file(task_pth)
-            if task_obj.get('exposed', True):
-                task_map[task_obj['id']] = task_pth
-        return task_map
-
-    def fetch_task_conf_list(self):
-        task_pths = [
-            task_dir / 'info.json'
-            for task_dir in self.data_root.glob('*')
-            if (task_dir / 'info.json').exists()
-        ]
-        task_objs = [from_json_file(task_pth) for task_pth in task_pths]
-        task_objs = [obj for obj in task_objs if obj.get('exposed', True)]
-        return task_objs
+    def fetch_task_conf_list(self) -> List[Dict]:
+        return [task.task_info for task in self.catalog.tasks.values()]
 
     def get_current_task(self, task_id: str) -> PromptTask:
-        task_pth = self.get_task_id_map()[task_id]
-        return PromptTask(Path(task_pth).parent)
+        return self.catalog.tasks[task_id]
 
     def search_tasks(self, search_token: str) -> List[str]:
         choices = []
-        for idd, pth in self.get_task_id_map().items():
+        for idd in self.catalog.tasks:
             if search_token in idd:
                 choices.append(idd)
         return choices
@@ -0,0 +1,100 @@
+import time
+import unittest
+from unittest import mock
+
+import httpx
+from openai import APIConnectionError, BadRequestError, RateLimitError
+
+from core.ai import CircuitBreaker, CircuitOpenError, call_with_retries, retry_delay_s
+
+REQUEST = httpx.Request('POST', 'http://llm.test/chat/completions')
+
+
+def rate_limit_error(retry_after: str = None) -> RateLimitError:
+    headers = {} if retry_after is None else {'retry-after': retry_after}
+    response = httpx.Response(429, request=REQUEST, headers=headers)
+    return RateLimitError('slow down', response=response, body=None)
+
+
+def bad_request_error() -> BadRequestError:
+    response = httpx.Response(400, request=REQUEST)
+    return BadRequestError('bad request', response=response, body=None)
+
+
+class TestRetryDelay(unittest.TestCase):
+    def test_delay_is_capped(self):
+        for attempt in range(20):
+            self.assertLessEqual(retry_delay_s(APIConnectionError(request=REQUEST), attempt), 30.0)
+
+    def test_retry_after_is_honoured(self):
+        self.assertGreaterEqual(retry_delay_s(rate_limit_error('7'), 0), 7.0)
+
+
+@mock.patch('core.ai.RETRY_BASE_DELAY_S', 0.001)
+class TestCallWithRetries(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def flaky(self, failures: int, error_factory):
+        async def routine():
+            self.calls += 1
+            if self.calls <= failures:
+                raise error_factory()
+            return 'ok'
+        return routine
+
+    async def test_transient_errors_are_retried(self):
+        routine = self.flaky(2, lambda: APIConnectionError(request=REQUEST))
+        self.assertEqual(await call_with_retries(routine, max_retries=3), 'ok')
+        self.assertEqual(self.calls, 3)
+
+    async def test_retries_are_limited(self):
+        routine = self.flaky(10, rate_limit_error)
+        with self.assertRaises(RateLimitError):
+            await call_with_retries(routine, max_retries=2)
+        self.assertEqual(self.calls, 3)
+
+    async def test_bad_request_is_not_retried(self):
+        routine = self.flaky(10, bad_request_error)
+        with self.assertRaises(BadRequestError):
+            await call_with_retries(routine, max_retries=3)
+        self.assertEqual(self.calls, 1)
+
+    async def test_no_retry_past_deadline(self):
+        routine = self.flaky(10, lambda: APIConnectionError(request=REQUEST))
+        with self.assertRaises(TimeoutError):
+            await call_with_retries(routine, max_retries=5, deadline_s=time.monotonic() - 1.0)
+        self.assertEqual(self.calls, 1)
+
+    async def test_open_breaker_fails_fast(self):
+        breaker = CircuitBreaker('llm.test', failure_threshold=2, reset_timeout_s=60.0)
+        routine = self.flaky(10, lambda: APIConnectionError(request=REQUEST))
+        with self.assertRaises(CircuitOpenError):
+            await call_with_retries(routine, breaker=breaker, max_retries=5)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(breaker.state, 'open')
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker('llm.test', failure_threshold=1, reset_timeout_s=0.0)
+        breaker.on_failure()
+        self.assertEqual(breaker.state, 'half_open')
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.on_success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_call()
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker('llm.test', failure_threshold=1, reset_timeout_s=60.0)
+        breaker.on_failure()
+        breaker.opened_at_s -= 60.0
+        breaker.before_call()
+        breaker.on_failure()
+        self.assertEqual(breaker.state, 'open')
+
+
+if __name__ == "__main__":
+    unittest.main()
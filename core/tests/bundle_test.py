@@ -0,0 +1,43 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from core.bundle import BUNDLE_NAME, compile_task_bundle
+from core.task import PromptTask
+
+
+class TestTaskBundle(unittest.TestCase):
+    def setUp(self):
+        self.task_dir = Path(tempfile.mkdtemp()) / 'dates_en'
+        shutil.copytree('data/dates_en', self.task_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.task_dir.parent)
+
+    def test_bundle_matches_directory(self):
+        compile_task_bundle(self.task_dir)
+        bundled = PromptTask(self.task_dir)
+        plain = PromptTask(self.task_dir, use_bundle=False)
+        self.assertIsNotNone(bundled.bundle)
+        self.assertEqual(bundled.task_info, plain.task_info)
+        self.assertEqual(bundled.sample_prompt, plain.sample_prompt)
+        self.assertEqual(dict(bundled.open_snippets), dict(plain.open_snippets))
+        self.assertEqual(dict(bundled.hidden_snippets), dict(plain.hidden_snippets))
+
+    def test_snippets_are_decoded_without_reading_files(self):
+        compile_task_bundle(self.task_dir)
+        task = PromptTask(self.task_dir)
+        with mock.patch('builtins.open', side_effect=AssertionError('file read')):
+            snippet_id = next(iter(task.hidden_snippets))
+            self.assertIn('Task', task.hidden_snippets[snippet_id])
+            self.assertNotIn('missing', task.hidden_snippets)
+
+    def test_no_bundle_reads_directory(self):
+        self.assertFalse((self.task_dir / BUNDLE_NAME).exists())
+        self.assertIsNone(PromptTask(self.task_dir).bundle)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import logging
+import unittest
+from typing import Optional
+from unittest import mock
+
+from core.jobs import (
+    JOB_DONE, JOB_FAILED, JOB_PENDING, JOB_RUNNING, EvaluationJob, EvaluationJobStore, EvaluationWorkerPool
+)
+from core.llm_manager import LLMResponse
+from core.prompt_db import PromptDBManager
+from core.prompter import EvaluationStatus, PromptRunner
+from core.ratelimit import Priority, QueueOverflowError, RateLimitedBatchQueue, RateLimiter
+from core.task_management import TaskManager
+
+TASK_ID = 'dates_en'
+
+
+class FakeLLMs:
+    # Answers every snippet with its answer, counting the calls
+
+    default_llm = 'main'
+
+    def __init__(self, task):
+        self.answers = {snippet['Task']: snippet['Answer'] for snippet in task.hidden_snippets.values()}
+        self.calls = 0
+        self.rate_limiter = None
+
+    async def get_ai_response(self, prompt: str, **kwargs) -> LLMResponse:
+        self.calls += 1
+        return LLMResponse(' '.join(self.answers[prompt]))
+
+    def get_rate_limiter(self, llm_name):
+        return self.rate_limiter
+
+
+class LimitedLLMs(FakeLLMs):
+    # Answers one snippet at a time through a real rate limiter
+
+    def __init__(self, task):
+        super().__init__(task)
+        self.rate_limiter = RateLimiter(rate_limit=1000, max_concurrency=1)
+
+    async def get_ai_response(self, prompt: str, user_id=None, priority=Priority.INTERACTIVE, **kwargs) -> LLMResponse:
+        await self.rate_limiter.submit(asyncio.sleep(0.005), user_id=user_id, priority=priority)
+        return await super().get_ai_response(prompt)
+
+
+class TestEvaluationJobStore(unittest.TestCase):
+    def setUp(self):
+        self.store = EvaluationJobStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_unfinished_jobs(self):
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        self.store.set_status(job.job_id, JOB_RUNNING)
+        self.assertEqual([unfinished.job_id for unfinished in self.store.unfinished_jobs()], [job.job_id])
+        self.store.finish_job(job.job_id, JOB_DONE)
+        self.assertEqual(self.store.unfinished_jobs(), [])
+
+
+class TestResume(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.task_manager = TaskManager(argparse.Namespace(data_root='data'))
+        self.task = self.task_manager.get_current_task(TASK_ID)
+        self.llms = FakeLLMs(self.task)
+        self.sql_db = PromptDBManager(':memory:')
+        self.runner = PromptRunner(RateLimitedBatchQueue(), self.sql_db, self.llms)
+        self.store = EvaluationJobStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+        self.sql_db.close()
+
+    async def test_answered_snippets_are_not_asked_again(self):
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        first = await self.runner.compute_hidden_batch(
+            self.task, 'user1', 'prompt', on_answer=lambda evall: self.store.record_snippet(job.job_id, evall)
+        )
+        calls = self.llms.calls
+        again = await self.runner.compute_hidden_batch(
+            self.task, 'user1', 'prompt', answered=self.store.answered_snippets(job.job_id)
+        )
+        self.assertEqual(self.llms.calls, calls)
+        self.assertEqual(again.status, EvaluationStatus.OK)
+        self.assertEqual(again.score, first.score)
+        self.assertEqual([evall.snippet_id for evall in again.eval_list], list(self.task.hidden_snippets))
+
+    async def test_pool_resumes_unfinished_jobs(self):
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        answered = list(self.task.hidden_snippets)[:2]
+        for snippet_id in answered:
+            self.store.cursor.execute(
+                'INSERT INTO evaluation_job_snippets VALUES (?, ?, ?, 0, NULL)',
+                (job.job_id, snippet_id, ' '.join(self.task.hidden_snippets[snippet_id]['Answer']))
+            )
+        self.store.set_status(job.job_id, JOB_RUNNING)
+
+        delivered = asyncio.Queue()
+
+        async def deliver(job, result_batch):
+            await delivered.put((job, result_batch))
+
+        pool = EvaluationWorkerPool(self.store, self.runner, self.task_manager, logging.getLogger('test'))
+        await pool.start(deliver)
+        delivered_job, result_batch = await asyncio.wait_for(delivered.get(), 5.0)
+        await pool.stop(grace_s=1.0)
+
+        self.assertEqual(delivered_job.job_id, job.job_id)
+        self.assertEqual(delivered_job.status, JOB_DONE)
+        self.assertEqual(self.llms.calls, len(self.task.hidden_snippets) - len(answered))
+        self.assertEqual(result_batch.status, EvaluationStatus.OK)
+        self.assertEqual(self.store.unfinished_jobs(), [])
+
+    async def run_pool(self, job: Optional[EvaluationJob]) -> asyncio.Queue:
+        delivered = asyncio.Queue()
+
+        async def deliver(job, result_batch):
+            await delivered.put((job, result_batch))
+
+        self.pool = EvaluationWorkerPool(self.store, self.runner, self.task_manager, logging.getLogger('test'))
+        await self.pool.start(deliver)
+        return delivered
+
+    async def test_backlog_does_not_delay_other_users(self):
+        self.llms = LimitedLLMs(self.task)
+        self.runner = PromptRunner(RateLimitedBatchQueue(), self.sql_db, self.llms)
+        delivered = await self.run_pool(None)
+        for _ in range(4):
+            self.pool.submit('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        self.pool.submit('user2', 2, 'private', 20, TASK_ID, 'hidden', 'prompt')
+        order = []
+        for _ in range(5):
+            job, result_batch = await asyncio.wait_for(delivered.get(), 5.0)
+            self.assertEqual(result_batch.status, EvaluationStatus.OK)
+            order.append(job.user_id)
+        await self.pool.stop(grace_s=1.0)
+        await self.llms.rate_limiter.close()
+
+        # The snippets of both users take turns, user2 doesn't wait for the whole backlog of user1
+        self.assertLessEqual(order.index('user2'), 1)
+
+    async def test_batch_larger_than_queue_fails(self):
+        self.llms.rate_limiter = RateLimiter(queue_max_size=len(self.task.hidden_snippets) - 1)
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        delivered = await self.run_pool(job)
+        delivered_job, result_batch = await asyncio.wait_for(delivered.get(), 5.0)
+        await self.pool.stop(grace_s=1.0)
+
+        self.assertEqual(delivered_job.status, JOB_FAILED)
+        self.assertIsNotNone(delivered_job.error)
+        self.assertIsNone(result_batch)
+        self.assertEqual(self.llms.calls, 0)
+
+    async def test_overflow_retries_are_capped(self):
+        async def overflow(*args, **kwargs):
+            raise QueueOverflowError('full')
+
+        self.runner.compute_hidden_batch = overflow
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        with mock.patch('core.jobs.OVERFLOW_RETRY_DELAY_S', 0.0), mock.patch('core.jobs.OVERFLOW_MAX_RETRIES', 3):
+            delivered = await self.run_pool(job)
+            delivered_job, result_batch = await asyncio.wait_for(delivered.get(), 5.0)
+        await self.pool.stop(grace_s=1.0)
+
+        self.assertEqual(delivered_job.status, JOB_FAILED)
+        self.assertEqual(delivered_job.overflow_retries, 3)
+        self.assertIsNotNone(delivered_job.error)
+        self.assertEqual(self.store.unfinished_jobs(), [])
+
+    async def test_stop_cancels_retries(self):
+        async def overflow(*args, **kwargs):
+            raise QueueOverflowError('full')
+
+        self.runner.compute_hidden_batch = overflow
+        job = self.store.create_job('user1', 1, 'private', 10, TASK_ID, 'hidden', 'prompt')
+        await self.run_pool(job)
+        for _ in range(100):
+            if self.pool.retries:
+                break
+            await asyncio.sleep(0.01)
+        handle = self.pool.retries[job.job_id]
+        await self.pool.stop(grace_s=1.0)
+
+        self.assertTrue(handle.cancelled())
+        self.assertEqual(self.pool.retries, dict())
+        # Resumed on the next start
+        self.assertEqual([(unfinished.job_id, unfinished.status) for unfinished in self.store.unfinished_jobs()],
+                         [(job.job_id, JOB_PENDING)])
+
+
+if __name__ == "__main__":
+    unittest.main()
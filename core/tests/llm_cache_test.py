@@ -0,0 +1,51 @@
+import time
+import unittest
+
+from core.llm_cache import LLMResponseCache, response_cache_key
+
+
+class TestLLMResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LLMResponseCache(':memory:', memory_size=2, disk_size=10)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_key_depends_on_all_fields(self):
+        key = response_cache_key('deepseek', 'deepseek-chat', 'system', 'snippet', None)
+        self.assertEqual(key, response_cache_key('deepseek', 'deepseek-chat', 'system', 'snippet', None))
+        self.assertNotEqual(key, response_cache_key('deepseek', 'deepseek-chat', 'system', 'snippet', 0.5))
+        self.assertNotEqual(key, response_cache_key('local_mistral', 'mistral', 'system', 'snippet', None))
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', 'response')
+        self.assertEqual(self.cache.get('key'), 'response')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_memory_lru_falls_back_to_disk(self):
+        for idd in range(3):
+            self.cache.put(f'key{idd}', f'response{idd}')
+        self.assertNotIn('key0', self.cache.memory)
+        self.assertEqual(self.cache.get('key0'), 'response0')
+        self.assertIn('key0', self.cache.memory)
+
+    def test_disk_size_eviction(self):
+        for idd in range(11):
+            self.cache.put(f'key{idd}', f'response{idd}')
+        self.assertLessEqual(self.cache.disk_count, 10)
+        self.cache.memory.clear()
+        self.assertIsNone(self.cache.get('key0'))
+        self.assertEqual(self.cache.get('key10'), 'response10')
+
+    def test_ttl(self):
+        self.cache.put('key', 'response')
+        self.cache.ttl_s = 0.01
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.disk_count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
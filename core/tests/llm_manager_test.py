@@ -0,0 +1,374 @@
+import asyncio
+import os
+import tempfile
+import time
+import types
+import unittest
+
+import yaml
+from openai.types import CompletionUsage
+
+from core.llm_manager import DEFAULT_RPM_BURST, LatencyTracker, LLMManager, RequestCancelledError, rpm_bucket
+from core.ratelimit import DEFAULT_MAX_CONCURRENCY, DEFAULT_QUEUE_SIZE, DEFAULT_RATE_LIMIT, DEFAULT_TIMERANGE_S, Priority
+
+CONFIG = {
+    'default_llm': 'main',
+    'llms': {
+        'main': {
+            'baseurl': 'http://main.test/v1',
+            'api_key': 'test',
+            'model_name': 'main-model',
+            'rate_limit': {'rpm': 6000, 'max_concurrency': 10},
+            'hedge': {'percentile': 50, 'min_samples': 3, 'fallback': 'backup'},
+        },
+        'backup': {
+            'baseurl': 'http://backup.test/v1',
+            'api_key': 'test',
+            'model_name': 'backup-model',
+            'rate_limit': {'rpm': 6000, 'max_concurrency': 10},
+        },
+    },
+}
+
+
+class FakeCompletions:
+    # Answers with the model name after the given delays, one per call (the last one repeats)
+
+    def __init__(self, delays_s, report_usage=True):
+        self.delays_s = list(delays_s)
+        self.report_usage = report_usage
+        self.calls = 0
+        self.cancelled = 0
+        self.entered = asyncio.Event()
+
+    async def create(self, model, messages, temperature=None, stream=False, stream_options=None, timeout=None):
+        delay_s = self.delays_s[min(self.calls, len(self.delays_s) - 1)]
+        self.calls += 1
+        self.entered.set()
+        try:
+            await asyncio.sleep(delay_s)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if stream:
+            include_usage = self.report_usage and stream_options is not None and stream_options['include_usage']
+            return self.stream(model, include_usage)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=model))],
+            usage=None
+        )
+
+    async def stream(self, model, include_usage):
+        for token in model.split('-'):
+            yield types.SimpleNamespace(
+                choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=token))],
+                usage=None
+            )
+        if include_usage:
+            yield types.SimpleNamespace(
+                choices=[],
+                usage=CompletionUsage(prompt_tokens=20, completion_tokens=1000, total_tokens=1020)
+            )
+
+
+class FakeClient:
+
+    def __init__(self, delays_s, report_usage=True):
+        self.chat = types.SimpleNamespace(completions=FakeCompletions(delays_s, report_usage))
+
+    async def close(self):
+        pass
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_percentile_needs_samples(self):
+        tracker = LatencyTracker()
+        tracker.observe(1.0)
+        self.assertIsNone(tracker.percentile(50, min_samples=2))
+
+    def test_percentile(self):
+        tracker = LatencyTracker()
+        for latency_s in range(1, 101):
+            tracker.observe(float(latency_s))
+        self.assertEqual(tracker.percentile(0, min_samples=1), 1.0)
+        self.assertEqual(tracker.percentile(95, min_samples=1), 95.0)
+        self.assertEqual(tracker.percentile(100, min_samples=1), 100.0)
+
+
+class TestRateLimitConfig(unittest.TestCase):
+    def test_rpm_is_not_exceeded_within_a_minute(self):
+        for rpm in [2, 5, 120, 300]:
+            with self.subTest(rpm=rpm):
+                rate_limit, burst = rpm_bucket(rpm, DEFAULT_RPM_BURST)
+                self.assertGreaterEqual(burst, 1)
+                self.assertLessEqual(rate_limit + burst, rpm)
+
+    def test_rpm_bucket(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        # rpm: 6000 starts 3 at once, then one per 10ms
+        bucket = llms.get_rate_limiter('main').bucket
+        self.assertEqual(bucket.capacity, DEFAULT_RPM_BURST)
+        self.assertAlmostEqual(bucket.rate_per_s, (6000 - DEFAULT_RPM_BURST) / 60.0)
+
+
+PROVIDERS_CONFIG = {
+    'default_llm': 'deepseek',
+    'llms': {
+        'deepseek': {
+            'baseurl': 'http://deepseek.test/v1',
+            'api_key': 'test',
+            'rate_limit': {'rpm': 300, 'tpm': 300000, 'max_concurrency': 10, 'adaptive_concurrency': {'min': 2}},
+        },
+        'local_mistral': {
+            'baseurl': 'http://mistral.test/v1',
+            'api_key': 'test',
+            'rate_limit': {'rpm': 60000, 'max_concurrency': 1, 'queue_size': 1000},
+        },
+        'plain': {
+            'baseurl': 'http://plain.test/v1',
+            'api_key': 'test',
+        },
+    },
+}
+
+
+class TestProviders(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(PROVIDERS_CONFIG, file)
+        self.llms = LLMManager(config_pth)
+        os.remove(config_pth)
+
+    async def asyncTearDown(self):
+        await self.llms.close()
+
+    def test_rate_limit_config(self):
+        deepseek = self.llms.get_rate_limiter('deepseek')
+        self.assertIs(self.llms.get_rate_limiter(None), deepseek)
+        self.assertEqual(deepseek.token_budget.budget, 300000)
+        self.assertEqual(deepseek.queue_max_size, DEFAULT_QUEUE_SIZE)
+        # max_concurrency is where the adaptive limit starts, max defaults to 4 times that
+        self.assertEqual(deepseek.concurrency_limit, 10)
+        self.assertEqual(deepseek.adaptive_concurrency.min_limit, 2)
+        self.assertEqual(deepseek.adaptive_concurrency.max_limit, 40)
+
+        mistral = self.llms.get_rate_limiter('local_mistral')
+        self.assertEqual(mistral.concurrency_limit, 1)
+        self.assertEqual(mistral.queue_max_size, 1000)
+        self.assertIsNone(mistral.token_budget)
+        self.assertIsNone(mistral.adaptive_concurrency)
+
+        plain = self.llms.get_rate_limiter('plain')
+        self.assertEqual(plain.rate_limit, DEFAULT_RATE_LIMIT)
+        self.assertEqual(plain.time_range_s, DEFAULT_TIMERANGE_S)
+        self.assertEqual(plain.concurrency_limit, DEFAULT_MAX_CONCURRENCY)
+
+        self.assertEqual(len({id(deepseek), id(mistral), id(plain)}), 3)
+        with self.assertRaises(ValueError):
+            self.llms.get_rate_limiter('unknown')
+
+    async def test_saturated_provider_does_not_delay_another(self):
+        for llm_name, delay_s in [('local_mistral', 1.0), ('deepseek', 0.01)]:
+            self.llms.aclients[llm_name] = FakeClient([delay_s])
+            self.llms.model_names[llm_name] = f'{llm_name}-model'
+        backlog = [
+            asyncio.create_task(self.llms.get_ai_response('local_mistral', 'system', f'prompt {idd}'))
+            for idd in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.llms.get_rate_limiter('local_mistral').stats()['pending'], 4)
+
+        start_s = time.monotonic()
+        response = await self.llms.get_ai_response('deepseek', 'system', 'prompt 0')
+        self.assertEqual(response.content, 'deepseek-model')
+        self.assertLess(time.monotonic() - start_s, 0.5)
+        for request in backlog:
+            request.cancel()
+        await asyncio.gather(*backlog, return_exceptions=True)
+
+
+class TestHedging(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, self.config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+
+    def tearDown(self):
+        os.remove(self.config_pth)
+
+    def make_manager(self, main_delays_s, backup_delays_s):
+        llms = LLMManager(self.config_pth)
+        for llm_name, delays_s in [('main', main_delays_s), ('backup', backup_delays_s)]:
+            llms.aclients[llm_name] = FakeClient(delays_s)
+            llms.model_names[llm_name] = f'{llm_name}-model'
+        return llms
+
+    async def warm_up(self, llms):
+        for idd in range(3):
+            await llms.get_ai_response('main', 'system', f'warm up {idd}')
+
+    async def test_slow_request_is_hedged_to_fallback(self):
+        llms = self.make_manager([0.01, 0.01, 0.01, 1.0], [0.01])
+        await self.warm_up(llms)
+        response = await llms.get_ai_response('main', 'system', 'slow one')
+        self.assertEqual(response.content, 'backup-model')
+        self.assertEqual(response.llm_name, 'backup')
+        await asyncio.sleep(0)
+        self.assertEqual(llms.aclients['main'].chat.completions.cancelled, 1)
+        self.assertEqual(llms.stats()['main']['hedge_won'], 1)
+        await llms.close()
+
+    async def test_fallback_can_be_disallowed(self):
+        llms = self.make_manager([0.01, 0.01, 0.01, 1.0, 0.01], [0.01])
+        await self.warm_up(llms)
+        response = await llms.get_ai_response('main', 'system', 'slow one', allow_fallback=False)
+        self.assertEqual(response.llm_name, 'main')
+        self.assertEqual(llms.aclients['main'].chat.completions.calls, 5)
+        self.assertEqual(llms.aclients['backup'].chat.completions.calls, 0)
+        await llms.close()
+
+    async def test_fast_request_is_not_hedged(self):
+        llms = self.make_manager([0.05, 0.05, 0.05, 0.001], [0.01])
+        await self.warm_up(llms)
+        response = await llms.get_ai_response('main', 'system', 'fast one')
+        self.assertEqual(response.llm_name, 'main')
+        self.assertEqual(llms.aclients['backup'].chat.completions.calls, 0)
+        await llms.close()
+
+
+class TestStreaming(unittest.IsolatedAsyncioTestCase):
+    def make_manager(self, report_usage=True, tokens_per_minute=None):
+        config = CONFIG
+        if tokens_per_minute is not None:
+            config = yaml.safe_load(yaml.safe_dump(CONFIG))
+            config['llms']['backup']['rate_limit']['tpm'] = tokens_per_minute
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(config, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        llms.aclients['backup'] = FakeClient([0.01], report_usage)
+        llms.model_names['backup'] = 'backup-model'
+        return llms
+
+    async def test_chunks_are_reported(self):
+        llms = self.make_manager()
+        texts = []
+        response = await llms.get_ai_response('backup', 'system', 'prompt', on_chunk=texts.append)
+        self.assertEqual(texts, ['backup', 'backupmodel'])
+        self.assertEqual(response.content, 'backupmodel')
+        await llms.close()
+
+    async def test_usage_calibrates_tokens(self):
+        llms = self.make_manager(tokens_per_minute=10_000)
+        limiter = llms.get_rate_limiter('backup')
+        estimator = llms.token_estimators['backup']
+        completion_tokens = estimator.completion_tokens
+        await llms.get_ai_response('backup', 'system', 'prompt', on_chunk=lambda text: None)
+        self.assertGreater(estimator.completion_tokens, completion_tokens)
+        # The reported 1020 tokens are debited, not the estimate
+        self.assertAlmostEqual(limiter.stats()['tokens_available'], 10_000 - 1020, delta=10)
+        await llms.close()
+
+    async def test_streamed_text_is_debited_without_usage(self):
+        llms = self.make_manager(report_usage=False)
+        llms.get_rate_limiter('backup')
+        estimator = llms.token_estimators['backup']
+        completion_tokens = estimator.completion_tokens
+        await llms.get_ai_response('backup', 'system', 'prompt', on_chunk=lambda text: None)
+        # 'backupmodel' is a couple of tokens, far less than the default estimate
+        self.assertLess(estimator.completion_tokens, completion_tokens)
+        await llms.close()
+
+
+class TestCancellation(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_user(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        llms.aclients['backup'] = FakeClient([1.0])
+        llms.model_names['backup'] = 'backup-model'
+
+        # The same request of two users is coalesced, stopping one of them doesn't affect the other
+        stopped = asyncio.create_task(llms.get_ai_response('backup', 'system', 'prompt', user_id='stopper'))
+        other = asyncio.create_task(llms.get_ai_response('backup', 'system', 'prompt', user_id='other'))
+        await asyncio.sleep(0.01)
+        self.assertEqual(llms.cancel_user('stopper'), 1)
+        with self.assertRaises(RequestCancelledError):
+            await stopped
+        self.assertEqual((await other).content, 'backup-model')
+        self.assertEqual(llms.cancel_user('stopper'), 0)
+        await llms.close()
+
+    async def test_priorities_are_not_coalesced(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        llms.aclients['backup'] = FakeClient([0.05])
+        llms.model_names['backup'] = 'backup-model'
+
+        # An interactive request doesn't wait in the batch queue of an identical one
+        await asyncio.gather(
+            llms.get_ai_response('backup', 'system', 'prompt', priority=Priority.BATCH),
+            llms.get_ai_response('backup', 'system', 'prompt', priority=Priority.INTERACTIVE),
+            llms.get_ai_response('backup', 'system', 'prompt', priority=Priority.INTERACTIVE),
+        )
+        self.assertEqual(llms.aclients['backup'].chat.completions.calls, 2)
+        await llms.close()
+
+    async def test_follower_outlives_leader_deadline(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        llms.aclients['backup'] = FakeClient([10.0, 0.01])
+        llms.model_names['backup'] = 'backup-model'
+
+        completions = llms.aclients['backup'].chat.completions
+        leader = asyncio.create_task(
+            llms.get_ai_response('backup', 'system', 'prompt', deadline_s=time.monotonic() + 0.2)
+        )
+        await completions.entered.wait()
+        follower = asyncio.create_task(llms.get_ai_response('backup', 'system', 'prompt'))
+        with self.assertRaises(TimeoutError):
+            await leader
+        self.assertEqual((await asyncio.wait_for(follower, 1.0)).content, 'backup-model')
+        self.assertEqual(completions.calls, 2)
+        await llms.close()
+
+    async def test_deadline(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        llms.aclients['backup'] = FakeClient([10.0])
+        llms.model_names['backup'] = 'backup-model'
+
+        completions = llms.aclients['backup'].chat.completions
+        response = asyncio.create_task(
+            llms.get_ai_response('backup', 'system', 'prompt', deadline_s=time.monotonic() + 0.5)
+        )
+        # The deadline hits the HTTP call, not the queue
+        await completions.entered.wait()
+        with self.assertRaises(TimeoutError):
+            await response
+        limiter = llms.get_rate_limiter('backup')
+        await asyncio.wait_for(limiter.idle.wait(), 1.0)
+        self.assertEqual(completions.cancelled, 1)
+        self.assertEqual(limiter.stats()['running'], 0)
+        await llms.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
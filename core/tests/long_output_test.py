@@ -0,0 +1,70 @@
+import gzip
+import logging
+import unittest
+
+from bot_partials.long_output import OutputRenderer
+from core.utils import split_tg_html
+
+CHAT = object()
+
+
+class FakeOutbox:
+    # Records what would be sent
+
+    def __init__(self):
+        self.messages = []
+        self.documents = []
+
+    async def send(self, chat, text, parse_mode=None, **kwargs):
+        self.messages.append((text, parse_mode))
+
+    async def send_document(self, chat, document, caption=None, parse_mode=None, **kwargs):
+        self.documents.append((document, caption, parse_mode))
+
+
+class TestOutputRenderer(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.outbox = FakeOutbox()
+        self.output = OutputRenderer(self.outbox, logging.getLogger('test'), max_messages=3, message_length=100)
+        self.edits = []
+
+    async def edit(self, text, parse_mode=None):
+        self.edits.append((text, parse_mode))
+
+    @staticmethod
+    def html(lines: int) -> str:
+        return '\n'.join(f'<b>{idd}.</b> line of the output' for idd in range(lines))
+
+    async def test_short_output_is_sent_as_messages(self):
+        html = self.html(8)
+        await self.output.send(CHAT, html, summary='summary', filename='task_open')
+        self.assertEqual([text for text, _ in self.outbox.messages], split_tg_html(html, 100))
+        self.assertEqual(len(self.outbox.messages), 3)
+        self.assertEqual({parse_mode for _, parse_mode in self.outbox.messages}, {'HTML'})
+        self.assertEqual(self.outbox.documents, [])
+
+    async def test_long_output_is_sent_as_document(self):
+        html = self.html(50)
+        await self.output.send(CHAT, html, summary='<b>summary</b>', filename='task_open')
+        self.assertEqual(self.outbox.messages, [])
+        [(document, caption, parse_mode)] = self.outbox.documents
+        self.assertEqual(document.filename, 'task_open.html.gz')
+        self.assertIn(html, gzip.decompress(document.input_file_content).decode('utf-8'))
+        self.assertEqual((caption, parse_mode), ('<b>summary</b>', 'HTML'))
+
+    async def test_edit_takes_the_first_part(self):
+        parts = split_tg_html(self.html(8), 100)
+        await self.output.send(CHAT, self.html(8), summary='summary', filename='task_open', edit=self.edit)
+        self.assertEqual(self.edits, [(parts[0], 'HTML')])
+        self.assertEqual([text for text, _ in self.outbox.messages], parts[1:])
+
+    async def test_edit_takes_the_summary_of_a_document(self):
+        await self.output.send(CHAT, self.html(50), summary='<b>summary</b>', filename='task_open', edit=self.edit)
+        self.assertEqual(self.edits, [('<b>summary</b>', 'HTML')])
+        [(document, caption, _)] = self.outbox.documents
+        self.assertIsNone(caption)
+        self.assertEqual(self.outbox.messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import time
+import unittest
+
+from telegram.error import RetryAfter
+
+from bot_partials.outbox import MessageScheduler
+
+_message_ids = itertools.count(1)
+
+
+class FakeChat:
+    # Records the messages, raising the given errors on the first sends
+
+    def __init__(self, idd: int = 1, type: str = 'private', errors=()):
+        self.id = idd
+        self.type = type
+        self.errors = list(errors)
+        self.sent = []
+        self.sent_s = []
+
+    async def send_message(self, text, parse_mode=None, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(text)
+        self.sent_s.append(time.monotonic())
+        return next(_message_ids)
+
+
+class TestMessageScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.outbox = MessageScheduler(logging.getLogger('test'), private_rate_per_s=20.0, group_rate_per_s=20.0)
+
+    async def test_pending_messages_are_merged(self):
+        chat = FakeChat()
+        messages = await asyncio.gather(*[self.outbox.send(chat, f'line {i}') for i in range(5)])
+        self.assertEqual(chat.sent, ['\n\n'.join(f'line {i}' for i in range(5))])
+        self.assertEqual(len(set(messages)), 1)
+        self.assertEqual(self.outbox.stats()['merged'], 4)
+
+    async def test_no_merge(self):
+        chat = FakeChat()
+        await asyncio.gather(
+            self.outbox.send(chat, 'computing', coalesce=False),
+            self.outbox.send(chat, 'plain'),
+            self.outbox.send(chat, 'html', parse_mode='HTML'),
+        )
+        self.assertEqual(chat.sent, ['computing', 'plain', 'html'])
+
+    async def test_long_messages_are_not_merged(self):
+        chat = FakeChat()
+        await asyncio.gather(self.outbox.send(chat, 'a' * 3000), self.outbox.send(chat, 'b' * 3000))
+        self.assertEqual(len(chat.sent), 2)
+
+    async def test_chat_rate(self):
+        chat = FakeChat()
+        for i in range(5):
+            await self.outbox.send(chat, f'line {i}')
+        # A burst of 3, then one per 1 / 20 s
+        self.assertEqual(len(chat.sent), 5)
+        self.assertGreaterEqual(chat.sent_s[4] - chat.sent_s[2], 0.09)
+
+    async def test_group_chat_rate(self):
+        chat = FakeChat(type='group')
+        for i in range(3):
+            await self.outbox.send(chat, f'line {i}')
+        # No burst in groups
+        self.assertGreaterEqual(chat.sent_s[2] - chat.sent_s[0], 0.09)
+
+    async def test_retry_after_pauses_the_chat(self):
+        chat = FakeChat(errors=[RetryAfter(datetime.timedelta(milliseconds=300))])
+        other = FakeChat(idd=2)
+        start_s = time.monotonic()
+        flooded = asyncio.create_task(self.outbox.send(chat, 'retried'))
+        await self.outbox.send(other, 'not paused')
+        self.assertLess(time.monotonic() - start_s, 0.25)
+        await flooded
+        self.assertGreaterEqual(chat.sent_s[0] - start_s, 0.29)
+        self.assertEqual(chat.sent, ['retried'])
+        self.assertEqual(self.outbox.stats()['retries'], 1)
+
+    async def test_error_reaches_the_sender(self):
+        chat = FakeChat(errors=[RuntimeError('boom')])
+        with self.assertRaises(RuntimeError):
+            await self.outbox.send(chat, 'failed')
+        await self.outbox.send(chat, 'sent')
+        self.assertEqual(chat.sent, ['sent'])
+
+    async def test_queue_is_released(self):
+        chat = FakeChat()
+        await self.outbox.send(chat, 'line')
+        await asyncio.sleep(0)
+        self.assertEqual(self.outbox.stats()['chats_waiting'], 0)
+        self.assertEqual(self.outbox.queues, dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
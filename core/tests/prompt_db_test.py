@@ -1,5 +1,9 @@
+import sqlite3
+import tempfile
 import unittest
-from core.prompt_db import PromptDBManager
+from pathlib import Path
+
+from core.prompt_db import MIGRATIONS, PromptDBManager
 
 
 class TestPromptDBManager(unittest.TestCase):
@@ -55,6 +59,67 @@ class TestPromptDBManager(unittest.TestCase):
         self.assertEqual(users[0][1], 'John Doe')
         self.assertEqual(users[1][1], 'Masha')
 
+    def test_same_run_is_accumulated(self):
+        self.db.insert_prompt_run('user1', 'task1', 'Sample prompt', 0.5, 10, 0.7, 5, {'param1': 'value1'})
+        self.db.insert_prompt_run('user1', 'task1', 'Sample prompt', 0.5, 10, 0.7, 5, {'param1': 'value1'})
+        prompts = self.db.get_top_k_user_prompts('user1', 'task1', 2)
+        self.assertEqual(len(prompts), 1)
+        self.assertEqual(prompts[0][1:5], (1.0, 20, 1.4, 10))
+
+    def test_lookups_use_indexes(self):
+        self.db.cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT run_id FROM prompt_runs
+            WHERE user_id = ? AND task_id = ? AND prompt_id = ? AND parameters_json = ?
+        ''', ('user1', 'task1', 1, 'null'))
+        self.assertIn('COVERING INDEX prompt_runs_lookup', self.db.cursor.fetchall()[0][3])
+        self.db.cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT prompt_id FROM prompts WHERE user_id = ? AND task_id = ? AND prompt_hash = ? AND prompt = ?
+        ''', ('user1', 'task1', 'hash', 'prompt'))
+        self.assertIn('INDEX prompts_lookup', self.db.cursor.fetchall()[0][3])
+
+
+class TestSchemaMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_pth = str(Path(self.tmp_dir.name) / 'sql.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_unversioned_database_is_migrated(self):
+        # A database created before the migrations: the tables only, with data
+        conn = sqlite3.connect(self.db_pth)
+        for statement in MIGRATIONS[0]:
+            conn.execute(statement)
+        conn.execute("INSERT INTO prompts (user_id, task_id, prompt) VALUES ('user1', 'task1', 'Sample prompt')")
+        conn.commit()
+        conn.close()
+
+        db = PromptDBManager(self.db_pth)
+        self.assertEqual(db.get_schema_version(), len(MIGRATIONS))
+        self.assertEqual(db.insert_prompt('user1', 'task1', 'Sample prompt'), 1)
+        self.assertEqual(db.insert_prompt('user1', 'task1', 'Other prompt'), 2)
+        db.cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(db.cursor.fetchone()[0], 'wal')
+        db.close()
+
+        db = PromptDBManager(self.db_pth)
+        db.cursor.execute('SELECT COUNT(*) FROM schema_migrations')
+        self.assertEqual(db.cursor.fetchone()[0], len(MIGRATIONS))
+        db.close()
+
+    def test_failed_migration_is_rolled_back(self):
+        db = PromptDBManager(self.db_pth, schema_version=1)
+        db.cursor.execute('CREATE INDEX prompts_lookup ON users (user_name)')
+        with self.assertRaises(sqlite3.OperationalError):
+            db.migrate(len(MIGRATIONS))
+        self.assertEqual(db.get_schema_version(), 1)
+        db.cursor.execute('PRAGMA table_info(prompts)')
+        self.assertNotIn('prompt_hash', [row[1] for row in db.cursor.fetchall()])
+        db.close()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import types
+import unittest
+
+import yaml
+
+from core.llm_manager import LLMManager
+from core.prompt_db import PromptDBManager
+from core.prompter import EvaluationStatus, PromptRunner
+from core.ratelimit import Priority, QueueOverflowError, RateLimitedBatchQueue
+from core.task_management import TaskManager
+
+TASK_ID = 'dates_en'
+
+CONFIG = {
+    'default_llm': 'deepseek',
+    'llms': {
+        'deepseek': {
+            'baseurl': 'http://deepseek.test/v1',
+            'api_key': 'test',
+            'model_name': 'deepseek-chat',
+            # One call at a time: a batch waits in the queue for much longer than a call takes
+            'rate_limit': {'rpm': 60_000, 'max_concurrency': 1},
+        },
+    },
+}
+
+
+class AnsweringCompletions:
+    # Answers each snippet with its answer after a delay (`delays_s` by text), `hung` texts never get an answer
+
+    def __init__(self, answers, delay_s, hung=(), delays_s=None):
+        self.answers = answers
+        self.delay_s = delay_s
+        self.hung = set(hung)
+        self.delays_s = delays_s or dict()
+        self.calls = 0
+
+    async def create(self, model, messages, temperature=None, stream=False, stream_options=None, timeout=None):
+        self.calls += 1
+        text = messages[-1]['content']
+        await asyncio.sleep(3600.0 if text in self.hung else self.delays_s.get(text, self.delay_s))
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=self.answers[text]))],
+            usage=None
+        )
+
+
+class FakeClient:
+
+    def __init__(self, completions):
+        self.chat = types.SimpleNamespace(completions=completions)
+
+    async def close(self):
+        pass
+
+
+class TestPromptRunner(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, config_pth = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as file:
+            yaml.safe_dump(CONFIG, file)
+        self.llms = LLMManager(config_pth)
+        os.remove(config_pth)
+        self.task = TaskManager(argparse.Namespace(data_root='data')).get_current_task(TASK_ID)
+        self.sql_db = PromptDBManager(':memory:')
+
+    async def asyncTearDown(self):
+        await self.llms.close()
+        self.sql_db.close()
+
+    def make_runner(self, delay_s: float, snippet_timeout_s: float, hung=(), delays_s=None) -> PromptRunner:
+        snippets = list(self.task.hidden_snippets.values()) + list(self.task.open_snippets.values())
+        answers = {snippet['Task']: ' '.join(snippet['Answer']) for snippet in snippets}
+        self.completions = AnsweringCompletions(answers, delay_s, hung, delays_s)
+        self.llms.aclients['deepseek'] = FakeClient(self.completions)
+        self.llms.model_names['deepseek'] = 'deepseek-chat'
+        return PromptRunner(RateLimitedBatchQueue(), self.sql_db, self.llms, snippet_timeout_s=snippet_timeout_s)
+
+    async def test_queue_time_does_not_time_out_a_batch(self):
+        # The last snippet waits for the others far longer than its own timeout
+        runner = self.make_runner(delay_s=0.05, snippet_timeout_s=0.1)
+        result_batch = await runner.compute_hidden_batch(self.task, 'user1', 'prompt')
+        self.assertEqual(result_batch.status, EvaluationStatus.OK)
+        self.assertEqual(self.completions.calls, len(self.task.hidden_snippets))
+
+    async def test_hung_call_times_out(self):
+        hung_snippet = next(iter(self.task.hidden_snippets.values()))
+        runner = self.make_runner(delay_s=0.01, snippet_timeout_s=0.1, hung=[hung_snippet['Task']])
+        result_batch = await asyncio.wait_for(runner.compute_hidden_batch(self.task, 'user1', 'prompt'), 5.0)
+        statuses = [evall.status for evall in result_batch.eval_list]
+        self.assertEqual(statuses[0], EvaluationStatus.TIMEOUT)
+        self.assertEqual(set(statuses[1:]), {EvaluationStatus.OK})
+
+
+    async def evaluate_open(self, runner: PromptRunner):
+        evaluations = runner.evaluate_as_completed(
+            self.task, self.task.open_snippets, 'prompt', self.task.get_matcher(), user_id='user1'
+        )
+        return [result async for result in evaluations]
+
+    async def test_results_in_completion_order(self):
+        self.llms.get_rate_limiter('deepseek').max_concurrency = 10
+        snippet_ids = list(self.task.open_snippets)
+        # The later the snippet, the sooner its answer
+        delays_s = {
+            self.task.open_snippets[snippet_id]['Task']: 0.02 * (len(snippet_ids) - idd)
+            for idd, snippet_id in enumerate(snippet_ids)
+        }
+        runner = self.make_runner(delay_s=0.0, snippet_timeout_s=5.0, delays_s=delays_s)
+        results = await self.evaluate_open(runner)
+        self.assertEqual([idd for idd, _ in results], list(reversed(range(len(snippet_ids)))))
+        for idd, evall in results:
+            self.assertEqual(evall.snippet_id, snippet_ids[idd])
+            self.assertEqual(evall.status, EvaluationStatus.OK)
+
+    async def test_runs_at_interactive_priority(self):
+        runner = self.make_runner(delay_s=0.01, snippet_timeout_s=5.0)
+        limiter = self.llms.get_rate_limiter('deepseek')
+        priorities = []
+        submit = limiter.submit
+
+        async def recording_submit(routine, **kwargs):
+            priorities.append(kwargs['priority'])
+            return await submit(routine, **kwargs)
+
+        limiter.submit = recording_submit
+        await self.evaluate_open(runner)
+        self.assertEqual(set(priorities), {Priority.INTERACTIVE})
+
+    async def test_stop_ends_the_loop(self):
+        snippet_tasks = [snippet['Task'] for snippet in self.task.open_snippets.values()]
+        runner = self.make_runner(delay_s=0.0, snippet_timeout_s=5.0, hung=snippet_tasks)
+        evaluation = asyncio.create_task(self.evaluate_open(runner))
+        while self.completions.calls == 0:
+            await asyncio.sleep(0.01)
+        self.assertGreater(runner.cancel_user('user1'), 0)
+        results = await asyncio.wait_for(evaluation, 1.0)
+        self.assertEqual(len(results), len(snippet_tasks))
+        self.assertEqual({evall.status for _, evall in results}, {EvaluationStatus.CANCELLED})
+
+    async def test_oversized_task_is_rejected(self):
+        runner = self.make_runner(delay_s=0.0, snippet_timeout_s=5.0)
+        self.llms.get_rate_limiter('deepseek').queue_max_size = len(self.task.open_snippets) - 1
+        with self.assertRaises(QueueOverflowError):
+            await self.evaluate_open(runner)
+        self.assertEqual(self.completions.calls, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
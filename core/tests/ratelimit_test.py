@@ -0,0 +1,314 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from core.ratelimit import (
+    AdaptiveConcurrency, FairQueue, Priority, PriorityFairQueue, QueueOverflowError, RateLimitedBatchQueue, RateLimiter,
+    SlidingWindowBudget, TokenBucket, _Job
+)
+
+
+class TestSlidingWindowBudget(unittest.TestCase):
+    def test_wait_for_oldest_debit(self):
+        budget = SlidingWindowBudget(budget=600, window_s=60.0)
+        budget.debit(200)
+        budget.debit(300)
+        self.assertEqual(budget.delay_s(100), 0.0)
+        # 200 of the first debit have to leave the window
+        self.assertAlmostEqual(budget.delay_s(300), 60.0, places=1)
+
+    def test_correction_changes_its_debit(self):
+        budget = SlidingWindowBudget(budget=600, window_s=60.0)
+        debit = budget.debit(600)
+        budget.correct(debit, -400)
+        self.assertEqual(budget.available, 400)
+        budget.correct(debit, -1000)
+        self.assertEqual(debit.amount, 0)
+        self.assertEqual(budget.available, 600)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate_per_s=10.0, capacity=2)
+        self.assertEqual(bucket.delay_s(), 0.0)
+        bucket.consume()
+        bucket.consume()
+        self.assertAlmostEqual(bucket.delay_s(), 0.1, places=2)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_grows_while_latency_is_flat(self):
+        concurrency = AdaptiveConcurrency(initial=2, max_limit=10)
+        for _ in range(20):
+            concurrency.on_success(1.0, in_flight=concurrency.current_limit)
+        self.assertGreater(concurrency.current_limit, 2)
+        self.assertLessEqual(concurrency.current_limit, 10)
+
+    def test_does_not_grow_when_underused(self):
+        concurrency = AdaptiveConcurrency(initial=4)
+        for _ in range(20):
+            concurrency.on_success(1.0, in_flight=1)
+        self.assertEqual(concurrency.current_limit, 4)
+
+    def test_backs_off_on_overload(self):
+        concurrency = AdaptiveConcurrency(initial=8, min_limit=2)
+        concurrency.on_overload()
+        self.assertEqual(concurrency.current_limit, 4)
+        # The same congestion reported again right away is ignored
+        concurrency.on_overload()
+        self.assertEqual(concurrency.current_limit, 4)
+
+    def test_backs_off_on_latency_growth(self):
+        concurrency = AdaptiveConcurrency(initial=8)
+        for _ in range(5):
+            concurrency.on_success(0.1, in_flight=1)
+        for _ in range(5):
+            concurrency.on_success(1.0, in_flight=1)
+        self.assertEqual(concurrency.current_limit, 4)
+
+
+class TestFairQueue(unittest.TestCase):
+    def test_round_robin_between_users(self):
+        queue = FairQueue()
+        for idd in range(4):
+            queue.push(_Job(routine=None, future=None, user_id='batch', token_cost=idd))
+        queue.push(_Job(routine=None, future=None, user_id='interactive', token_cost=100))
+        order = [(job.user_id, job.token_cost) for job in iter(queue.pop, None)]
+        self.assertEqual(order, [
+            ('batch', 0), ('interactive', 100), ('batch', 1), ('batch', 2), ('batch', 3)
+        ])
+        self.assertEqual(len(queue), 0)
+
+    def test_remove(self):
+        queue = FairQueue()
+        job = _Job(routine=None, future=None, user_id='user')
+        queue.push(job)
+        self.assertTrue(queue.remove(job))
+        self.assertFalse(queue.remove(job))
+        self.assertIsNone(queue.peek())
+
+
+class TestPriorityFairQueue(unittest.TestCase):
+    def test_interactive_goes_first(self):
+        queue = PriorityFairQueue(aging_s=10.0)
+        queue.push(_Job(routine=None, future=None, priority=Priority.BATCH, enqueued_s=0.0))
+        queue.push(_Job(routine=None, future=None, priority=Priority.INTERACTIVE, enqueued_s=1.0))
+        self.assertEqual(queue.pop(now_s=2.0).priority, Priority.INTERACTIVE)
+        self.assertEqual(queue.pop(now_s=2.0).priority, Priority.BATCH)
+
+    def test_aging(self):
+        queue = PriorityFairQueue(aging_s=10.0)
+        queue.push(_Job(routine=None, future=None, priority=Priority.BATCH, enqueued_s=0.0))
+        queue.push(_Job(routine=None, future=None, priority=Priority.INTERACTIVE, enqueued_s=15.0))
+        self.assertEqual(queue.peek(now_s=16.0).priority, Priority.BATCH)
+        self.assertEqual(len(queue), 2)
+
+    def test_aged_backlog_takes_turns_with_interactive(self):
+        # A backlog much older than aging_s doesn't go ahead of new interactive jobs
+        queue = PriorityFairQueue(aging_s=10.0)
+        for _ in range(10):
+            queue.push(_Job(routine=None, future=None, priority=Priority.BATCH, enqueued_s=0.0))
+        for _ in range(3):
+            queue.push(_Job(routine=None, future=None, priority=Priority.INTERACTIVE, enqueued_s=100.0))
+        popped = [queue.pop(now_s=100.5).priority for _ in range(6)]
+        self.assertEqual(popped, [Priority.BATCH, Priority.INTERACTIVE] * 3)
+        self.assertEqual(len(queue), 7)
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def routine(self, value, sleep_s=0.05):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(sleep_s)
+        finally:
+            self.in_flight -= 1
+        return value
+
+    async def test_submit_batch_keeps_order(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=3)
+        result = await limiter.submit_batch([self.routine(i) for i in range(10)])
+        await limiter.close()
+        self.assertEqual(result, list(range(10)))
+        self.assertEqual(self.max_in_flight, 3)
+
+    async def test_rate_is_limited(self):
+        limiter = RateLimiter(rate_limit=5, time_range_s=0.5, max_concurrency=100)
+        start_s = time.monotonic()
+        await limiter.submit_batch([self.routine(i, sleep_s=0) for i in range(10)])
+        await limiter.close()
+        # 5 go out as a burst, the other 5 need 0.5s of refill
+        self.assertGreaterEqual(time.monotonic() - start_s, 0.45)
+
+    @mock.patch('core.ratelimit.TOKEN_WINDOW_S', 0.5)
+    async def test_tokens_per_minute(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=100, tokens_per_minute=600)
+        start_s = time.monotonic()
+        await limiter.submit(self.routine(1, sleep_s=0), token_cost=600)
+        # The budget is spent until the debit leaves the window
+        await limiter.submit(self.routine(2, sleep_s=0), token_cost=5)
+        self.assertGreaterEqual(time.monotonic() - start_s, 0.45)
+        await limiter.close()
+
+    @mock.patch('core.ratelimit.TOKEN_WINDOW_S', 0.5)
+    async def test_overestimated_tokens_are_given_back(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=100, tokens_per_minute=600)
+
+        async def routine():
+            limiter.adjust_tokens(-500)
+
+        start_s = time.monotonic()
+        await limiter.submit(routine(), token_cost=600)
+        await limiter.submit(self.routine(2, sleep_s=0), token_cost=500)
+        self.assertLess(time.monotonic() - start_s, 0.1)
+        self.assertAlmostEqual(limiter.stats()['tokens_available'], 0)
+        await limiter.close()
+
+    @mock.patch('core.ratelimit.TOKEN_WINDOW_S', 0.5)
+    async def test_no_window_exceeds_token_budget(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=100, tokens_per_minute=600)
+        started_s = []
+
+        async def routine():
+            started_s.append(time.monotonic())
+
+        await asyncio.gather(*[limiter.submit(routine(), token_cost=300) for _ in range(6)])
+        await limiter.close()
+        # A refilling bucket of the whole budget would start 3 routines (900 tokens) within the first window
+        for window_start_s in started_s:
+            in_window = [start_s for start_s in started_s if window_start_s <= start_s < window_start_s + 0.49]
+            self.assertLessEqual(len(in_window) * 300, 600)
+        self.assertGreaterEqual(started_s[-1] - started_s[0], 0.95)
+
+    async def test_batch_does_not_starve_other_users(self):
+        limiter = RateLimiter(rate_limit=1000, max_concurrency=1)
+        finished = []
+
+        async def routine(name):
+            await asyncio.sleep(0.01)
+            finished.append(name)
+
+        batch = asyncio.create_task(limiter.submit_batch([routine(f'batch{i}') for i in range(20)], user_id='batch'))
+        await asyncio.sleep(0.015)
+        await limiter.submit(routine('interactive'), user_id='interactive')
+        self.assertLessEqual(finished.index('interactive'), 3)
+        await batch
+        await limiter.close()
+
+    async def test_admission_control(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1, queue_max_size=2)
+        with self.assertRaises(QueueOverflowError):
+            await limiter.submit_batch([self.routine(i) for i in range(3)])
+        first = asyncio.create_task(limiter.submit(self.routine(1)))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(limiter.submit(self.routine(i))) for i in range(2)]
+        await asyncio.sleep(0)
+        with self.assertRaises(QueueOverflowError):
+            await limiter.submit(self.routine(3))
+        await asyncio.gather(first, *queued)
+        await limiter.close()
+
+    async def test_batch_progress(self):
+        limiter = RateLimiter(rate_limit=1000, max_concurrency=2)
+        queue = RateLimitedBatchQueue(progress_interval_s=0.02)
+        reports = []
+
+        async def notify(progress):
+            reports.append(progress)
+
+        routines = [limiter.submit(self.routine(i, sleep_s=0.02), user_id='user') for i in range(6)]
+        result = await queue.add_batch_task(routines, rate_limiter=limiter, user_id='user', notify_progress=notify)
+        await limiter.close()
+        self.assertEqual(result, list(range(6)))
+        self.assertGreater(len(reports), 1)
+        self.assertEqual(reports[0].done, 0)
+        self.assertEqual(reports[0].total, 6)
+        self.assertIsNotNone(reports[-1].queue_status.eta_s)
+        self.assertIsNotNone(limiter.service_rate())
+
+    async def test_exception_propagates(self):
+        async def failing():
+            raise RuntimeError('boom')
+        limiter = RateLimiter()
+        with self.assertRaises(RuntimeError):
+            await limiter.submit(failing())
+        await limiter.close()
+
+    async def test_cancelled_submit_is_dropped(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1)
+        first = asyncio.create_task(limiter.submit(self.routine(1, sleep_s=0.1)))
+        second = asyncio.create_task(limiter.submit(self.routine(2)))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        self.assertEqual(await first, 1)
+        await limiter.close()
+        self.assertEqual(limiter.started, 1)
+
+    async def blocked(self, started: asyncio.Event):
+        self.in_flight += 1
+        started.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.in_flight -= 1
+
+    async def test_deadline_drops_routine(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1)
+        started = asyncio.Event()
+        running = asyncio.create_task(limiter.submit(self.blocked(started), deadline_s=time.monotonic() + 0.2))
+        await started.wait()
+        # Expires while the only slot is taken
+        with self.assertRaises(TimeoutError):
+            await limiter.submit(self.routine(2), deadline_s=time.monotonic() + 0.01)
+        with self.assertRaises(TimeoutError):
+            await running
+        self.assertEqual(self.in_flight, 0)
+        self.assertEqual(await limiter.submit(self.routine(3), deadline_s=time.monotonic() + 1.0), 3)
+        await limiter.close()
+        self.assertEqual(limiter.started, 2)
+
+    async def test_expired_job_is_not_started(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1)
+        await limiter.start_if_not()
+        job = limiter.send_task(self.routine(1), deadline_s=time.monotonic() - 1.0)
+        with self.assertRaises(TimeoutError):
+            await job.future
+        await limiter.close()
+        self.assertEqual(limiter.started, 0)
+
+    async def test_cancel_before_first_step(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1)
+        submitted = asyncio.create_task(limiter.submit(self.routine(1), user_id='stopper'))
+        # Dispatched, but the task running the routine hasn't had its first step
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(len(limiter.running), 1)
+        self.assertEqual(limiter.cancel_user('stopper'), 1)
+        with self.assertRaises(asyncio.CancelledError):
+            await submitted
+        self.assertEqual(len(limiter.running), 0)
+        self.assertEqual(await asyncio.wait_for(limiter.submit(self.routine(2)), 0.5), 2)
+        await limiter.close()
+
+    async def test_cancel_user(self):
+        limiter = RateLimiter(rate_limit=100, max_concurrency=1)
+        running = asyncio.create_task(limiter.submit(self.routine(1, sleep_s=1.0), user_id='stopper'))
+        queued = asyncio.create_task(limiter.submit(self.routine(2), user_id='stopper'))
+        other = asyncio.create_task(limiter.submit(self.routine(3), user_id='other'))
+        await asyncio.sleep(0.01)
+        self.assertEqual(limiter.cancel_user('stopper'), 2)
+        self.assertEqual(await asyncio.wait_for(other, 0.5), 3)
+        for task in [running, queued]:
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        await limiter.close()
+        self.assertEqual(limiter.started, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
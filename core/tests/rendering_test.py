@@ -0,0 +1,70 @@
+import argparse
+import gc
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from core.rendering import TemplateRenderer, default_renderer
+from core.task_management import TaskManager
+from core.utils import from_json_file, from_txt_file, to_json_file
+
+TASK_ID = 'dates_en'
+
+
+class TestTemplateRenderer(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        shutil.copytree(f'data/{TASK_ID}', self.data_root / TASK_ID)
+        self.task_manager = TaskManager(argparse.Namespace(data_root=str(self.data_root)))
+        self.renderer = TemplateRenderer()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_no_file_is_read_on_commands(self):
+        task = self.task_manager.get_current_task(TASK_ID)
+        snippet = next(iter(task.open_snippets))
+        help_text = from_txt_file('templates/help.txt')
+        with mock.patch('builtins.open', side_effect=AssertionError('file read')):
+            self.assertEqual(self.renderer.static_text('help.txt'), help_text)
+            self.assertIn(task.title, self.renderer.short_description(task))
+            self.assertIn(f'[FOCUS] {snippet}', self.renderer.short_description(task, snippet))
+
+    def test_description_is_cached_per_snippet(self):
+        task = self.task_manager.get_current_task(TASK_ID)
+        snippet = next(iter(task.open_snippets))
+        first = self.renderer.short_description(task, snippet)
+        with mock.patch.object(self.renderer, 'render', side_effect=AssertionError('rendered again')):
+            self.assertIs(self.renderer.short_description(task, snippet), first)
+        self.assertNotEqual(self.renderer.short_description(task), first)
+
+    def test_reloaded_task_is_rendered_again(self):
+        old_description = self.renderer.short_description(self.task_manager.get_current_task(TASK_ID))
+        info_pth = self.data_root / TASK_ID / 'info.json'
+        info = from_json_file(info_pth)
+        info['title'] = 'Updated title'
+        to_json_file(info_pth, info)
+        self.task_manager.catalog = self.task_manager.load_catalog()
+        gc.collect()
+
+        self.assertEqual(len(self.renderer.descriptions), 0)
+        description = self.renderer.short_description(self.task_manager.get_current_task(TASK_ID))
+        self.assertNotEqual(description, old_description)
+        self.assertIn('Updated title', description)
+
+    def test_same_text_as_task(self):
+        task = self.task_manager.get_current_task(TASK_ID)
+        self.assertEqual(self.renderer.short_description(task), task.short_description())
+
+    def test_task_uses_the_default_renderer(self):
+        task = self.task_manager.get_current_task(TASK_ID)
+        renderer = default_renderer()
+        self.assertIs(default_renderer(), renderer)
+        description = task.short_description()
+        self.assertIs(renderer.short_description(task), description)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from core.single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+        self.cancelled = False
+
+    async def routine(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return 'response'
+
+    async def test_coalesces_concurrent_calls(self):
+        results = await asyncio.gather(*[
+            self.flight.do('key', self.routine)
+            for _ in range(5)
+        ])
+        self.assertEqual(results, ['response'] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(self.flight), 0)
+
+    async def test_sequential_calls_are_not_coalesced(self):
+        await self.flight.do('key', self.routine)
+        await self.flight.do('key', self.routine)
+        self.assertEqual(self.calls, 2)
+
+    async def test_one_waiter_leaving_keeps_call(self):
+        first = asyncio.create_task(self.flight.do('key', self.routine))
+        second = asyncio.create_task(self.flight.do('key', self.routine))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertEqual(await second, 'response')
+        self.assertTrue(first.cancelled())
+        self.assertFalse(self.cancelled)
+
+    async def test_last_waiter_leaving_cancels_call(self):
+        first = asyncio.create_task(self.flight.do('key', self.routine))
+        second = asyncio.create_task(self.flight.do('key', self.routine))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0)
+        self.assertTrue(self.cancelled)
+        self.assertEqual(len(self.flight), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
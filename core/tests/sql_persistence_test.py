@@ -0,0 +1,144 @@
+import asyncio
+import pickle
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from bot_partials.sql_persistence import MIGRATED_SUFFIX, SQLitePersistence
+
+
+class TestSQLitePersistence(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_pth = str(Path(self.tmp_dir.name) / 'bot_data.db')
+        self.persistence = SQLitePersistence(self.db_pth)
+
+    def tearDown(self):
+        self.persistence.close()
+        self.tmp_dir.cleanup()
+
+    def reopen(self) -> SQLitePersistence:
+        self.persistence.close()
+        self.persistence = SQLitePersistence(self.db_pth)
+        return self.persistence
+
+    def stored_rows(self) -> int:
+        # Seen from another connection, i.e. committed
+        conn = sqlite3.connect(self.db_pth)
+        count = conn.execute('SELECT COUNT(*) FROM persistence_data').fetchone()[0]
+        conn.close()
+        return count
+
+    async def test_round_trip(self):
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        await self.persistence.update_chat_data(-2, {'focus': 'dates_en'})
+        await self.persistence.update_bot_data({'runs': 3})
+        await self.persistence.update_conversation('naming', (1, 1), 'expecting_name')
+        await self.persistence.flush()
+
+        persistence = self.reopen()
+        self.assertEqual(await persistence.get_user_data(), {1: {'name': 'John Doe'}})
+        self.assertEqual(await persistence.get_chat_data(), {-2: {'focus': 'dates_en'}})
+        self.assertEqual(await persistence.get_bot_data(), {'runs': 3})
+        self.assertEqual(await persistence.get_conversations('naming'), {(1, 1): 'expecting_name'})
+
+    async def test_only_changed_rows_are_written(self):
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        await self.persistence.update_user_data(2, {'name': 'Masha'})
+        self.assertEqual(self.persistence.rows_written, 2)
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        await self.persistence.update_user_data(2, {'name': 'Vasya'})
+        self.assertEqual(self.persistence.rows_written, 3)
+
+    async def test_drop(self):
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        await self.persistence.update_user_data(2, {'name': 'Masha'})
+        await self.persistence.update_chat_data(1, {'focus': 'dates_en'})
+        await self.persistence.update_conversation('naming', (1, 1), 'expecting_name')
+        await self.persistence.drop_user_data(1)
+        await self.persistence.drop_chat_data(1)
+        await self.persistence.update_conversation('naming', (1, 1), None)
+        await self.persistence.flush()
+
+        persistence = self.reopen()
+        self.assertEqual(await persistence.get_user_data(), {2: {'name': 'Masha'}})
+        self.assertEqual(await persistence.get_chat_data(), dict())
+        self.assertEqual(await persistence.get_conversations('naming'), dict())
+
+    async def test_flush_commits(self):
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        self.assertEqual(self.stored_rows(), 0)
+        await self.persistence.flush()
+        self.assertEqual(self.stored_rows(), 1)
+        self.assertIsNone(self.persistence.commit_handle)
+
+    async def test_updates_are_committed_together(self):
+        await self.persistence.update_user_data(1, {'name': 'John Doe'})
+        await self.persistence.update_user_data(2, {'name': 'Masha'})
+        await self.persistence.update_bot_data({'runs': 1})
+        self.assertEqual(self.stored_rows(), 0)
+        # One commit, scheduled for the next loop iteration
+        await asyncio.sleep(0)
+        self.assertEqual(self.stored_rows(), 3)
+
+
+class TestPickleMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_pth = str(Path(self.tmp_dir.name) / 'bot_data.db')
+        self.pickle_pth = Path(self.tmp_dir.name) / 'prompetition_bot'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_pickle(self, user_data):
+        # The layout of a single file PicklePersistence
+        with open(self.pickle_pth, 'wb') as f:
+            pickle.dump({
+                'user_data': user_data,
+                'chat_data': {-2: {'focus': 'dates_en'}},
+                'bot_data': {'runs': 3},
+                'callback_data': None,
+                'conversations': {'naming': {(1, 1): 'expecting_name'}},
+            }, f)
+
+    def test_migrate(self):
+        self.write_pickle({1: {'name': 'John Doe'}, 2: {'name': 'Masha'}})
+        persistence = SQLitePersistence(self.db_pth)
+        self.assertTrue(persistence.migrate_from_pickle(str(self.pickle_pth)))
+        persistence.close()
+        self.assertFalse(self.pickle_pth.exists())
+        self.assertTrue(self.pickle_pth.with_name(self.pickle_pth.name + MIGRATED_SUFFIX).exists())
+
+        persistence = SQLitePersistence(self.db_pth)
+        user_data = {key: pickle.loads(data) for key, data in persistence.rows['user_data'].items()}
+        self.assertEqual(user_data, {'1': {'name': 'John Doe'}, '2': {'name': 'Masha'}})
+        self.assertIn('conversation:naming', persistence.rows)
+        persistence.close()
+
+    def test_migrate_is_idempotent(self):
+        self.write_pickle({1: {'name': 'John Doe'}})
+        persistence = SQLitePersistence(self.db_pth)
+        self.assertTrue(persistence.migrate_from_pickle(str(self.pickle_pth)))
+        rows_written = persistence.rows_written
+        self.assertFalse(persistence.migrate_from_pickle(str(self.pickle_pth)))
+        self.assertEqual(persistence.rows_written, rows_written)
+        persistence.close()
+
+    def test_existing_db_is_not_overwritten(self):
+        persistence = SQLitePersistence(self.db_pth)
+        persistence._store('user_data', '1', pickle.dumps({'name': 'Current name'}))
+        persistence.close()
+
+        # A pickle left over, e.g. restored from a backup
+        self.write_pickle({1: {'name': 'Old name'}})
+        persistence = SQLitePersistence(self.db_pth)
+        self.assertFalse(persistence.migrate_from_pickle(str(self.pickle_pth)))
+        self.assertEqual(pickle.loads(persistence.rows['user_data']['1']), {'name': 'Current name'})
+        self.assertTrue(self.pickle_pth.exists())
+        persistence.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
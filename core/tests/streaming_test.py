@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+import logging
+import time
+import unittest
+
+from telegram.error import BadRequest, RetryAfter
+
+from bot_partials.streaming import MAX_MESSAGE_LENGTH, TRUNCATION_MARK, StreamingMessage
+
+
+class FakeMessage:
+    # Records the edits, raising the given errors on the first ones
+
+    def __init__(self, text: str = 'Processing', errors=()):
+        self.text = text
+        self.chat = object()
+        self.errors = list(errors)
+        self.edits = []
+        self.edits_s = []
+
+    async def edit_text(self, text, parse_mode=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((text, parse_mode))
+        self.edits_s.append(time.monotonic())
+
+
+class TestStreamingMessage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, chat, text, parse_mode=None, coalesce=True):
+        self.sent.append((chat, text, parse_mode, coalesce))
+
+    def make_stream(self, message: FakeMessage, interval_s: float = 0.1) -> StreamingMessage:
+        return StreamingMessage(message, logging.getLogger('test'), self.send, interval_s=interval_s)
+
+    async def test_edits_are_throttled(self):
+        message = FakeMessage()
+        stream = self.make_stream(message)
+        text = ''
+        for _ in range(25):
+            text += 'token '
+            stream.update(text)
+            await asyncio.sleep(0.01)
+        await stream.flush_task
+        self.assertGreater(len(message.edits), 1)
+        self.assertLessEqual(len(message.edits), 4)
+        for earlier_s, later_s in zip(message.edits_s, message.edits_s[1:]):
+            self.assertGreaterEqual(later_s - earlier_s, 0.09)
+
+    async def test_long_preview_is_truncated(self):
+        message = FakeMessage()
+        stream = self.make_stream(message)
+        stream.update('a' * (MAX_MESSAGE_LENGTH + 100))
+        await stream.flush_task
+        preview, parse_mode = message.edits[0]
+        self.assertEqual(len(preview), MAX_MESSAGE_LENGTH)
+        self.assertTrue(preview.startswith(TRUNCATION_MARK))
+        self.assertIsNone(parse_mode)
+
+    async def test_retry_after_backs_off(self):
+        message = FakeMessage(errors=[RetryAfter(datetime.timedelta(milliseconds=300))])
+        stream = self.make_stream(message)
+        start_s = time.monotonic()
+        stream.update('first')
+        await stream.flush_task
+        self.assertEqual(message.edits, [])
+        stream.update('first second')
+        await stream.flush_task
+        self.assertEqual(message.edits, [('first second', None)])
+        self.assertGreaterEqual(message.edits_s[0] - start_s, 0.29)
+
+    async def test_finish_replaces_the_preview(self):
+        message = FakeMessage()
+        stream = self.make_stream(message, interval_s=10.0)
+        stream.update('first')
+        await asyncio.sleep(0)
+        stream.update('first second')
+        await stream.finish('<b>done</b>')
+        self.assertEqual(message.edits[-1], ('<b>done</b>', 'HTML'))
+        self.assertEqual(self.sent, [])
+
+    async def test_finish_falls_back_to_send(self):
+        message = FakeMessage(errors=[BadRequest('Message to edit not found')])
+        stream = self.make_stream(message)
+        await stream.finish('<b>done</b>')
+        self.assertEqual(message.edits, [])
+        self.assertEqual(self.sent, [(message.chat, '<b>done</b>', 'HTML', False)])
+
+    async def test_finish_not_modified(self):
+        message = FakeMessage(errors=[BadRequest('Message is not modified')])
+        stream = self.make_stream(message)
+        await stream.finish('<b>done</b>')
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
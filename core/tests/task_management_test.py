@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import logging
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from core.task_management import TaskManager
+from core.utils import from_json_file, to_json_file
+
+
+class TestTaskCatalog(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        shutil.copytree('data/dates_en', self.data_root / 'dates_en')
+        self.task_manager = TaskManager(argparse.Namespace(data_root=str(self.data_root)))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_no_file_is_read_after_loading(self):
+        with mock.patch('builtins.open', side_effect=AssertionError('file read')):
+            task = self.task_manager.get_current_task('dates_en')
+            self.assertGreater(len(task.hidden_snippets), 0)
+            self.assertEqual(self.task_manager.search_tasks('dates'), ['dates_en'])
+            self.assertEqual(len(self.task_manager.fetch_task_conf_list()), 1)
+
+    async def test_catalog_is_reloaded_on_change(self):
+        old_task = self.task_manager.get_current_task('dates_en')
+        info_pth = self.data_root / 'dates_en' / 'info.json'
+        info = from_json_file(info_pth)
+        info['title'] = 'Updated title'
+        to_json_file(info_pth, info)
+
+        watch = asyncio.create_task(self.task_manager.watch(logging.getLogger('test'), interval_s=0.01))
+        try:
+            for _ in range(200):
+                if self.task_manager.get_current_task('dates_en') is not old_task:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watch.cancel()
+        self.assertEqual(self.task_manager.get_current_task('dates_en').title, 'Updated title')
+        # The task taken before keeps its data
+        self.assertNotEqual(old_task.title, 'Updated title')
+
+
+if __name__ == "__main__":
+    unittest.main()
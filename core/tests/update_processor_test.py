@@ -0,0 +1,104 @@
+import asyncio
+import itertools
+import unittest
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+from bot_partials.update_processor import PerUserUpdateProcessor
+
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id: int, text: str) -> Update:
+    message = Message(
+        message_id=next(_update_ids),
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=user_id, type='private'),
+        from_user=User(id=user_id, first_name=f'user{user_id}', is_bot=False),
+        text=text
+    )
+    return Update(update_id=next(_update_ids), message=message)
+
+
+class TestPerUserUpdateProcessor(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.processor = PerUserUpdateProcessor(max_concurrent_updates=4, unordered_commands=['stop'])
+        await self.processor.initialize()
+        self.log = []
+
+    async def handler(self, name: str, release: asyncio.Event = None, started: asyncio.Event = None):
+        self.log.append(f'{name} start')
+        if started is not None:
+            started.set()
+        if release is not None:
+            await release.wait()
+        self.log.append(f'{name} end')
+
+    async def started(self, count: int):
+        while len(self.log) < count:
+            await asyncio.sleep(0)
+
+    def process(self, update: Update, coroutine) -> asyncio.Task:
+        return asyncio.create_task(self.processor.process_update(update, coroutine))
+
+    async def test_same_user_in_order(self):
+        release = asyncio.Event()
+        started = asyncio.Event()
+        first = self.process(make_update(1, '/run_to_score'), self.handler('first', release, started))
+        second = self.process(make_update(1, 'some text'), self.handler('second'))
+        await asyncio.wait_for(started.wait(), 1.0)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.log, ['first start'])
+        release.set()
+        await asyncio.gather(first, second)
+        self.assertEqual(self.log, ['first start', 'first end', 'second start', 'second end'])
+        self.assertEqual(self.processor.user_locks, dict())
+
+    async def test_different_users_concurrently(self):
+        release = asyncio.Event()
+        started = asyncio.Event()
+        first = self.process(make_update(1, '/run_to_score'), self.handler('first', release))
+        other = self.process(make_update(2, '/run_to_score'), self.handler('other', started=started))
+        await asyncio.wait_for(started.wait(), 1.0)
+        await asyncio.wait_for(other, 1.0)
+        self.assertFalse(first.done())
+        release.set()
+        await first
+
+    async def test_concurrency_cap(self):
+        release = asyncio.Event()
+        tasks = [
+            self.process(make_update(user_id, '/run_to_score'), self.handler(f'user{user_id}', release))
+            for user_id in range(6)
+        ]
+        await asyncio.wait_for(self.started(4), 1.0)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(self.log), 4)
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(len(self.log), 12)
+
+    async def test_stop_is_not_queued(self):
+        for text in ['/stop', '/stop@prompetition_bot']:
+            with self.subTest(text=text):
+                release = asyncio.Event()
+                stopped = asyncio.Event()
+                running = self.process(make_update(1, '/run_to_score'), self.handler('running', release))
+                queued = self.process(make_update(1, 'some text'), self.handler('queued'))
+                stop = self.process(make_update(1, text), self.handler('stop', started=stopped))
+                await asyncio.wait_for(stopped.wait(), 1.0)
+                await asyncio.wait_for(stop, 1.0)
+                self.assertFalse(running.done())
+                self.assertFalse(queued.done())
+                release.set()
+                await asyncio.gather(running, queued)
+
+    async def test_other_commands_are_queued(self):
+        self.assertFalse(self.processor._is_unordered(make_update(1, '/stopper')))
+        self.assertFalse(self.processor._is_unordered(make_update(1, 'stop')))
+        self.assertTrue(self.processor._is_unordered(make_update(1, '/stop now')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import re
+import unittest
+
+from core.utils import split_tg_html
+
+TAG_RE = re.compile(r'<(/?)(\w+)[^>]*>')
+
+
+def visible_text(html: str) -> str:
+    return TAG_RE.sub('', html)
+
+
+def is_balanced(html: str) -> bool:
+    stack = []
+    for closing, name in TAG_RE.findall(html):
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+class TestSplitTgHtml(unittest.TestCase):
+    def setUp(self):
+        self.html = '<b>task - score: 50.00%</b>\n\n' + '\n'.join(
+            f'{idd}. <b>snippet_{idd}</b>\n<code>' + 'a &amp; b &lt; c\n' * 40 + '</code>'
+            for idd in range(10)
+        )
+
+    def test_short_html_is_kept(self):
+        self.assertEqual(split_tg_html('<b>short</b>', 100), ['<b>short</b>'])
+
+    def test_parts_fit_and_keep_tags_balanced(self):
+        parts = split_tg_html(self.html, 500)
+        self.assertGreater(len(parts), 1)
+        for part in parts:
+            self.assertLessEqual(len(part), 500)
+            self.assertTrue(is_balanced(part), part)
+
+    def test_text_is_preserved(self):
+        parts = split_tg_html(self.html, 500)
+        self.assertEqual(''.join(visible_text(part) for part in parts), visible_text(self.html))
+
+    def test_entities_are_not_cut(self):
+        html = '<code>' + '&amp;' * 300 + '</code>'
+        for part in split_tg_html(html, 100):
+            self.assertRegex(visible_text(part), r'^(&amp;)+$')
+
+    def test_cuts_at_line_ends(self):
+        html = '\n'.join(['x' * 30] * 10)
+        for part in split_tg_html(html, 100)[:-1]:
+            self.assertTrue(part.endswith('\n'))
+
+
+if __name__ == "__main__":
+    unittest.main()
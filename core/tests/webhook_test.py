@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import types
+import unittest
+from typing import Dict, Tuple
+
+from bot_partials.webhook import MAX_BODY_SIZE, SECRET_TOKEN_HEADER, WebhookServer
+
+SECRET = 'secret'
+UPDATE = {
+    'update_id': 1,
+    'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': '/help'},
+}
+
+
+def post(body: bytes, secret: str = SECRET, connection: str = 'keep-alive') -> bytes:
+    return (
+        f'POST /webhook HTTP/1.1\r\n'
+        f'Host: localhost\r\n'
+        f'{SECRET_TOKEN_HEADER}: {secret}\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {connection}\r\n'
+        f'\r\n'
+    ).encode('latin-1') + body
+
+
+class TestWebhookServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.application = types.SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        self.server = WebhookServer(
+            self.application, logging.getLogger('test'), '127.0.0.1', 0, 'webhook', secret_token=SECRET
+        )
+        await self.server.start()
+        self.server.ready = True
+        port = self.server.server.sockets[0].getsockname()[1]
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        await self.server.stop()
+
+    async def request(self, data: bytes) -> Tuple[int, Dict[str, str], bytes]:
+        self.writer.write(data)
+        await self.writer.drain()
+        status_line = await asyncio.wait_for(self.reader.readline(), 1.0)
+        if not status_line:
+            self.fail('connection closed without a response')
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(int(headers['content-length']))
+        return int(status_line.split()[1]), headers, body
+
+    async def assert_closed(self):
+        self.assertEqual(await asyncio.wait_for(self.reader.read(), 1.0), b'')
+
+    async def test_update_is_queued(self):
+        status, _, _ = await self.request(post(json.dumps(UPDATE).encode('utf-8')))
+        self.assertEqual(status, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual(update.update_id, 1)
+        self.assertEqual(update.message.text, '/help')
+
+    async def test_wrong_secret_is_rejected(self):
+        status, _, _ = await self.request(post(json.dumps(UPDATE).encode('utf-8'), secret='wrong'))
+        self.assertEqual(status, 403)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_keep_alive(self):
+        for update_id in range(1, 4):
+            body = json.dumps(dict(UPDATE, update_id=update_id)).encode('utf-8')
+            status, headers, _ = await self.request(post(body))
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['connection'], 'keep-alive')
+        self.assertEqual(self.application.update_queue.qsize(), 3)
+
+        status, headers, _ = await self.request(post(json.dumps(UPDATE).encode('utf-8'), connection='close'))
+        self.assertEqual(headers['connection'], 'close')
+        await self.assert_closed()
+
+    async def test_payload_too_large(self):
+        data = post(b'').replace(b'Content-Length: 0', f'Content-Length: {MAX_BODY_SIZE + 1}'.encode('latin-1'))
+        status, _, _ = await self.request(data)
+        self.assertEqual(status, 413)
+        await self.assert_closed()
+
+    async def test_malformed_request_line(self):
+        status, _, _ = await self.request(b'GARBAGE\r\n\r\n')
+        self.assertEqual(status, 400)
+        await self.assert_closed()
+
+    async def test_line_too_long(self):
+        status, _, _ = await self.request(b'GET /' + b'a' * 100_000 + b' HTTP/1.1\r\n\r\n')
+        self.assertEqual(status, 400)
+        await self.assert_closed()
+
+    async def test_malformed_update(self):
+        status, _, _ = await self.request(post(b'not json'))
+        self.assertEqual(status, 400)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_not_ready(self):
+        self.server.ready = False
+        status, _, _ = await self.request(b'GET /readyz HTTP/1.1\r\n\r\n')
+        self.assertEqual(status, 503)
+        status, _, _ = await self.request(post(json.dumps(UPDATE).encode('utf-8')))
+        self.assertEqual(status, 503)
+        status, _, _ = await self.request(b'GET /healthz HTTP/1.1\r\n\r\n')
+        self.assertEqual(status, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import json
+import re
 from pathlib import Path
-from typing import Union, Any
+from typing import List, Tuple, Union, Any
 
 PathLike = Union[str, Path]
 
@@ -42,5 +43,70 @@ def html_escape_obj(obj):
     else:
         return obj
 
+# A tag, an entity or a single character: a message is never cut inside the first two
+TG_HTML_TOKEN_RE = re.compile(r'<[^<>]+>|&#?\w+;|.', re.DOTALL)
+TG_HTML_TAG_RE = re.compile(r'<(/?)([\w-]+)')
+TG_MESSAGE_LENGTH = 4096
+
+
+def _closing_tags(open_tags: List[Tuple[str, str]]) -> str:
+    return ''.join(f'</{name}>' for name, _ in reversed(open_tags))
+
+
+def _opening_tags(open_tags: List[Tuple[str, str]]) -> str:
+    return ''.join(tag for _, tag in open_tags)
+
+
+def _has_text(html: str) -> bool:
+    return any(not token.startswith('<') and not token.isspace() for token in TG_HTML_TOKEN_RE.findall(html))
+
+
+def split_tg_html(html: str, limit: int = TG_MESSAGE_LENGTH) -> List[str]:
+    """
+    Splits Telegram HTML into parts of at most `limit` characters, preferably at line ends.
+    Tags open at a cut are closed at the end of the part and reopened at the start of the next one.
+    """
+    if len(html) <= limit:
+        return [html]
+    parts = []
+    current = ''
+    open_tags: List[Tuple[str, str]] = []
+    # Position in `current` after its last newline and the tags open there
+    last_break = None
+    for token in TG_HTML_TOKEN_RE.findall(html):
+        next_tags = open_tags
+        match = TG_HTML_TAG_RE.match(token) if token.startswith('<') else None
+        if match is not None:
+            closing, name = match.group(1), match.group(2).lower()
+            if not closing:
+                next_tags = open_tags + [(name, token)]
+            else:
+                names = [open_name for open_name, _ in open_tags]
+                if name in names:
+                    idx = len(names) - 1 - names[::-1].index(name)
+                    next_tags = open_tags[:idx] + open_tags[idx + 1:]
+
+        while len(current) + len(token) + len(_closing_tags(next_tags)) > limit:
+            if last_break is not None:
+                pos, break_tags = last_break
+                part, current = current[:pos] + _closing_tags(break_tags), _opening_tags(break_tags) + current[pos:]
+            elif current != _opening_tags(open_tags):
+                part, current = current + _closing_tags(open_tags), _opening_tags(open_tags)
+            else:
+                # The open tags alone don't leave room for the token, nothing to do but exceed
+                break
+            last_break = None
+            if _has_text(part):
+                parts.append(part)
+
+        current += token
+        open_tags = next_tags
+        if token == '\n':
+            last_break = (len(current), open_tags)
+    if _has_text(current):
+        parts.append(current + _closing_tags(open_tags))
+    return parts
+
+
 def tg_user_id(id) -> str:
     return f'TG:{id}'
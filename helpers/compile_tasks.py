@@ -0,0 +1,37 @@
+from typing import List
+
+from pathlib import Path
+import argparse
+
+from core.bundle import compile_task_bundle
+
+
+def parse_args(input_string: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compile task directories into single-file bundles")
+    parser.add_argument(
+        "--data_root",
+        type=str,
+        default='data',
+        help="Path to the tasks directory"
+    )
+    parser.add_argument(
+        "--task",
+        type=str,
+        default=None,
+        help="Directory name of the task to compile, all tasks by default"
+    )
+    return parser.parse_args(input_string)
+
+
+def main(args: argparse.Namespace):
+    data_root = Path(args.data_root)
+    task_dirs = [data_root / args.task] if args.task else sorted(data_root.glob('*'))
+    for task_dir in task_dirs:
+        if not (task_dir / 'info.json').exists():
+            continue
+        bundle_pth = compile_task_bundle(task_dir)
+        print(f'{task_dir} -> {bundle_pth} ({bundle_pth.stat().st_size} bytes)')
+
+
+if __name__ == '__main__':
+    main(parse_args())
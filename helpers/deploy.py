@@ -4,6 +4,8 @@ from typing import List
 from pathlib import Path
 import argparse
 
+from helpers.compile_tasks import main as compile_tasks
+
 
 def parse_args(input_string: List[str] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Update vector base")
@@ -49,6 +51,9 @@ def main(args: argparse.Namespace):
     for new_dir in creatable_dirs:
         (deploy_dir / new_dir).mkdir(exist_ok=True, parents=True)
 
+    # The deployed bot loads each task from a single bundle file
+    compile_tasks(argparse.Namespace(data_root=str(deploy_dir / 'data'), task=None))
+
 
 if __name__ == '__main__':
     main(parse_args())
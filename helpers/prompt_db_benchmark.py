@@ -0,0 +1,151 @@
+import argparse
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from core.prompt_db import MIGRATIONS, PromptDBManager
+
+# Run from the repository root: python -m helpers.prompt_db_benchmark
+
+
+def parse_args(input_string: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure PromptDBManager lookups before and after the migrations")
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=2_000_000,
+        help="Number of synthetic prompt runs (one prompt each)"
+    )
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=5_000,
+        help="Number of synthetic users"
+    )
+    parser.add_argument(
+        "--tasks",
+        type=int,
+        default=20,
+        help="Number of synthetic tasks"
+    )
+    parser.add_argument(
+        "--prompt_length",
+        type=int,
+        default=300,
+        help="Length of a synthetic prompt in characters"
+    )
+    parser.add_argument(
+        "--lookups",
+        type=int,
+        default=20,
+        help="Number of submissions and leaderboard queries to time with each schema"
+    )
+    parser.add_argument(
+        "--db_pth",
+        type=str,
+        default=None,
+        help="Database file to create (a temporary one by default)"
+    )
+    return parser.parse_args(input_string)
+
+
+def synthetic_prompt(i: int, length: int) -> str:
+    prefix = f'Prompt {i}: extract the date from the text and answer in YYYY/MM/DD. '
+    return (prefix * (length // len(prefix) + 1))[:length]
+
+
+def fill(db: PromptDBManager, args: argparse.Namespace):
+    rnd = random.Random(0)
+    batch = 100_000
+    for start in range(0, args.runs, batch):
+        rows = []
+        for i in range(start, min(start + batch, args.runs)):
+            rows.append((
+                i + 1, f'user{rnd.randrange(args.users)}', f'task{rnd.randrange(args.tasks)}',
+                synthetic_prompt(i, args.prompt_length)
+            ))
+        db.cursor.executemany('INSERT INTO prompts (prompt_id, user_id, task_id, prompt) VALUES (?, ?, ?, ?)', rows)
+        db.cursor.executemany('''
+            INSERT INTO prompt_runs (user_id, task_id, prompt_id, creation_date, open_score, open_runs, hidden_score, hidden_runs, parameters_json)
+            VALUES (?, ?, ?, '2024-11-01 00:00:00', ?, 10, ?, 50, 'null')
+        ''', [(user_id, task_id, prompt_id, rnd.random() * 10, rnd.random() * 50) for prompt_id, user_id, task_id, _ in rows])
+        db.conn.commit()
+    db.cursor.executemany(
+        'INSERT INTO users (user_id, user_name) VALUES (?, ?)',
+        [(f'user{i}', f'User {i}') for i in range(args.users)]
+    )
+    db.conn.commit()
+
+
+def sample_runs(db: PromptDBManager, args: argparse.Namespace) -> List[tuple]:
+    rnd = random.Random(1)
+    samples = []
+    for _ in range(args.lookups):
+        db.cursor.execute('''
+            SELECT p.user_id, p.task_id, p.prompt
+            FROM prompts p
+            WHERE p.prompt_id = ?
+        ''', (rnd.randrange(args.runs) + 1,))
+        samples.append(db.cursor.fetchone())
+    return samples
+
+
+def legacy_submission(db: PromptDBManager, user_id: str, task_id: str, prompt: str):
+    # The lookups of insert_prompt_run before the migrations
+    db.cursor.execute(
+        'SELECT prompt_id FROM prompts WHERE user_id = ? AND task_id = ? AND prompt = ?',
+        (user_id, task_id, prompt)
+    )
+    prompt_id = db.cursor.fetchone()[0]
+    db.cursor.execute('''
+        SELECT run_id, open_score, open_runs, hidden_score, hidden_runs
+        FROM prompt_runs
+        WHERE user_id = ? AND task_id = ? AND prompt_id = ? AND parameters_json = ?
+    ''', (user_id, task_id, prompt_id, json.dumps(None)))
+    db.cursor.fetchone()
+
+
+def timed_ms(calls: List[Callable[[], None]]) -> float:
+    start = time.perf_counter()
+    for call in calls:
+        call()
+    return (time.perf_counter() - start) / len(calls) * 1000
+
+
+def measure(db: PromptDBManager, samples: List[tuple], submission: Callable) -> List[float]:
+    return [
+        timed_ms([lambda sample=sample: submission(*sample) for sample in samples]),
+        timed_ms([lambda task_id=task_id: db.form_leader_board(task_id) for _, task_id, _ in samples]),
+        timed_ms([lambda sample=sample: db.get_top_k_user_prompts(sample[0], sample[1], 5) for sample in samples]),
+    ]
+
+
+def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_pth = args.db_pth or str(Path(tmp_dir) / 'sql.db')
+
+        start = time.perf_counter()
+        db = PromptDBManager(db_pth, schema_version=1)
+        fill(db, args)
+        print(f'filled:          {args.runs} runs, {args.users} users, {args.tasks} tasks in {time.perf_counter() - start:.1f}s')
+        samples = sample_runs(db, args)
+        before = measure(db, samples, lambda *sample: legacy_submission(db, *sample))
+        db.close()
+
+        start = time.perf_counter()
+        db = PromptDBManager(db_pth)
+        print(f'migrated:        to version {len(MIGRATIONS)} in {time.perf_counter() - start:.1f}s')
+        # Accumulates into the existing runs, the same work as a resubmitted prompt
+        after = measure(db, samples, lambda *sample: db.insert_prompt_run(*sample))
+        db.close()
+
+    print(f'{"ms per call":<16} {"before":>10} {"after":>10}')
+    for name, before_ms, after_ms in zip(['submission', 'leaderboard', 'user top-k'], before, after):
+        print(f'{name:<16} {before_ms:>10.2f} {after_ms:>10.2f}')
+
+
+if __name__ == '__main__':
+    main(parse_args())
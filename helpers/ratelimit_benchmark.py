@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import random
+import time
+from typing import List
+
+from core.ratelimit import Priority, RateLimiter
+
+# Run from the repository root: python -m helpers.ratelimit_benchmark
+
+
+def parse_args(input_string: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure RateLimiter throughput against its configured limit")
+    parser.add_argument(
+        "--rate_limit",
+        type=int,
+        default=20,
+        help="Requests allowed per time range"
+    )
+    parser.add_argument(
+        "--time_range_s",
+        type=float,
+        default=1.0,
+        help="Time range of the rate limit in seconds"
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=50,
+        help="Max number of requests in flight"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Number of requests to submit"
+    )
+    parser.add_argument(
+        "--latency_s",
+        type=float,
+        default=2.0,
+        help="Mean simulated request latency in seconds"
+    )
+    parser.add_argument(
+        "--interactive_requests",
+        type=int,
+        default=20,
+        help="Number of interactive requests submitted while the batch backlog is processed"
+    )
+    parser.add_argument(
+        "--interactive_interval_s",
+        type=float,
+        default=0.25,
+        help="Interval between interactive requests in seconds"
+    )
+    return parser.parse_args(input_string)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args: argparse.Namespace):
+    limiter = RateLimiter(
+        rate_limit=args.rate_limit,
+        time_range_s=args.time_range_s,
+        max_concurrency=args.max_concurrency,
+    )
+    start_times = []
+    interactive_waits = []
+
+    async def fake_request(collect_start: bool = True):
+        if collect_start:
+            start_times.append(time.monotonic())
+        await asyncio.sleep(random.uniform(0.5, 1.5) * args.latency_s)
+
+    async def interactive_requests():
+        for _ in range(args.interactive_requests):
+            await asyncio.sleep(args.interactive_interval_s)
+            submitted_s = time.monotonic()
+
+            async def timed_request():
+                interactive_waits.append(time.monotonic() - submitted_s)
+                await fake_request(collect_start=False)
+
+            asyncio.create_task(limiter.submit(timed_request(), user_id='interactive', priority=Priority.INTERACTIVE))
+
+    begin_s = time.monotonic()
+    await asyncio.gather(
+        limiter.submit_batch([fake_request() for _ in range(args.requests)], user_id='batch'),
+        interactive_requests()
+    )
+    total_s = time.monotonic() - begin_s
+    await limiter.close()
+
+    configured_rps = args.rate_limit / args.time_range_s
+    # The first `rate_limit` requests go out as a burst, the rest show the sustained rate.
+    sustained = start_times[args.rate_limit:]
+    if len(sustained) > 1:
+        sustained_rps = (len(sustained) - 1) / (sustained[-1] - sustained[0])
+    else:
+        sustained_rps = float('nan')
+
+    print(f'configured:      {configured_rps:.2f} rps, max concurrency {args.max_concurrency}')
+    print(f'requests:        {args.requests}, mean latency {args.latency_s:.2f}s')
+    print(f'total time:      {total_s:.2f}s')
+    print(f'overall rps:     {args.requests / total_s:.2f}')
+    print(f'sustained rps:   {sustained_rps:.2f} ({sustained_rps / configured_rps * 100:.1f}% of configured)')
+    if interactive_waits:
+        print(f'interactive:     {len(interactive_waits)} requests during the batch backlog')
+        print(f'queueing p50:    {percentile(interactive_waits, 0.5):.3f}s')
+        print(f'queueing p95:    {percentile(interactive_waits, 0.95):.3f}s')
+
+
+def main(args: argparse.Namespace):
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main(parse_args())